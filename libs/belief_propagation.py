@@ -0,0 +1,556 @@
+# Copyright (C) 2024 Sebastien CHRISTIAN, University of French Polynesia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import copy
+import time
+from collections.abc import MutableMapping
+import numpy as np
+import pandas as pd
+
+# Array-backed loopy belief propagation used by GeneralAgent and BatchedGeneralAgent.
+# The engine holds n_rows independent sets of beliefs and messages over the same graph (one row per target
+# language, GeneralAgent uses a single row).
+# Beliefs of all nodes are stored in one (rows x slots) array (node k's beliefs are the columns
+# belief_offsets[k]:belief_offsets[k+1]), messages in another one ordered by sender, then recipient:
+# the messages a node sends are one contiguous slice, computed with a single batch of array operations.
+# Same computations as the former dict implementation of GeneralAgent:
+#   message i->j = normalize(weight_i * psi_ij @ (phi_i * product of messages k->i, k neighbor of i, k != j))
+#   belief_i = damped(normalize(phi_i * product of messages received by i))
+# A NaN in a potential makes the messages of that edge uniform, as it did with DataFrame.at lookups.
+
+
+def segment_sums(values, segment_ids, n_segments):
+    """ sums of the columns of each segment, for each row of values (rows x columns) """
+    n_rows = values.shape[0]
+    if n_rows == 1:
+        return np.bincount(segment_ids, weights=values[0], minlength=n_segments)[None, :]
+    ids = (np.arange(n_rows)[:, None] * n_segments + segment_ids[None, :]).ravel()
+    return np.bincount(ids, weights=values.ravel(), minlength=n_rows * n_segments).reshape(n_rows, n_segments)
+
+
+def normalize_segments(values, segment_ids, segment_sizes):
+    """ normalizes in place each segment of each row, uniform on segments whose sum is not > 0 (zero or NaN)."""
+    sums = segment_sums(values, segment_ids, len(segment_sizes))
+    valid = sums > 0
+    np.divide(values, np.where(valid, sums, 1.0)[:, segment_ids], out=values)
+    invalid = ~valid[:, segment_ids]
+    if invalid.any():
+        values[invalid] = np.broadcast_to(1.0 / np.maximum(segment_sizes[segment_ids], 1), values.shape)[invalid]
+    return values
+
+
+class PotentialMap(MutableMapping):
+    """ {recipient: DataFrame} of the potentials sent by one node, stored as arrays with their labels
+    (recipient values, sender values). DataFrames are created on first access, the engine reads the arrays directly.
+    Used by agents loaded from a file (see GeneralAgent.load), that may never need most DataFrames."""
+    def __init__(self):
+        self.blocks = {}
+        self.frames = {}
+
+    def add_block(self, recipient, array, index, columns):
+        self.frames.pop(recipient, None)
+        self.blocks[recipient] = (array, list(index), list(columns))
+
+    def potential_array(self, recipient, row_values, column_values):
+        if recipient not in self.frames:
+            array, index, columns = self.blocks[recipient]
+            if index == list(row_values) and columns == list(column_values):
+                return array
+        return BeliefPropagationEngine.potential_array(self[recipient], row_values, column_values)
+
+    def __getitem__(self, recipient):
+        if recipient not in self.frames:
+            array, index, columns = self.blocks[recipient]
+            self.frames[recipient] = pd.DataFrame(array, index=index, columns=columns)
+        return self.frames[recipient]
+
+    def __setitem__(self, recipient, cp_matrix):
+        self.frames[recipient] = cp_matrix
+        self.blocks[recipient] = None
+
+    def __delitem__(self, recipient):
+        del self.blocks[recipient]
+        self.frames.pop(recipient, None)
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+    def __len__(self):
+        return len(self.blocks)
+
+
+class BeliefPropagationEngine:
+    """ graph is {sender: {recipient: DataFrame rows recipient values x columns sender values}} as in GeneralAgent,
+    values_by_node is {node: [values]} in the order used by the belief vectors."""
+    def __init__(self, graph, values_by_node, n_rows=1):
+        self.graph = graph
+        self.n_rows = n_rows
+        self.nodes = list(values_by_node.keys())
+        self.node_index = {node: k for k, node in enumerate(self.nodes)}
+        self.values = [list(values_by_node[node]) for node in self.nodes]
+        self.value_index = [{v: i for i, v in enumerate(values)} for values in self.values]
+        n = len(self.nodes)
+        sizes = np.array([len(values) for values in self.values], dtype=np.int64)
+        self.belief_offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.belief_sizes = sizes
+        self.slot_node = np.repeat(np.arange(n), sizes)
+        self.beliefs = np.zeros((n_rows, self.belief_offsets[-1]))
+        self.weights = np.ones((n_rows, n))
+        self.locked = np.zeros((n_rows, n), dtype=bool)
+        self.entropy = np.zeros((n_rows, n))
+
+        # edges, numbered by sender then recipient
+        self.edge_sender = []
+        self.edge_recipient = []
+        self.out_edges = [[] for _ in range(n)]
+        potentials_by_sender = [[] for _ in range(n)]
+        for sender in self.nodes:
+            i = self.node_index[sender]
+            potentials = graph.get(sender, {})
+            for recipient in potentials:
+                if recipient not in self.node_index or recipient == sender:
+                    continue
+                j = self.node_index[recipient]
+                self.out_edges[i].append(len(self.edge_sender))
+                self.edge_sender.append(i)
+                self.edge_recipient.append(j)
+                if isinstance(potentials, PotentialMap):
+                    potential = potentials.potential_array(recipient, self.values[j], self.values[i])
+                else:
+                    potential = self.potential_array(potentials[recipient], self.values[j], self.values[i])
+                potentials_by_sender[i].append(potential)
+        self.edge_sender = np.array(self.edge_sender, dtype=np.int64)
+        self.edge_recipient = np.array(self.edge_recipient, dtype=np.int64)
+        self.edge_index = {(int(i), int(j)): e for e, (i, j) in enumerate(zip(self.edge_sender, self.edge_recipient))}
+        message_sizes = sizes[self.edge_recipient] if len(self.edge_recipient) else np.zeros(0, dtype=np.int64)
+        self.message_offsets = np.concatenate([[0], np.cumsum(message_sizes)]).astype(np.int64)
+        n_message_values = int(self.message_offsets[-1])
+        # never sent messages are all ones; the extra last column is a constant 1 used for missing reverse edges
+        self.messages = np.ones((n_rows, n_message_values + 1))
+        self.sent = np.zeros((n_rows, len(self.edge_sender)), dtype=bool)
+
+        # per sender: stacked potentials of its outgoing edges, and where to read the messages it received
+        # from the same neighbors (its inbox, restricted to the neighbors it sends to)
+        self.sender_potentials = []
+        self.sender_row_edge = []
+        self.sender_segment_sizes = []
+        self.sender_inbox_index = []
+        for i in range(n):
+            edges = self.out_edges[i]
+            if not edges:
+                self.sender_potentials.append(None)
+                self.sender_row_edge.append(None)
+                self.sender_segment_sizes.append(None)
+                self.sender_inbox_index.append(None)
+                continue
+            self.sender_potentials.append(np.vstack(potentials_by_sender[i]))
+            segment_sizes = message_sizes[edges]
+            self.sender_segment_sizes.append(segment_sizes)
+            self.sender_row_edge.append(np.repeat(np.arange(len(edges)), segment_sizes))
+            inbox_index = np.full((len(edges), sizes[i]), n_message_values, dtype=np.int64)
+            for r, e in enumerate(edges):
+                reverse = self.edge_index.get((int(self.edge_recipient[e]), i), None)
+                if reverse is not None:
+                    start = self.message_offsets[reverse]
+                    inbox_index[r] = np.arange(start, start + sizes[i])
+            self.sender_inbox_index.append(inbox_index)
+
+        # product of all messages received by each belief slot
+        message_slot = np.zeros(n_message_values, dtype=np.int64)
+        for e, j in enumerate(self.edge_recipient):
+            start, end = self.message_offsets[e], self.message_offsets[e + 1]
+            message_slot[start:end] = np.arange(self.belief_offsets[j], self.belief_offsets[j + 1])
+        self.incoming_order = np.argsort(message_slot, kind="stable")
+        sorted_slots = message_slot[self.incoming_order]
+        if len(sorted_slots):
+            self.incoming_starts = np.flatnonzero(np.concatenate([[True], sorted_slots[1:] != sorted_slots[:-1]]))
+            self.incoming_slots = sorted_slots[self.incoming_starts]
+        else:
+            self.incoming_starts = np.zeros(0, dtype=np.int64)
+            self.incoming_slots = np.zeros(0, dtype=np.int64)
+        # per sender structures padded to the same shape, built on first use (see build_padded_senders)
+        self.padded = None
+
+    @staticmethod
+    def potential_array(cp_matrix, row_values, column_values):
+        if list(cp_matrix.index) == list(row_values) and list(cp_matrix.columns) == list(column_values):
+            return cp_matrix.to_numpy(dtype=float)
+        # values missing from the potential are NaN, which makes the messages of that edge uniform
+        return cp_matrix.reindex(index=row_values, columns=column_values).to_numpy(dtype=float)
+
+    def has_same_values(self, node, beliefs):
+        value_index = self.value_index[self.node_index[node]]
+        return len(beliefs) == len(value_index) and all(v in value_index for v in beliefs)
+
+    def node_slice(self, k):
+        return slice(self.belief_offsets[k], self.belief_offsets[k + 1])
+
+    def set_beliefs(self, node, beliefs, row=0):
+        k = self.node_index[node]
+        self.beliefs[row, self.node_slice(k)] = [beliefs[v] for v in self.values[k]]
+
+    def get_beliefs(self, node, row=0):
+        k = self.node_index[node]
+        return dict(zip(self.values[k], self.beliefs[row, self.node_slice(k)].tolist()))
+
+    def replicate(self, n_rows, row=0):
+        """ engine sharing the graph, values and potentials of this one, with n_rows copies of the beliefs, weights,
+        locks and messages of row. """
+        engine = copy.copy(self)
+        engine.n_rows = n_rows
+        for name in ["beliefs", "weights", "locked", "entropy", "messages", "sent"]:
+            setattr(engine, name, np.repeat(getattr(self, name)[row:row + 1], n_rows, axis=0))
+        return engine
+
+    def reset_messages(self):
+        self.messages[:] = 1.0
+        self.sent[:] = False
+
+    def message_inputs(self, i, rows=slice(None)):
+        """ for each neighbor j of node i, phi_i * product of the messages received by i from its other neighbors
+        (rows x neighbors x values of i)."""
+        inbox = self.messages[rows][:, self.sender_inbox_index[i]]
+        n_selected, n_edges, n_values = inbox.shape
+        # product of the messages of all neighbors but the recipient: exclusive prefix x suffix products
+        ones = np.ones((n_selected, 1, n_values))
+        prefix = np.cumprod(np.concatenate([ones, inbox[:, :-1]], axis=1), axis=1)
+        suffix = np.cumprod(np.concatenate([inbox[:, 1:], ones], axis=1)[:, ::-1], axis=1)[:, ::-1]
+        return self.beliefs[rows, self.node_slice(i)][:, None, :] * prefix * suffix
+
+    def compute_messages(self, i, rows=slice(None), inputs=None, edge_mask=None):
+        """ messages sent by node i to each of its neighbors, concatenated in out_edges[i] order, for the rows given
+        (rows x concatenated messages). With edge_mask, only the messages of the selected out edges."""
+        potentials = self.sender_potentials[i]
+        if potentials is None:
+            return np.zeros((self.beliefs[rows].shape[0], 0))
+        if inputs is None:
+            inputs = self.message_inputs(i, rows)
+        row_edge = self.sender_row_edge[i]
+        segment_sizes = self.sender_segment_sizes[i]
+        if edge_mask is not None:
+            potential_rows = edge_mask[row_edge]
+            potentials = potentials[potential_rows]
+            row_edge = row_edge[potential_rows]
+            segment_sizes = segment_sizes[edge_mask]
+            # segment ids of the selected edges, renumbered from 0
+            inputs = inputs[:, edge_mask]
+            row_edge = np.cumsum(edge_mask)[row_edge] - 1
+        messages = np.einsum("kc,rkc->rk", potentials, inputs[:, row_edge])
+        messages *= self.weights[rows, i][:, None]
+        return normalize_segments(messages, row_edge, segment_sizes)
+
+    def send_messages(self, i, rows=slice(None)):
+        edges = self.out_edges[i]
+        if edges:
+            columns = slice(self.message_offsets[edges[0]], self.message_offsets[edges[-1] + 1])
+            if isinstance(rows, slice):
+                self.messages[rows, columns] = self.compute_messages(i, rows)
+                self.sent[rows, edges[0]:edges[-1] + 1] = True
+            else:
+                self.messages[rows[:, None], np.arange(columns.start, columns.stop)[None, :]] = self.compute_messages(i, rows)
+                self.sent[rows[:, None], np.arange(edges[0], edges[-1] + 1)[None, :]] = True
+
+    def build_padded_senders(self):
+        """ potentials, inbox and message indexes of every sender padded to the same shape
+        (senders x potential rows x sender values), so that rows sending from different nodes are computed together.
+        Padded potential rows and columns are 0, padded inbox cells read the constant 1 message column."""
+        n = len(self.nodes)
+        n_message_values = self.messages.shape[1] - 1
+        max_edges = max([len(edges) for edges in self.out_edges] + [1])
+        max_values = max([int(size) for size in self.belief_sizes] + [1])
+        max_rows = max([len(row_edge) for row_edge in self.sender_row_edge if row_edge is not None] + [1])
+        padded = {"potentials": np.zeros((n, max_rows, max_values)),
+                  # segment of each potential row: its edge, max_edges for padding rows
+                  "row_edge": np.full((n, max_rows), max_edges, dtype=np.int64),
+                  "input_edge": np.zeros((n, max_rows), dtype=np.int64),
+                  "segment_sizes": np.ones((n, max_edges + 1), dtype=np.int64),
+                  "inbox_index": np.full((n, max_edges, max_values), n_message_values, dtype=np.int64),
+                  "belief_index": np.zeros((n, max_values), dtype=np.int64),
+                  "message_index": np.full((n, max_rows), n_message_values, dtype=np.int64),
+                  "valid_rows": np.zeros((n, max_rows), dtype=bool),
+                  "edges": np.zeros((n, max_edges), dtype=np.int64),
+                  "valid_edges": np.zeros((n, max_edges), dtype=bool),
+                  "max_edges": max_edges}
+        for i in range(n):
+            size = int(self.belief_sizes[i])
+            padded["belief_index"][i, :size] = np.arange(self.belief_offsets[i], self.belief_offsets[i + 1])
+            edges = self.out_edges[i]
+            if not edges:
+                continue
+            n_rows = len(self.sender_row_edge[i])
+            padded["potentials"][i, :n_rows, :size] = self.sender_potentials[i]
+            padded["row_edge"][i, :n_rows] = self.sender_row_edge[i]
+            padded["input_edge"][i, :n_rows] = self.sender_row_edge[i]
+            padded["segment_sizes"][i, :len(edges)] = self.sender_segment_sizes[i]
+            padded["inbox_index"][i, :len(edges), :size] = self.sender_inbox_index[i]
+            padded["message_index"][i, :n_rows] = np.arange(self.message_offsets[edges[0]],
+                                                            self.message_offsets[edges[-1] + 1])
+            padded["valid_rows"][i, :n_rows] = True
+            padded["edges"][i, :len(edges)] = edges
+            padded["valid_edges"][i, :len(edges)] = True
+        self.padded = padded
+        return padded
+
+    def send_messages_by_row(self, senders):
+        """ each row r sends the messages of node senders[r], all rows computed together (same computation as
+        send_messages, on the padded sender structures)."""
+        padded = self.padded if self.padded is not None else self.build_padded_senders()
+        rows = np.arange(self.n_rows)
+        max_edges = padded["max_edges"]
+        inbox = self.messages[rows[:, None, None], padded["inbox_index"][senders]]
+        ones = np.ones((self.n_rows, 1, inbox.shape[2]))
+        prefix = np.cumprod(np.concatenate([ones, inbox[:, :-1]], axis=1), axis=1)
+        suffix = np.cumprod(np.concatenate([inbox[:, 1:], ones], axis=1)[:, ::-1], axis=1)[:, ::-1]
+        inputs = self.beliefs[rows[:, None], padded["belief_index"][senders]][:, None, :] * prefix * suffix
+        row_edge = padded["row_edge"][senders]
+        messages = np.einsum("rkc,rkc->rk", padded["potentials"][senders],
+                             inputs[rows[:, None], padded["input_edge"][senders]])
+        messages *= self.weights[rows, senders][:, None]
+        # normalization of each (row, edge) segment, uniform when the sum is not > 0
+        segments = rows[:, None] * (max_edges + 1) + row_edge
+        sums = np.bincount(segments.ravel(), weights=messages.ravel(),
+                           minlength=self.n_rows * (max_edges + 1))[segments]
+        valid = sums > 0
+        messages = np.where(valid, messages / np.where(valid, sums, 1.0),
+                            1.0 / padded["segment_sizes"][senders][rows[:, None], row_edge])
+        valid_rows = padded["valid_rows"][senders]
+        self.messages[np.nonzero(valid_rows)[0], padded["message_index"][senders][valid_rows]] = messages[valid_rows]
+        valid_edges = padded["valid_edges"][senders]
+        self.sent[np.nonzero(valid_edges)[0], padded["edges"][senders][valid_edges]] = True
+
+    def run_message_round(self, node_order):
+        """ nodes send their messages in that order, each using the messages already received in the round.
+        node_order is either a list of nodes used for all rows, or a list of such lists, one per row."""
+        if len(node_order) and isinstance(node_order[0], (list, tuple)):
+            orders = np.array([[self.node_index[node] for node in order if node in self.node_index]
+                               for order in node_order], dtype=np.int64)
+            for step in range(orders.shape[1]):
+                self.send_messages_by_row(orders[:, step])
+        else:
+            for node in node_order:
+                if node in self.node_index:
+                    self.send_messages(self.node_index[node])
+
+    def get_message(self, sender, recipient, row=0):
+        e = self.edge_index[(self.node_index[sender], self.node_index[recipient])]
+        k = self.node_index[recipient]
+        return dict(zip(self.values[k], self.messages[row, self.message_offsets[e]:self.message_offsets[e + 1]].tolist()))
+
+    def get_message_inbox(self, node, row=0):
+        """ {sender: {value: p}} of the messages received by node."""
+        k = self.node_index[node]
+        return {self.nodes[self.edge_sender[e]]: self.get_message(self.nodes[self.edge_sender[e]], node, row)
+                for e in np.flatnonzero((self.edge_recipient == k) & self.sent[row])}
+
+    def update_beliefs(self, nodes, damping_factor=0.5, rows=None):
+        """ updates the beliefs of the unlocked nodes given (all rows by default) from the messages they received.
+        Returns the (rows x nodes) mask of the updated beliefs."""
+        selected = np.zeros((self.n_rows, len(self.nodes)), dtype=bool)
+        node_ks = [self.node_index[node] for node in nodes if node in self.node_index]
+        if rows is None:
+            selected[:, node_ks] = True
+        else:
+            selected[np.ix_(np.atleast_1d(rows), node_ks)] = True
+        selected &= ~self.locked
+        if not selected.any():
+            return selected
+        damped = self.damped_beliefs(damping_factor)
+        selected_slots = selected[:, self.slot_node]
+        self.beliefs[selected_slots] = damped[selected_slots]
+        self.update_entropy()
+        return selected
+
+    def damped_beliefs(self, damping_factor=0.5):
+        """ beliefs of all nodes updated from the messages received, without storing them."""
+        products = np.ones(self.beliefs.shape)
+        if len(self.incoming_order):
+            products[:, self.incoming_slots] = np.multiply.reduceat(self.messages[:, self.incoming_order],
+                                                                    self.incoming_starts, axis=1)
+        computed = normalize_segments(self.beliefs * products, self.slot_node, self.belief_sizes)
+        damped = damping_factor * self.beliefs + (1 - damping_factor) * computed
+        return normalize_segments(damped, self.slot_node, self.belief_sizes)
+
+    def run_residual_schedule(self, tolerance=1e-3, max_iterations=50, damping_factor=0.5):
+        """ residual belief propagation: at each iteration, a message is computed only when its inputs
+        (normalized phi_i * product of the other messages received by the sender) changed by more than
+        tolerance since it was last sent, and sent only when it changed by more than tolerance.
+        Only the nodes that received new messages update their beliefs.
+        Iterations are synchronous (all candidate messages are computed from the same state), so results
+        do not depend on any order. Stops when no message nor belief changes by more than tolerance.
+        Returns a report: iterations, converged, residual_history (max change per iteration),
+        message_computations, and cycle_times (wall time of each iteration, in seconds)."""
+        report = {"iterations": 0, "converged": False, "residual_history": [], "message_computations": 0,
+                  "cycle_times": []}
+        n = len(self.nodes)
+        # inputs each message was last sent with, NaN until it is sent by the schedule
+        sent_inputs = [None if not self.out_edges[i] else
+                       np.full((self.n_rows, len(self.out_edges[i]), self.belief_sizes[i]), np.nan) for i in range(n)]
+        dirty = np.ones((self.n_rows, n), dtype=bool)
+        for iteration in range(max_iterations):
+            t0 = time.perf_counter()
+            received = np.zeros((self.n_rows, n), dtype=bool)
+            max_residual = 0.0
+            updates = []
+            for i in range(n):
+                edges = self.out_edges[i]
+                rows = np.flatnonzero(dirty[:, i])
+                if not edges or not len(rows):
+                    continue
+                inputs = self.message_inputs(i, rows)
+                sums = inputs.sum(axis=2, keepdims=True)
+                normalized_inputs = np.divide(inputs, sums, out=np.zeros(inputs.shape), where=sums > 0)
+                input_change = np.abs(normalized_inputs - sent_inputs[i][rows]).max(axis=2, initial=0.0)
+                stale = ~(input_change <= tolerance)
+                edge_mask = stale.any(axis=0)
+                if not edge_mask.any():
+                    continue
+                candidates = self.compute_messages(i, rows, inputs=inputs, edge_mask=edge_mask)
+                report["message_computations"] += len(rows) * int(edge_mask.sum())
+                selected_edges = np.array(edges)[edge_mask]
+                columns = np.concatenate([np.arange(self.message_offsets[e], self.message_offsets[e + 1])
+                                          for e in selected_edges])
+                # residual of each message: max absolute change over its values
+                difference = np.abs(candidates - self.messages[rows[:, None], columns[None, :]])
+                sizes = self.sender_segment_sizes[i][edge_mask]
+                residuals = np.zeros((len(rows), len(selected_edges)))
+                if len(columns):
+                    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+                    residuals[:, sizes > 0] = np.maximum.reduceat(difference, starts[sizes > 0], axis=1)
+                changed = (residuals > tolerance) & stale[:, edge_mask]
+                if changed.any():
+                    max_residual = max(max_residual, float(residuals[changed].max()))
+                    updates.append((i, rows, edge_mask, selected_edges, columns, candidates, changed,
+                                    normalized_inputs[:, edge_mask]))
+            for i, rows, edge_mask, selected_edges, columns, candidates, changed, normalized_inputs in updates:
+                keep = ~np.repeat(changed, self.sender_segment_sizes[i][edge_mask], axis=1)
+                candidates[keep] = self.messages[rows[:, None], columns[None, :]][keep]
+                self.messages[rows[:, None], columns[None, :]] = candidates
+                self.sent[rows[:, None], selected_edges[None, :]] |= changed
+                sent_inputs_i = sent_inputs[i][rows][:, edge_mask]
+                sent_inputs_i[changed] = normalized_inputs[changed]
+                block = sent_inputs[i][rows]
+                block[:, edge_mask] = sent_inputs_i
+                sent_inputs[i][rows] = block
+                for r, row in enumerate(rows):
+                    received[row, self.edge_recipient[selected_edges[changed[r]]]] = True
+            # beliefs of the unlocked nodes that received new messages
+            to_update = received & ~self.locked
+            belief_changed = np.zeros((self.n_rows, n), dtype=bool)
+            if to_update.any():
+                damped = self.damped_beliefs(damping_factor)
+                slots = to_update[:, self.slot_node]
+                change = np.where(slots, np.abs(damped - self.beliefs), 0.0)
+                self.beliefs[slots] = damped[slots]
+                node_change = np.zeros((self.n_rows, n))
+                np.maximum.at(node_change, (slice(None), self.slot_node), change)
+                belief_changed = node_change > tolerance
+                max_residual = max(max_residual, float(node_change.max()))
+            # a node may send again when its beliefs or the messages it received changed
+            dirty = received | belief_changed
+            report["iterations"] = iteration + 1
+            report["residual_history"].append(max_residual)
+            report["cycle_times"].append(time.perf_counter() - t0)
+            if not dirty.any():
+                report["converged"] = True
+                break
+        self.update_entropy()
+        return report
+
+    def update_entropy(self):
+        """ entropy of each node, normalized by log of its number of values (0 for less than 2 values)."""
+        p = self.beliefs
+        terms = np.zeros(p.shape)
+        positive = p > 0
+        terms[positive] = -p[positive] * np.log(p[positive])
+        entropy = segment_sums(terms, self.slot_node, len(self.nodes))
+        norm = np.log(np.maximum(self.belief_sizes, 1))
+        self.entropy = np.divide(entropy, norm, out=np.zeros(entropy.shape), where=norm > 0)
+        return self.entropy
+
+    def edge_scores(self, row=0):
+        """ for each edge i->j: mutual information between i and j under the joint phi_i(x_i) * psi_ij(x_j, x_i),
+        and support, the share of the cells of psi_ij that are not NaN. Returns two arrays indexed by edge. """
+        mutual_information = np.zeros(len(self.edge_sender))
+        support = np.zeros(len(self.edge_sender))
+        for i, edges in enumerate(self.out_edges):
+            if not edges or self.belief_sizes[i] == 0:
+                continue
+            potentials = self.sender_potentials[i]
+            row_edge = self.sender_row_edge[i]
+            defined = ~np.isnan(potentials)
+            support[edges] = np.bincount(row_edge, weights=defined.sum(axis=1), minlength=len(edges)) / \
+                np.maximum(self.sender_segment_sizes[i] * self.belief_sizes[i], 1)
+            joint = np.where(defined, potentials, 0.0) * self.beliefs[row, self.node_slice(i)][None, :]
+            z = np.bincount(row_edge, weights=joint.sum(axis=1), minlength=len(edges))
+            joint /= np.where(z > 0, z, 1.0)[row_edge][:, None]
+            # marginals: p_j per row of the stacked potentials, p_i per edge and value of i
+            p_j = joint.sum(axis=1)
+            p_i = np.zeros((len(edges), self.belief_sizes[i]))
+            np.add.at(p_i, row_edge, joint)
+            positive = joint > 0
+            terms = np.zeros(joint.shape)
+            terms[positive] = joint[positive] * (np.log(joint[positive])
+                                                 - np.log(np.broadcast_to(p_j[:, None], joint.shape)[positive])
+                                                 - np.log(p_i[row_edge][positive]))
+            mutual_information[edges] = np.bincount(row_edge, weights=terms.sum(axis=1), minlength=len(edges))
+        return np.maximum(mutual_information, 0.0), support
+
+    def get_winning_values(self, row=0):
+        """ {node: value of highest belief} """
+        return {node: self.values[k][int(np.argmax(self.beliefs[row, self.node_slice(k)]))]
+                for k, node in enumerate(self.nodes) if self.belief_sizes[k] > 0}
+
+
+def prune_graph(graph, engine, max_neighbors=None, min_mutual_information=None, min_support=None, row=0):
+    """ sparse version of graph (same DataFrames), keeping the pairs of nodes (both directions) whose score,
+    the largest mutual information of the two directions (see edge_scores), is at least min_mutual_information,
+    and that are among the max_neighbors best pairs of one of their nodes. With min_support, directions whose
+    potentials have a smaller share of non-NaN cells do not count. Returns (pruned graph, report). """
+    edge_mutual_information, support = engine.edge_scores(row)
+    mutual_information = edge_mutual_information
+    if min_support is not None:
+        mutual_information = np.where(support >= min_support, mutual_information, -np.inf)
+    n = len(engine.nodes)
+    scores = np.full((n, n), -np.inf)
+    scores[engine.edge_sender, engine.edge_recipient] = mutual_information
+    scores = np.maximum(scores, scores.T)
+    keep = np.isfinite(scores)
+    if min_mutual_information is not None:
+        keep &= scores >= min_mutual_information
+    if max_neighbors is not None:
+        ranked = np.where(keep, scores, -np.inf)
+        top = np.zeros((n, n), dtype=bool)
+        best = np.argsort(-ranked, axis=1, kind="stable")[:, :max_neighbors]
+        top[np.repeat(np.arange(n), best.shape[1]), best.ravel()] = True
+        keep &= top | top.T
+    pruned = {}
+    for sender in graph.keys():
+        if sender not in engine.node_index:
+            pruned[sender] = dict(graph[sender])
+            continue
+        i = engine.node_index[sender]
+        pruned[sender] = {recipient: cp_matrix for recipient, cp_matrix in graph[sender].items()
+                          if recipient in engine.node_index and keep[i, engine.node_index[recipient]]}
+    n_edges = len(engine.edge_sender)
+    kept_edges = sum(len(neighbors) for neighbors in pruned.values())
+    report = {"nodes": n,
+              "edges": n_edges,
+              "kept_edges": kept_edges,
+              "density": kept_edges / (n * (n - 1)) if n > 1 else 0.0,
+              "full_density": n_edges / (n * (n - 1)) if n > 1 else 0.0,
+              "kept_mutual_information": float(edge_mutual_information[keep[engine.edge_sender, engine.edge_recipient]].sum())
+              if n_edges else 0.0,
+              "total_mutual_information": float(edge_mutual_information.sum())}
+    return pruned, report
@@ -0,0 +1,531 @@
+# Copyright (C) 2024 Sebastien CHRISTIAN, University of French Polynesia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import hashlib
+import itertools
+import weakref
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from libs.data_registry import resolve_data_root
+
+# Conditional probability tables (CPT) are value x value matrices M where M[a, b] estimates P(A|B),
+# A and B being binary "value present in language" indicators.
+# Instead of counting languages for each (a, b) pair, we build once a sparse language x value
+# incidence matrix X (X[l, v] = 1 if language l has value v). The co-occurrence matrix
+# K = X.T @ X then holds every k_A∧B at once, and its diagonal holds every n_B.
+
+
+def build_incidence_matrix(values_by_language, language_ids, value_ids):
+    """ builds the sparse language x value incidence matrix.
+    values_by_language is a dict {language id: [value ids]}, rows follow language_ids and columns follow value_ids.
+    Values not in value_ids and languages without values are ignored."""
+    value_index = {str(v): i for i, v in enumerate(value_ids)}
+    rows = []
+    cols = []
+    for row, language_id in enumerate(language_ids):
+        for v in values_by_language.get(str(language_id), []):
+            col = value_index.get(str(v), None)
+            if col is not None:
+                rows.append(row)
+                cols.append(col)
+    incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                  shape=(len(language_ids), len(value_ids)),
+                                  dtype=np.int32)
+    # a value listed twice for a language is still a single presence
+    incidence.data[:] = 1
+    return incidence
+
+
+def compute_cooccurrence_counts(incidence):
+    """ returns the dense value x value matrix K where K[a, b] is the number of languages having both a and b.
+    The diagonal K[b, b] is n_B, the number of languages having b."""
+    return np.asarray((incidence.T @ incidence).todense(), dtype=np.int64)
+
+
+def compute_conditional_probability_arrays(cooccurrence, n_min, k_min, alpha, beta):
+    """ applies the CPT estimation rules to a co-occurrence matrix, for all pairs at once.
+    p_hat[a, b] = (k_A∧B + alpha) / (n_B + alpha + beta)
+    Cells are NaN when n_B == 0, n_B < n_min or k_A∧B < k_min.
+    Returns (p_hat, n_b) with n_b the vector of n_B counts."""
+    k = np.asarray(cooccurrence, dtype=float)
+    n_b = np.diag(k).copy()
+    p_hat = (k + alpha) / (n_b[np.newaxis, :] + alpha + beta)
+    unsupported = (n_b[np.newaxis, :] == 0) | (n_b[np.newaxis, :] < n_min) | (k < k_min)
+    p_hat[unsupported] = np.nan
+    return p_hat, n_b
+
+
+def cpt_arrays_to_df(cpt_array, trust_array, value_ids):
+    """ wraps CPT and trust arrays into the DataFrames used across DIG4EL (string labels)."""
+    labels = [str(v) for v in value_ids]
+    cpt = pd.DataFrame(cpt_array, index=labels, columns=labels)
+    cpt_trust = pd.DataFrame(trust_array, index=labels, columns=labels)
+    return cpt, cpt_trust
+
+
+class CooccurrenceCounts:
+    """ keeps the incidence matrix and the co-occurrence counts computed over all languages.
+    Counts over any subset of languages are derived from these global counts by subtracting
+    the contribution of the languages left out, so that leave-one-out (or leave-family-out)
+    CPTs do not require a new full computation."""
+    def __init__(self, values_by_language, language_ids, value_ids):
+        self.language_ids = [str(lid) for lid in language_ids]
+        self.value_ids = [str(v) for v in value_ids]
+        self.language_index = {lid: i for i, lid in enumerate(self.language_ids)}
+        self.incidence = build_incidence_matrix(values_by_language, self.language_ids, self.value_ids)
+        self.cooccurrence = compute_cooccurrence_counts(self.incidence)
+
+    def get_language_rows(self, language_ids):
+        """ row indices of the known languages among language_ids, unknown languages are ignored."""
+        return sorted(set(self.language_index[str(lid)] for lid in language_ids if str(lid) in self.language_index))
+
+    def counts_excluding(self, language_ids):
+        """ co-occurrence counts over all languages except language_ids. """
+        rows = self.get_language_rows(language_ids or [])
+        if not rows:
+            return self.cooccurrence
+        return self.cooccurrence - compute_cooccurrence_counts(self.incidence[rows])
+
+    def counts_for(self, language_ids):
+        """ co-occurrence counts over language_ids only.
+        Small subsets are counted directly, large ones by subtracting their complement."""
+        rows = self.get_language_rows(language_ids or [])
+        if 2 * len(rows) <= len(self.language_ids):
+            return compute_cooccurrence_counts(self.incidence[rows])
+        complement = sorted(set(range(len(self.language_ids))) - set(rows))
+        if not complement:
+            return self.cooccurrence
+        return self.cooccurrence - compute_cooccurrence_counts(self.incidence[complement])
+
+
+# ================ BINARY CPT STORAGE ====================================================
+# A CPT stored in binary format is a folder (same name as the JSON CPT, with a .cpt extension) containing
+#   values.npy   float32 |V| x |V| matrix, NaN where the CPT is undefined
+#   trust.npy    optional float32 trust matrix (co-occurrence counts), NaN where undefined
+#   labels.json  {"index": [row labels], "columns": [column labels]}
+# values.npy is memory-mapped read-only: all the processes loading it share one copy through the OS page cache,
+# and modules loading the same CPT in one process share the same DataFrame.
+# A binary version older than its JSON CPT is ignored: the JSON CPT was rebuilt after the conversion.
+
+# CPTs already loaded in this process, by absolute path of the JSON CPT
+loaded_cpts = {}
+
+
+def get_binary_cpt_path(json_path):
+    return os.path.splitext(str(json_path))[0] + ".cpt"
+
+
+def get_current_binary_cpt_path(json_path):
+    """ binary version of the CPT stored at json_path, None if there is none or if the JSON CPT was
+    modified after its conversion (the binary version is then stale and ignored until converted again). """
+    binary_values = os.path.join(get_binary_cpt_path(json_path), "values.npy")
+    if not os.path.isfile(binary_values):
+        return None
+    if os.path.isfile(str(json_path)) and os.path.getmtime(str(json_path)) > os.path.getmtime(binary_values):
+        print("CPT: {} is older than {}, ignored (see convert_json_cpt_to_binary).".format(
+            get_binary_cpt_path(json_path), json_path))
+        return None
+    return get_binary_cpt_path(json_path)
+
+
+def save_cpt_binary(cpt, folder, cpt_trust=None):
+    os.makedirs(folder, exist_ok=True)
+    np.save(os.path.join(folder, "values.npy"), cpt.to_numpy(dtype=np.float32, na_value=np.nan))
+    if cpt_trust is not None:
+        cpt_trust = cpt_trust.reindex(index=cpt.index, columns=cpt.columns)
+        np.save(os.path.join(folder, "trust.npy"), cpt_trust.to_numpy(dtype=np.float32, na_value=np.nan))
+    with open(os.path.join(folder, "labels.json"), "w", encoding='utf-8') as f:
+        json.dump({"index": [str(i) for i in cpt.index],
+                   "columns": [str(c) for c in cpt.columns]}, f, ensure_ascii=False)
+
+
+def load_cpt_binary(folder, trust=False):
+    """ returns the CPT stored in folder as a DataFrame backed by a read-only memory map.
+    With trust=True, returns the trust matrix instead (None if not stored)."""
+    with open(os.path.join(folder, "labels.json"), "r", encoding='utf-8') as f:
+        labels = json.load(f)
+    filename = "trust.npy" if trust else "values.npy"
+    if not os.path.isfile(os.path.join(folder, filename)):
+        return None
+    values = np.load(os.path.join(folder, filename), mmap_mode="r")
+    return pd.DataFrame(values, index=labels["index"], columns=labels["columns"], copy=False)
+
+
+def convert_json_cpt_to_binary(json_path, trust_json_path=None):
+    """ converts a CPT stored by pandas.to_json (and optionally its trust matrix) to the binary format. """
+    cpt = pd.read_json(json_path)
+    cpt.index = cpt.index.astype(str)
+    cpt.columns = cpt.columns.astype(str)
+    cpt_trust = None
+    if trust_json_path is not None and os.path.isfile(trust_json_path):
+        cpt_trust = pd.read_json(trust_json_path)
+        cpt_trust.index = cpt_trust.index.astype(str)
+        cpt_trust.columns = cpt_trust.columns.astype(str)
+    folder = get_binary_cpt_path(json_path)
+    save_cpt_binary(cpt, folder, cpt_trust=cpt_trust)
+    print("Converted {} to {}".format(json_path, folder))
+    return folder
+
+
+def convert_default_cpts_to_binary(external_data_path=None):
+    """ converts the CPTs loaded by wals_utils and grambank_utils (default: the external_data folder of the data registries). """
+    if external_data_path is None:
+        external_data_path = resolve_data_root("external_data")
+    cpt_files = [
+        ("wals_derived/de_conditional_probability_df.json", "wals_derived/de_conditional_probability_trust.json"),
+        ("grambank_derived/grambank_vid_conditional_probability.json", "grambank_derived/grambank_vid_conditional_probability_trust.json"),
+    ]
+    for cpt_file, trust_file in cpt_files:
+        json_path = os.path.join(external_data_path, cpt_file)
+        if os.path.isfile(json_path):
+            convert_json_cpt_to_binary(json_path,
+                                       os.path.join(external_data_path, trust_file) if trust_file else None)
+        else:
+            print("convert_default_cpts_to_binary: {} not found".format(json_path))
+
+
+def load_cpt(json_path):
+    """ loads a CPT once per process, with string labels.
+    The binary version is memory-mapped when available and not older than the JSON file,
+    otherwise the JSON file is parsed. Raises FileNotFoundError if neither exists."""
+    key = os.path.abspath(str(json_path))
+    if key not in loaded_cpts:
+        binary_path = get_current_binary_cpt_path(json_path)
+        if binary_path is not None:
+            cpt = load_cpt_binary(binary_path)
+        else:
+            cpt = pd.read_json(json_path)
+            cpt.index = cpt.index.astype(str)
+            cpt.columns = cpt.columns.astype(str)
+        register_cpt(cpt, key)
+        loaded_cpts[key] = cpt
+    return loaded_cpts[key]
+
+
+def get_cpt_file_id(json_path):
+    """ id of the CPT stored at json_path (or in its binary version), with its modification time:
+    the id changes when the CPT is rebuilt. None if the CPT is not stored. """
+    binary_path = get_current_binary_cpt_path(json_path)
+    binary_values = os.path.join(binary_path, "values.npy") if binary_path is not None else None
+    for path in [binary_values, str(json_path)]:
+        if path is not None and os.path.isfile(path):
+            return "{}@{}".format(os.path.abspath(path), os.path.getmtime(path))
+    return None
+
+
+# ================ SPARSE CPT ============================================================
+# CPTs between datasets (e.g. WALS values given Grambank values) are mostly unsupported.
+# A SparseCPT only stores supported cells (explicit zeros included), unsupported cells read as NaN.
+# On disk: a folder with values.npz (scipy CSR matrix) and labels.json {"index": [...], "columns": [...]}.
+
+def compute_sparse_conditional_probabilities(cooccurrence, n_b, n_min, k_min, alpha, beta):
+    """ sparse version of compute_conditional_probability_arrays for a rectangular count matrix K[a, b]
+    and the vector n_b of column value counts. Only cells with k_A∧B >= max(k_min, 1) and n_B >= max(n_min, 1)
+    are stored, with p_hat = (k_A∧B + alpha) / (n_B + alpha + beta)."""
+    k = sparse.coo_matrix(cooccurrence)
+    n_b = np.asarray(n_b, dtype=float).ravel()
+    supported = (k.data >= max(k_min, 1)) & (n_b[k.col] >= max(n_min, 1))
+    rows, cols, counts = k.row[supported], k.col[supported], k.data[supported].astype(float)
+    p_hat = (counts + alpha) / (n_b[cols] + alpha + beta)
+    return sparse.csr_matrix((p_hat, (rows, cols)), shape=k.shape)
+
+
+class SparseCPT:
+    """ CPT storing only its supported cells, see above."""
+    def __init__(self, matrix, index, columns, cpt_id=None):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.index = [str(label) for label in index]
+        self.columns = [str(label) for label in columns]
+        self.row_index = {label: i for i, label in enumerate(self.index)}
+        self.column_index = {label: j for j, label in enumerate(self.columns)}
+        if cpt_id is not None:
+            register_cpt(self, cpt_id)
+
+    def get_block(self, row_labels, column_labels):
+        """ dense block for the given labels, NaN on unsupported cells. Raises KeyError on unknown labels."""
+        rows = [self.row_index[str(label)] for label in row_labels]
+        block_columns = {self.column_index[str(label)]: j for j, label in enumerate(column_labels)}
+        block = np.full((len(rows), len(block_columns)), np.nan)
+        for i, row in enumerate(rows):
+            start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+            for col, value in zip(self.matrix.indices[start:end], self.matrix.data[start:end]):
+                if col in block_columns:
+                    block[i, block_columns[col]] = value
+        return block
+
+    def to_df(self):
+        """ dense DataFrame, NaN on unsupported cells."""
+        return pd.DataFrame(self.get_block(self.index, self.columns), index=self.index, columns=self.columns)
+
+
+def save_sparse_cpt(sparse_cpt, folder):
+    os.makedirs(folder, exist_ok=True)
+    sparse.save_npz(os.path.join(folder, "values.npz"), sparse_cpt.matrix)
+    with open(os.path.join(folder, "labels.json"), "w", encoding='utf-8') as f:
+        json.dump({"index": sparse_cpt.index, "columns": sparse_cpt.columns}, f, ensure_ascii=False)
+
+
+def get_sparse_cpt_id(folder):
+    # the modification time is part of the id, so that normalized blocks of a rebuilt CPT are not reused
+    return "{}@{}".format(os.path.abspath(folder), os.path.getmtime(os.path.join(folder, "values.npz")))
+
+
+def load_sparse_cpt(folder):
+    with open(os.path.join(folder, "labels.json"), "r", encoding='utf-8') as f:
+        labels = json.load(f)
+    return SparseCPT(sparse.load_npz(os.path.join(folder, "values.npz")), labels["index"], labels["columns"],
+                     cpt_id=get_sparse_cpt_id(folder))
+
+
+# ================ NORMALIZED BLOCK CACHE ================================================
+# Agents use, for each pair of parameters (Pi, Pj), the CPT block of Pj values (rows) given Pi values (columns),
+# each column normalized to sum to 1. Blocks are computed once per process and kept as small read-only arrays
+# with their labels, keyed by (CPT id, pi, pj): creating an agent again only wraps cached arrays into DataFrames.
+# CPT ids belong to CPT objects (by id()), not to their content: a CPT derived from another one (copy, reindex,
+# arithmetic...) is a new object with its own id. When a CPT object is garbage collected its id is forgotten,
+# and its cached blocks are dropped unless another live CPT has the same id.
+
+MAX_CACHED_BLOCKS = 100000
+normalized_blocks = OrderedDict()
+block_keys_by_cpt_id = {}
+cpt_ids = {}
+anonymous_cpt_ids = itertools.count()
+
+
+def register_cpt(cpt, cpt_id):
+    """ gives the CPT object cpt (DataFrame or SparseCPT) a stable id in the block cache:
+    its path, language set hash... CPTs with the same id share their cached blocks."""
+    key = id(cpt)
+    if key not in cpt_ids:
+        weakref.finalize(cpt, forget_cpt, key)
+    cpt_ids[key] = cpt_id
+    return cpt_id
+
+
+def get_cpt_id(cpt):
+    """ id of a CPT object in the block cache: given by register_cpt (CPTs loaded or computed by cpt_utils),
+    otherwise an anonymous id given on first use."""
+    key = id(cpt)
+    if key not in cpt_ids:
+        register_cpt(cpt, "cpt:{}".format(next(anonymous_cpt_ids)))
+    return cpt_ids[key]
+
+
+def forget_cpt(key):
+    cpt_id = cpt_ids.pop(key, None)
+    if cpt_id is not None and cpt_id not in cpt_ids.values():
+        for block_key in block_keys_by_cpt_id.pop(cpt_id, ()):
+            normalized_blocks.pop(block_key, None)
+
+
+def drop_cached_block(block_key):
+    normalized_blocks.pop(block_key, None)
+    keys = block_keys_by_cpt_id.get(block_key[0], None)
+    if keys is not None:
+        keys.discard(block_key)
+        if not keys:
+            del block_keys_by_cpt_id[block_key[0]]
+
+
+def normalize_columns(block):
+    """ normalizes each column of block to sum to 1, ignoring NaN, like utils.normalize_column.
+    Columns summing to 0 get a uniform distribution."""
+    sums = np.nansum(block, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normalized = block / sums[np.newaxis, :]
+    normalized[:, sums == 0] = 1 / block.shape[0]
+    return normalized
+
+
+def get_normalized_block(cpt, row_labels, column_labels, pi, pj):
+    """ returns (normalized block, max of the raw block, row labels, column labels) for the rows and columns
+    of cpt (DataFrame or SparseCPT), cached by (CPT id, pi, pj). Raises KeyError if labels are missing from the CPT."""
+    key = (get_cpt_id(cpt), pi, pj)
+    if key in normalized_blocks:
+        normalized_blocks.move_to_end(key)
+        return normalized_blocks[key]
+    if isinstance(cpt, SparseCPT):
+        block = cpt.get_block(row_labels, column_labels)
+    else:
+        block = cpt.loc[list(row_labels), list(column_labels)].to_numpy(dtype=float)
+    normalized = normalize_columns(block)
+    normalized.flags.writeable = False
+    raw_max = np.nanmax(block) if block.size and not np.all(np.isnan(block)) else np.nan
+    entry = (normalized, raw_max, tuple(row_labels), tuple(column_labels))
+    normalized_blocks[key] = entry
+    block_keys_by_cpt_id.setdefault(key[0], set()).add(key)
+    while len(normalized_blocks) > MAX_CACHED_BLOCKS:
+        drop_cached_block(next(iter(normalized_blocks)))
+    return entry
+
+
+def normalized_block_to_df(entry):
+    normalized, _, row_labels, column_labels = entry
+    return pd.DataFrame(normalized, index=list(row_labels), columns=list(column_labels), copy=False)
+
+
+# ================ PAIRWISE POTENTIAL STORE ==============================================
+# MRF potentials between two parameters P1 and P2 are built from two CPT blocks:
+#   A = CPT[P1 values, P2 values] and B = CPT[P2 values, P1 values], each normalized row by row,
+#   potential(P1, P2) = sqrt(A * B.T)
+# Computed for all parameter pairs at once, they form one symmetric |V| x |V| matrix where values are grouped
+# by parameter. The store keeps that matrix in a single array file (potentials.npy, memory-mapped) and an index
+# (index.json) giving, for each parameter, the offset of its block and its value labels:
+# the potential of a pair of parameters is a slice of the matrix.
+
+def normalize_rows_by_block(values, block_sizes):
+    """ normalizes each row of values within each column block, ignoring NaN.
+    Rows of a block summing to 0 get a uniform distribution over the block."""
+    values = np.asarray(values, dtype=float)
+    starts = np.concatenate([[0], np.cumsum(block_sizes)[:-1]]).astype(int)
+    block_sums = np.add.reduceat(np.nan_to_num(values, nan=0.0), starts, axis=1)
+    sizes = np.repeat(np.asarray(block_sizes), block_sizes)
+    sums = np.repeat(block_sums, block_sizes, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normalized = values / sums
+    uniform = np.broadcast_to(1.0 / sizes, values.shape)
+    return np.where(sums == 0, uniform, normalized)
+
+
+def compute_block_potentials(cpt, value_blocks):
+    """ potential matrix for all pairs of parameters, value_blocks is the list of value label lists of each parameter."""
+    labels = [str(v) for block in value_blocks for v in block]
+    values = cpt.reindex(index=labels, columns=labels).to_numpy(dtype=float)
+    normalized = normalize_rows_by_block(values, [len(block) for block in value_blocks])
+    return np.sqrt(normalized * normalized.T)
+
+
+class PotentialStore:
+    """ pairwise potentials between parameters, stored in folder (see above)."""
+    def __init__(self, folder):
+        with open(os.path.join(folder, "index.json"), "r", encoding='utf-8') as f:
+            index = json.load(f)
+        self.offsets = {p: block["offset"] for p, block in index["blocks"].items()}
+        self.labels = {p: block["values"] for p, block in index["blocks"].items()}
+        self.cpt_id = index.get("cpt_id", None)
+        self.potentials = np.load(os.path.join(folder, "potentials.npy"), mmap_mode="r")
+        # id of the stored potentials, changes when the store is built again
+        self.potential_id = "{}@{}".format(os.path.abspath(folder), os.path.getmtime(os.path.join(folder, "potentials.npy")))
+
+    def has_parameter(self, parameter):
+        return str(parameter) in self.offsets
+
+    def get_potential_array(self, p1, p2):
+        o1 = self.offsets[str(p1)]
+        o2 = self.offsets[str(p2)]
+        return self.potentials[o1:o1 + len(self.labels[str(p1)]), o2:o2 + len(self.labels[str(p2)])]
+
+    def get_potential(self, p1, p2):
+        """ potential between p1 (rows) and p2 (columns) as a DataFrame, None if a parameter is not stored."""
+        if not (self.has_parameter(p1) and self.has_parameter(p2)):
+            return None
+        return pd.DataFrame(np.asarray(self.get_potential_array(p1, p2), dtype=float),
+                            index=self.labels[str(p1)], columns=self.labels[str(p2)])
+
+
+def build_potential_store(cpt, value_blocks_by_parameter, folder, cpt_id=None):
+    """ computes the potentials of all pairs of parameters in one pass and stores them in folder.
+    value_blocks_by_parameter is a dict {parameter: [value labels]}, parameters with values missing from the CPT are skipped.
+    cpt_id (e.g. get_cpt_file_id of the CPT file) is stored in the index, to detect potentials built from another CPT."""
+    cpt_labels = set(str(v) for v in cpt.index) & set(str(v) for v in cpt.columns)
+    blocks = {}
+    offset = 0
+    for parameter, values in value_blocks_by_parameter.items():
+        values = [str(v) for v in values]
+        if values and all(v in cpt_labels for v in values):
+            blocks[str(parameter)] = {"offset": offset, "values": values}
+            offset += len(values)
+    potentials = compute_block_potentials(cpt, [block["values"] for block in blocks.values()])
+    os.makedirs(folder, exist_ok=True)
+    np.save(os.path.join(folder, "potentials.npy"), potentials.astype(np.float32))
+    with open(os.path.join(folder, "index.json"), "w", encoding='utf-8') as f:
+        json.dump({"cpt_id": cpt_id, "blocks": blocks}, f, ensure_ascii=False)
+    return PotentialStore(folder)
+
+
+# ================ CPT PROVIDER ==========================================================
+
+# suffix of the CPT folders of a CPTProvider cache_folder. Changed with the language set hash encoding:
+# folders stored under a former hash are not reused.
+CPT_CACHE_FOLDER_SUFFIX = ".languages.cpt"
+
+
+def get_language_set_hash(language_ids):
+    """ hash of a set of languages. The sorted ids are separated ('1','12' and '11','2' are different sets)."""
+    encoded = json.dumps(sorted(set(str(lid) for lid in language_ids)))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+class CPTProvider:
+    """ returns the CPT (and trust matrix) over any set of languages, computed on demand
+    from global co-occurrence counts (see CooccurrenceCounts).
+    The last max_cached CPTs are kept in memory (least recently used are dropped first).
+    With a cache_folder, CPTs are also stored there in binary format, by language set hash,
+    and memory-mapped when requested again, including by other processes.
+    estimate is a function (cooccurrence, value_ids) -> (cpt, cpt_trust) applying the dataset's estimation rules."""
+    def __init__(self, name, counts, estimate, max_cached=8, cache_folder=None):
+        self.name = name
+        self.counts = counts
+        self.estimate = estimate
+        self.max_cached = max_cached
+        self.cache_folder = cache_folder
+        self.cached_cpts = OrderedDict()
+
+    def get_cpt(self, language_ids=None):
+        """ returns (cpt, cpt_trust) over language_ids, all languages if None."""
+        if language_ids is None:
+            language_ids = self.counts.language_ids
+        filter_hash = get_language_set_hash(language_ids)
+        if filter_hash in self.cached_cpts:
+            self.cached_cpts.move_to_end(filter_hash)
+            return self.cached_cpts[filter_hash]
+        cpt_folder = os.path.join(self.cache_folder, filter_hash + CPT_CACHE_FOLDER_SUFFIX) if self.cache_folder else None
+        if cpt_folder is not None and os.path.isdir(cpt_folder):
+            cpt = load_cpt_binary(cpt_folder)
+            cpt_trust = load_cpt_binary(cpt_folder, trust=True)
+        else:
+            cpt, cpt_trust = self.estimate(self.counts.counts_for(language_ids), self.counts.value_ids)
+            if cpt_folder is not None:
+                save_cpt_binary(cpt, cpt_folder, cpt_trust=cpt_trust)
+        register_cpt(cpt, "{}:{}".format(self.name, filter_hash))
+        self.cached_cpts[filter_hash] = (cpt, cpt_trust)
+        while len(self.cached_cpts) > self.max_cached:
+            self.cached_cpts.popitem(last=False)
+        return cpt, cpt_trust
+
+    def get_defined_share(self, language_ids=None):
+        """ share of the defined (non-NaN) cells of the CPT over language_ids, all languages if None."""
+        values = self.get_cpt(language_ids)[0].to_numpy(dtype=float)
+        return np.count_nonzero(~np.isnan(values)) / values.size if values.size else 0.0
+
+    def get_supported_cpt(self, language_ids, n_min, min_coverage):
+        """ returns (cpt, cpt_trust) over language_ids, or None when language_ids are too few to estimate it:
+        fewer than n_min known languages (values seen in fewer than n_min languages are NaN anyway),
+        or fewer defined cells than min_coverage times those of the CPT over all languages."""
+        n_languages = len(self.counts.get_language_rows(language_ids))
+        if n_languages < n_min:
+            print("{} CPT: {} languages, fewer than {}.".format(self.name, n_languages, n_min))
+            return None
+        coverage = self.get_defined_share(language_ids)
+        reference = self.get_defined_share()
+        if reference == 0 or coverage < min_coverage * reference:
+            print("{} CPT: {:.2%} of cells defined over {} languages, {:.2%} over all languages.".format(
+                self.name, coverage, n_languages, reference))
+            return None
+        return self.get_cpt(language_ids)
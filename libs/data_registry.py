@@ -0,0 +1,83 @@
+# Copyright (C) 2024 Sebastien CHRISTIAN, University of French Polynesia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+
+
+def resolve_data_root(relative_folder, prefixes=("./", "../")):
+    """ returns the path to relative_folder from the first prefix where it exists.
+    Pages run from the repository root (./), scripts from a subfolder (../)."""
+    for prefix in prefixes:
+        path = os.path.join(prefix, relative_folder)
+        if os.path.isdir(path):
+            return path
+    return os.path.join(prefixes[-1], relative_folder)
+
+
+class LazyDataRegistry:
+    """ Lookup tables loaded on first attribute access.
+    tables maps each attribute name either to a JSON filename in the data folder,
+    or to a function taking the registry and returning the table (derived tables, CPTs...).
+    The data folder is resolved once, on first access."""
+    def __init__(self, relative_folder, tables):
+        self._relative_folder = relative_folder
+        self._tables = dict(tables)
+        self._root = None
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = resolve_data_root(self._relative_folder)
+        return self._root
+
+    def path(self, filename):
+        return os.path.join(self.root, filename)
+
+    def has_table(self, name):
+        return name in self._tables
+
+    def is_loaded(self, name):
+        return name in self.__dict__
+
+    def unload(self, name):
+        """ drops a loaded table, it is loaded again on next access."""
+        self.__dict__.pop(name, None)
+
+    def get_file_ids(self):
+        """ {table name: "path@mtime"} of the existing JSON files of the tables, the id of a file changes when it is rebuilt."""
+        file_ids = {}
+        for name, source in self._tables.items():
+            if not callable(source) and os.path.isfile(self.path(source)):
+                file_ids[name] = "{}@{}".format(os.path.abspath(self.path(source)), os.path.getmtime(self.path(source)))
+        return file_ids
+
+    def load_all(self):
+        for name in self._tables:
+            getattr(self, name)
+
+    def __getattr__(self, name):
+        # only called for tables not loaded yet: loaded tables are regular instance attributes
+        tables = self.__dict__.get("_tables", {})
+        if name not in tables:
+            raise AttributeError("{} is not a known data table".format(name))
+        source = tables[name]
+        if callable(source):
+            value = source(self)
+        else:
+            with open(self.path(source), encoding='utf-8') as f:
+                value = json.load(f)
+        self.__dict__[name] = value
+        return value
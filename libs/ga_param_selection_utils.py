@@ -12,10 +12,16 @@ Legend of symbols used in the comments
 
 import json
 import math
+import os
+import hashlib
+import shutil
 from pathlib import Path
 from typing import Dict, Tuple, List, Set
 
-import networkx as nx
+import numpy as np
+from scipy import sparse
+
+from libs import cpt_utils as cu
 
 ###############################################################################
 # 1.  Loading CPTs → weighted directed graph
@@ -53,25 +59,161 @@ def load_cpt(path: Path) -> Dict[Tuple[str, str], float]:
     return edges
 
 
-def load_all_cpts(base_dir: Path) -> nx.DiGraph:
-    """Return a DiGraph whose edges carry the CPT probabilities as weights."""
-    filenames = [
-        "wals_derived/de_conditional_probability_df.json",          # WALS → WALS
-        "grambank_derived/grambank_vid_conditional_probability.json",   # GB   → GB
-        "grambank_given_wals_cpt.json",                # WALS → GB
-        "wals_given_grambank_cpt.json",                # GB   → WALS
-    ]
+CPT_FILENAMES = [
+    "wals_derived/de_conditional_probability_df.json",          # WALS → WALS
+    "grambank_derived/grambank_vid_conditional_probability.json",   # GB   → GB
+    "grambank_given_wals_cpt.json",                # WALS → GB
+    "wals_given_grambank_cpt.json",                # GB   → WALS
+]
+
+# CSR graphs built from the CPTs are cached in this folder of base_dir, by hash of the CPT file ids
+GRAPH_CACHE_FOLDER = "param_selection_graph"
+
+
+class ValueGraph:
+    """Directed graph over value ids stored as compressed sparse rows.
+
+    forward[s, t] = P(t | s) for every edge s → t, reverse is its transpose
+    (row c lists the predecessors of c). Edge weights of 0 are kept as explicit entries.
+    Supports the networkx calls of the pages: G.nodes, G[u].items(), number_of_nodes(), number_of_edges().
+    """
+
+    def __init__(self, nodes: List[str], forward: sparse.csr_matrix):
+        self.nodes = list(nodes)
+        self.node_index = {v: i for i, v in enumerate(self.nodes)}
+        self.forward = forward
+        self.reverse = forward.T.tocsr()
+        # boolean CSR of the edges with weight ≥ θ_CP, by θ_CP (see expand_frontier)
+        self.strong_edges = {}
+
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+    def number_of_edges(self) -> int:
+        return int(self.forward.nnz)
+
+    def __contains__(self, v: str) -> bool:
+        return v in self.node_index
+
+    def __getitem__(self, u: str) -> Dict[str, Dict[str, float]]:
+        """Successors of u with their edge attributes, as G[u] in networkx."""
+        i = self.node_index[u]
+        start, end = self.forward.indptr[i], self.forward.indptr[i + 1]
+        return {self.nodes[j]: {"weight": float(w)}
+                for j, w in zip(self.forward.indices[start:end], self.forward.data[start:end])}
+
+    def successors(self, u: str) -> List[str]:
+        return list(self[u].keys())
+
+    def predecessors(self, c: str) -> List[str]:
+        i = self.node_index[c]
+        return [self.nodes[j] for j in self.reverse.indices[self.reverse.indptr[i]:self.reverse.indptr[i + 1]]]
+
+    def indexes(self, values) -> np.ndarray:
+        """Node indexes of the values in the graph (others are ignored)."""
+        return np.array([self.node_index[v] for v in values if v in self.node_index], dtype=np.int64)
+
+    def get_strong_edges(self, θ_CP: float) -> sparse.csr_matrix:
+        if θ_CP not in self.strong_edges:
+            strong = self.forward.copy()
+            strong.data = strong.data >= θ_CP
+            strong.eliminate_zeros()
+            self.strong_edges[θ_CP] = strong
+        return self.strong_edges[θ_CP]
 
-    G = nx.DiGraph()
-    for fname in filenames:
+
+def cpt_edges(cpt) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(source labels, target labels, P(target | source)) of the non‑NaN cells of a CPT DataFrame
+    (rows = targets, columns = given sources), without the diagonal and blank ids."""
+    values = cpt.to_numpy(dtype=float)
+    targets = np.asarray(cpt.index, dtype=str)
+    sources = np.asarray(cpt.columns, dtype=str)
+    t, s = np.nonzero(~np.isnan(values))
+    keep = (targets[t] != sources[s]) & (targets[t] != "") & (sources[s] != "")
+    t, s = t[keep], s[keep]
+    return sources[s], targets[t], values[t, s]
+
+
+def build_value_graph(paths: List[Path]) -> ValueGraph:
+    """Graph of the edges of all the CPTs; an edge found in several CPTs keeps the weight of the last one."""
+    sources, targets, weights = [], [], []
+    for path in paths:
+        s, t, w = cpt_edges(cu.load_cpt(path))
+        sources.append(s)
+        targets.append(t)
+        weights.append(w)
+    sources = np.concatenate(sources) if sources else np.zeros(0, dtype=str)
+    targets = np.concatenate(targets) if targets else np.zeros(0, dtype=str)
+    weights = np.concatenate(weights) if weights else np.zeros(0)
+    nodes, node_ids = np.unique(np.concatenate([sources, targets]), return_inverse=True)
+    rows, columns = node_ids[:len(sources)], node_ids[len(sources):]
+    # keep the last occurrence of each (source, target) pair
+    keys = rows.astype(np.int64) * len(nodes) + columns
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    forward = sparse.csr_matrix((weights[last], (rows[last], columns[last])), shape=(len(nodes), len(nodes)))
+    forward.sort_indices()
+    return ValueGraph(nodes.tolist(), forward)
+
+
+def save_value_graph(G: ValueGraph, folder: Path):
+    """Stores the CSR arrays as .npy files and the node ids as JSON, like the binary CPTs of cpt_utils."""
+    os.makedirs(folder, exist_ok=True)
+    for name in ["data", "indices", "indptr"]:
+        np.save(os.path.join(folder, name + ".npy"), getattr(G.forward, name))
+    with open(os.path.join(folder, "nodes.json"), "w", encoding="utf-8") as fp:
+        json.dump(G.nodes, fp, ensure_ascii=False)
+
+
+def load_value_graph(folder: Path, mmap: bool = True) -> ValueGraph:
+    """ValueGraph stored by save_value_graph; with mmap the forward CSR arrays are read‑only memory maps."""
+    with open(os.path.join(folder, "nodes.json"), "r", encoding="utf-8") as fp:
+        nodes = json.load(fp)
+    data, indices, indptr = [np.load(os.path.join(folder, name + ".npy"), mmap_mode="r" if mmap else None)
+                             for name in ["data", "indices", "indptr"]]
+    forward = sparse.csr_matrix((data, indices, indptr), shape=(len(nodes), len(nodes)), copy=False)
+    return ValueGraph(nodes, forward)
+
+
+def load_all_cpts(base_dir: Path, use_cache: bool = True) -> ValueGraph:
+    """Return a ValueGraph whose edges carry the CPT probabilities as weights.
+    With use_cache, the graph is stored in base_dir/param_selection_graph and memory‑mapped on next loads."""
+    paths = []
+    for fname in CPT_FILENAMES:
         path = base_dir / fname
-        if not path.exists():
+        if not path.exists() and not os.path.isdir(cu.get_binary_cpt_path(path)):
             print(f"[WARN] missing CPT: {path}")
             continue
-        for (src, tgt), p in load_cpt(path).items():
-            G.add_edge(src, tgt, weight=p)
+        paths.append(path)
+    if not use_cache:
+        return build_value_graph(paths)
+
+    # CPT file ids include their modification time: a rebuilt CPT gives a new cache entry
+    cache_key = hashlib.sha256(json.dumps([cu.get_cpt_file_id(path) for path in paths]).encode()).hexdigest()
+    cache_folder = base_dir / GRAPH_CACHE_FOLDER / cache_key
+    if (cache_folder / "nodes.json").exists():
+        return load_value_graph(cache_folder)
+    G = build_value_graph(paths)
+    # written under a temporary name first, sessions loading the graph never read a partial folder
+    temporary_folder = Path(f"{cache_folder}.{os.getpid()}.tmp")
+    save_value_graph(G, temporary_folder)
+    try:
+        os.replace(temporary_folder, cache_folder)
+    except OSError:
+        # another session stored it meanwhile
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+        return G
+    remove_stale_value_graphs(base_dir / GRAPH_CACHE_FOLDER, keep=cache_key)
     return G
 
+
+def remove_stale_value_graphs(graph_cache_folder: Path, keep: str):
+    """Removes the cached graphs of former CPT versions, only the graph keyed by keep is used.
+    Temporary folders of sessions still writing a graph are left alone."""
+    for entry in os.listdir(graph_cache_folder):
+        if entry != keep and not entry.endswith(".tmp"):
+            shutil.rmtree(graph_cache_folder / entry, ignore_errors=True)
+
 ###############################################################################
 # 2.  Belief vector  b_v   (priors → observations → known values)
 ###############################################################################
@@ -79,9 +221,34 @@ def load_all_cpts(base_dir: Path) -> nx.DiGraph:
 class BeliefState:
     """Holds the current subjective probability for every value id."""
 
-    def __init__(self, priors: Dict[str, float]):
+    def __init__(self, priors: Dict[str, float], parameter_by_value: Dict[str, str] = None):
         # Vector  b  over all vertices; starts with family priors.
         self.belief = priors.copy()
+        # value → parameter index used by set_known. Without mapping, the parameter of a value is
+        # the part of its id before "-" (GB###‑x), plain WALS numbers being their own parameter.
+        self.parameter_by_value = dict(parameter_by_value) if parameter_by_value is not None else {}
+        self.values_by_parameter: Dict[str, List[str]] = {}
+        for vid in self.belief:
+            self._index_value(vid)
+        # ids of the values whose belief changed, in order, read by the suggesters (see ParameterSuggester)
+        self.changes: List[str] = []
+        self.suggesters = {}
+
+    def parameter_of(self, value_id: str) -> str:
+        if value_id not in self.parameter_by_value:
+            self.parameter_by_value[value_id] = value_id.split("-")[0]
+        return self.parameter_by_value[value_id]
+
+    def _index_value(self, value_id: str):
+        self.values_by_parameter.setdefault(self.parameter_of(value_id), []).append(value_id)
+
+    def _set(self, value_id: str, p: float):
+        if value_id not in self.belief:
+            self._index_value(value_id)
+        elif self.belief[value_id] == p:
+            return
+        self.belief[value_id] = p
+        self.changes.append(value_id)
 
     # ────────────────────────────────────────────────────────────────────
     # Bayesian update hooks: observation vs. known
@@ -89,14 +256,12 @@ class BeliefState:
 
     def update_observation(self, value_id: str, p: float):
         """Soft evidence: 0 < p < 1."""
-        self.belief[value_id] = p
+        self._set(value_id, p)
 
     def set_known(self, value_id: str):
         """Hard evidence: probability 1 for the chosen value, 0 for its siblings."""
-        param = value_id.split("-")[0]  # works for GB###‑x and plain WALS numbers
-        for vid in list(self.belief.keys()):
-            if vid.split("-")[0] == param:
-                self.belief[vid] = 1.0 if vid == value_id else 0.0
+        for vid in self.values_by_parameter.get(self.parameter_of(value_id), []):
+            self._set(vid, 1.0 if vid == value_id else 0.0)
 
     # Convenience --------------------------------------------------------
 
@@ -109,58 +274,139 @@ class BeliefState:
 ###############################################################################
 
 
+def expand_frontier_indexes(
+    G: ValueGraph,
+    seed_idx: np.ndarray,
+    θ_CP: float = 0.3,
+    d: int = 2,
+) -> np.ndarray:
+    """Boolean mask of the nodes reached from the seed node indexes, seeds included (see expand_frontier).
+    Each step is one row slice of the thresholded CSR adjacency."""
+    strong_edges = G.get_strong_edges(θ_CP)
+    reached = np.zeros(G.number_of_nodes(), dtype=bool)
+    frontier = np.asarray(seed_idx, dtype=np.int64)
+    reached[frontier] = True
+    for _ in range(d):
+        print("**** frontier size: {}".format(len(frontier)))
+        nxt = np.unique(strong_edges[frontier].indices)
+        nxt = nxt[~reached[nxt]]
+        if not len(nxt):
+            break
+        reached[nxt] = True
+        frontier = nxt
+    return reached
+
+
 def expand_frontier(
-    G: nx.DiGraph,
+    G: ValueGraph,
     seeds: Set[str],
     θ_CP: float = 0.3, # floor on edge weights kept during frontier expansion.
     d: int = 2, # BFS depth limit
 ) -> Set[str]:
     """Breadth‑first out to depth *d*, keeping only edges with weight ≥ θ_CP."""
-    frontier = set(seeds)
-    reached = set(seeds)
-    for _ in range(d):
-        print("**** frontier size: {}".format(len(frontier)))
-        nxt = {
-            v
-            for u in frontier
-            for v, attrs in G[u].items()
-            if attrs["weight"] >= θ_CP and v not in reached
-        }
-        if not nxt:
-            break
-        reached.update(nxt)
-        frontier = nxt
+    reached = expand_frontier_indexes(G, G.indexes(seeds), θ_CP, d)
     # candidates = nodes we discovered minus the original strong seeds
-    return reached - seeds
+    return {G.nodes[i] for i in np.flatnonzero(reached)} - set(seeds)
 
 ###############################################################################
 # 4.  Scoring candidates   s_c = max_p   P(c|p) · b_p
 ###############################################################################
 
 
+def belief_vector(G: ValueGraph, belief: BeliefState) -> np.ndarray:
+    """b_v for every node of G (0 for values without belief)."""
+    return np.array([belief.belief.get(v, 0.0) for v in G.nodes], dtype=float)
+
+
+def best_predecessor_scores(G: ValueGraph, b: np.ndarray, cand_idx: np.ndarray) -> np.ndarray:
+    """max over predecessors p of P(c|p) · b_p for each candidate index c, 0 without predecessor."""
+    rows = G.reverse[cand_idx]
+    products = rows.data * b[rows.indices]
+    scores = np.zeros(len(cand_idx))
+    has_predecessor = np.diff(rows.indptr) > 0
+    if products.size:
+        scores[has_predecessor] = np.maximum.reduceat(products, rows.indptr[:-1][has_predecessor])
+    return scores
+
+
 def score_candidates(
-    G: nx.DiGraph,
+    G: ValueGraph,
     belief: BeliefState,
     cand: Set[str],
 ) -> List[Tuple[str, float]]:
-    scores = {}
-    for c in cand:
-        # For every predecessor p → c compute the product
-        #   local conditional × current belief of p
-        best = max(
-            (G[p][c]["weight"] * belief.belief.get(p, 0.0) for p in G.predecessors(c)),
-            default=0.0,
-        )
-        scores[c] = best  # heuristic of expected info gain
-    return sorted(scores.items(), key=lambda t: t[1], reverse=True)
+    cand = list(cand)
+    cand_idx = np.array([G.node_index.get(c, -1) for c in cand], dtype=np.int64)
+    in_graph = cand_idx >= 0
+    # For every predecessor p → c the product local conditional × current belief of p, best one kept
+    scores = np.zeros(len(cand))
+    scores[in_graph] = best_predecessor_scores(G, belief_vector(G, belief), cand_idx[in_graph])
+    # heuristic of expected info gain
+    return sorted(zip(cand, scores.tolist()), key=lambda t: t[1], reverse=True)
 
 ###############################################################################
 # 5.  Putting it together   suggest_parameters()
 ###############################################################################
 
 
+class ParameterSuggester:
+    """suggest_parameters that keeps its state between calls: the beliefs b as a vector, the best‑predecessor
+    score of every node and the candidates reached from the strong values.
+    On each call, only the values changed in the BeliefState since the previous call are read: the scores of
+    their successors are recomputed, and the frontier is expanded again only if the set of strong values changed."""
+
+    def __init__(
+        self,
+        G: ValueGraph,
+        belief: BeliefState,
+        θ_CP: float = 0.3,
+        θ_belief: float = 0.7,
+        d: int = 2,
+    ):
+        self.G = G
+        self.belief = belief
+        self.θ_CP = θ_CP
+        self.θ_belief = θ_belief
+        self.d = d
+        self.b = belief_vector(G, belief)
+        self.scores = best_predecessor_scores(G, self.b, np.arange(G.number_of_nodes()))
+        self.strong = self.b >= θ_belief
+        self.candidates = None
+        self.seen_changes = len(belief.changes)
+
+    def update(self):
+        """Applies the belief changes made since the last update."""
+        changed = self.G.indexes(set(self.belief.changes[self.seen_changes:]))
+        self.seen_changes = len(self.belief.changes)
+        if not len(changed):
+            return
+        self.b[changed] = [self.belief.belief.get(self.G.nodes[i], 0.0) for i in changed]
+        strong = self.b[changed] >= self.θ_belief
+        if (strong != self.strong[changed]).any():
+            self.strong[changed] = strong
+            self.candidates = None
+        affected = np.unique(self.G.forward[changed].indices)
+        self.scores[affected] = best_predecessor_scores(self.G, self.b, affected)
+
+    def get_candidates(self) -> np.ndarray:
+        """Node indexes of the candidates: reached from the strong values, strong values excluded."""
+        if self.candidates is None:
+            seeds = np.flatnonzero(self.strong)
+            self.candidates = np.flatnonzero(expand_frontier_indexes(self.G, seeds, self.θ_CP, self.d) & ~self.strong)
+        return self.candidates
+
+    def suggest(self, θ_score: float = 0.2, K: int = 20) -> List[Tuple[str, float]]:
+        """Return up to *K* value‑IDs ranked by heuristic information gain, with score ≥ θ_score."""
+        self.update()
+        if not self.belief.strong_values(self.θ_belief):
+            return []
+        cand = self.get_candidates()
+        cand = cand[self.scores[cand] >= θ_score]
+        ranked = cand[np.argsort(-self.scores[cand], kind="stable")][:K]
+        return [(self.G.nodes[i], float(self.scores[i])) for i in ranked]
+
+
 def suggest_parameters(
-    G: nx.DiGraph,
+    G: ValueGraph,
     belief: BeliefState,
     θ_CP: float = 0.3,  # floor on edge weights kept during frontier expansion
     θ_belief: float = 0.7,  # threshold above which a value is considered *strong*
@@ -168,13 +414,12 @@ def suggest_parameters(
     θ_score: float = 0.2,  # minimum score for a candidate to be proposed
     K: int = 20  # top‑k suggestions to return.
 ) -> List[Tuple[str, float]]:
-    """Return up to *K* value‑IDs ranked by heuristic information gain."""
-    strong = set(belief.strong_values(θ_belief))
-    if not strong:
-        return []
-
-    cand = expand_frontier(G, strong, θ_CP, d)
-    ranked = score_candidates(G, belief, cand)
-    # Filter low utility suggestions
-    return [(vid, s) for vid, s in ranked if s >= θ_score][:K]
-
+    """Return up to *K* value‑IDs ranked by heuristic information gain.
+    The ParameterSuggester is kept with the belief state: calling again after set_known or update_observation
+    only updates the neighbourhood of the changed values."""
+    key = (id(G), θ_CP, θ_belief, d)
+    suggester = belief.suggesters.get(key, None)
+    if suggester is None or suggester.G is not G:
+        suggester = ParameterSuggester(G, belief, θ_CP, θ_belief, d)
+        belief.suggesters[key] = suggester
+    return suggester.suggest(θ_score, K)
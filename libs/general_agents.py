@@ -17,28 +17,102 @@ import json
 import os
 import copy
 import random
+import numpy as np
 import pandas as pd
 from libs import wals_utils as wu, grambank_utils as gu, grambank_wals_utils as gwu
+from libs import belief_propagation as bp
+from libs import cpt_utils as cu
+from libs.data_registry import resolve_data_root
 import math
 import pickle
+import hashlib
 
 # GLOBAL VARIABLES
-try:
-    with open("./external_data/wals_derived/domain_elements_pk_by_parameter_pk_lookup_table.json", encoding='utf-8') as f:
-        domain_elements_pk_by_parameter_pk = json.load(f)
-    with open("./external_data/wals_derived/parameter_pk_by_name_filtered.json", encoding='utf-8') as f:
-        parameter_pk_by_name_filtered = json.load(f)
-    default_wals_cpt = pd.read_json("./external_data/wals_derived/de_conditional_probability_df.json")
-except FileNotFoundError:
-    with open("../external_data/wals_derived/domain_elements_pk_by_parameter_pk_lookup_table.json", encoding='utf-8') as f:
-        domain_elements_pk_by_parameter_pk = json.load(f)
-    with open("../external_data/wals_derived/parameter_pk_by_name_filtered.json", encoding='utf-8') as f:
-        parameter_pk_by_name_filtered = json.load(f)
-    default_wals_cpt = pd.read_json("../external_data/wals_derived/de_conditional_probability_df.json")
+# WALS tables and the default WALS CPT are loaded lazily by wals_utils and shared with it.
+
+# version of the GeneralAgent.save file format, and folder of the agent cache (see get_cached_general_agent)
+AGENT_FILE_FORMAT = 1
+AGENT_CACHE_FOLDER = "agent_cache"
+# the least recently used agents are removed from the cache beyond this size (bytes)
+MAX_AGENT_CACHE_SIZE = 512 * 1024 * 1024
+
+# a CPT filtered by language_stat_filter is used only if it keeps at least this share of the defined cells of the
+# CPT over all languages: small language sets leave most blocks NaN (uniform potentials), losing most inferences
+MIN_FILTERED_CPT_COVERAGE = 0.5
 
 # CLASSES
+class BeliefHistory:
+    """ successive beliefs of a parameter, stored in one preallocated float array (one row per step),
+    value labels kept once (from the first beliefs appended).
+    mode is "full" (every step, the array grows by doubling), "last" (ring buffer of the last max_length steps)
+    or "off" (nothing stored)."""
+    def __init__(self, mode="full", max_length=100):
+        if mode not in ("full", "last", "off"):
+            raise ValueError("history mode must be 'full', 'last' or 'off', got {}".format(mode))
+        if max_length < 1:
+            raise ValueError("history max_length must be at least 1, got {}".format(max_length))
+        self.mode = mode
+        self.max_length = max_length
+        self.values = None
+        self.array = None
+        self.start = 0
+        self.length = 0
+
+    def clear(self):
+        self.start = 0
+        self.length = 0
+
+    def append(self, beliefs):
+        if self.mode == "off":
+            return
+        if self.values is None:
+            self.values = list(beliefs.keys())
+            capacity = self.max_length if self.mode == "last" else 8
+            self.array = np.empty((capacity, len(self.values)))
+        row = [beliefs.get(v, np.nan) for v in self.values]
+        capacity = self.array.shape[0]
+        if self.mode == "last" and self.length == capacity:
+            # overwrite the oldest step
+            self.array[self.start] = row
+            self.start = (self.start + 1) % capacity
+            return
+        if self.length == capacity:
+            self.array = np.concatenate([self.array, np.empty(self.array.shape)])
+        self.array[(self.start + self.length) % self.array.shape[0]] = row
+        self.length += 1
+
+    def to_array(self):
+        """ (steps x values) array, oldest step first """
+        if self.array is None:
+            return np.empty((0, 0))
+        return np.roll(self.array, -self.start, axis=0)[:self.length]
+
+    def to_df(self):
+        """ values x steps DataFrame, as pd.DataFrame(list of beliefs dicts).T """
+        return pd.DataFrame(self.to_array().T, index=self.values or [], columns=range(self.length))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, step):
+        if isinstance(step, slice):
+            return [self[k] for k in range(*step.indices(self.length))]
+        if step < 0:
+            step += self.length
+        if not 0 <= step < self.length:
+            raise IndexError("beliefs history index out of range")
+        return dict(zip(self.values, self.array[(self.start + step) % self.array.shape[0]].tolist()))
+
+    def __iter__(self):
+        return (self[k] for k in range(self.length))
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class LanguageParameter:
-    def __init__(self, parameter_name, origin="wals", priors_language_pk_list = [], verbose=False):
+    def __init__(self, parameter_name, origin="wals", priors_language_pk_list = [], verbose=False,
+                 history_mode="full", history_length=100):
         self.verbose = verbose
         self.name = parameter_name
         self.origin = origin
@@ -58,8 +132,8 @@ class LanguageParameter:
             else:
                 self.parameter_pk = "none"
             # values
-            if self.parameter_pk in domain_elements_pk_by_parameter_pk:
-                self.values = domain_elements_pk_by_parameter_pk[self.parameter_pk]
+            if self.parameter_pk in wu.domain_elements_pk_by_parameter_pk:
+                self.values = wu.domain_elements_pk_by_parameter_pk[self.parameter_pk]
                 if verbose:
                     print("WALS LanguageParameter {}: values = {}".format(self.name, self.values))
             else:
@@ -87,7 +161,7 @@ class LanguageParameter:
 
         # beliefs
         self.beliefs = {}
-        self.beliefs_history = []
+        self.beliefs_history = BeliefHistory(history_mode, history_length)
         self.observations_inbox = []
         self.message_inbox = {}
 
@@ -115,16 +189,16 @@ class LanguageParameter:
     def initialize_beliefs_with_grambank(self):
         pvalues = gu.grambank_param_value_dict[self.parameter_pk]["pvalues"].keys()
         self.beliefs = gu.compute_grambank_param_distribution(self.parameter_pk, self.priors_language_pk_list)
-        self.beliefs_history.append(copy.deepcopy(self.beliefs))
+        self.beliefs_history.append(self.beliefs)
         self.update_entropy()
         if self.verbose:
             print("LanguageParameter {}: Beliefs initialized with Grambank: {}".format(self.name, self.beliefs))
 
     def initialize_beliefs_with_wals(self):
-        depks = domain_elements_pk_by_parameter_pk[self.parameter_pk]
+        depks = wu.domain_elements_pk_by_parameter_pk[self.parameter_pk]
         # initialize with statistical priors
         self.beliefs = wu.compute_wals_param_distribution(self.parameter_pk, self.priors_language_pk_list)
-        self.beliefs_history.append(copy.deepcopy(self.beliefs))
+        self.beliefs_history.append(self.beliefs)
         self.update_entropy()
         if self.verbose:
             print("LanguageParameter {}: Beliefs initialized with WALS: {}".format(self.name, self.beliefs))
@@ -144,7 +218,7 @@ class LanguageParameter:
         if locked:
             self.locked = True
         #print("updated belief after injection", self.beliefs)
-        self.beliefs_history.append(copy.deepcopy(self.beliefs))
+        self.beliefs_history.append(self.beliefs)
         self.update_entropy()
         # if self.verbose:
         #     print("LanguageParameter {}: beliefs_history updated by inject_peak_belief, length {}.".format(self.name, len(self.beliefs_history)))
@@ -414,7 +488,7 @@ class LanguageParameter:
                 posteriors[de_pk] = exp_scores[de_pk] / normalization_factor
 
             self.beliefs = posteriors
-            self.beliefs_history.append(copy.deepcopy(self.beliefs))
+            self.beliefs_history.append(self.beliefs)
 
             if verbose:
                 print("LanguageParameter {}: Posteriors: {}".format(self.name, posteriors))
@@ -441,7 +515,6 @@ class LanguageParameter:
                     break
 
         self.observations_inbox = []
-        self.beliefs_history.append(copy.deepcopy(self.beliefs))
         self.update_entropy()
         return True
 
@@ -453,8 +526,19 @@ class GeneralAgent:
     fully connected graph."""
     def __init__(self, name, parameter_names=[],
                  language_stat_filter={},
-                 active_wals_cpt=default_wals_cpt,
+                 active_wals_cpt=None,
+                 filter_wals_cpt=False,
+                 filter_grambank_cpt=False,
+                 history_mode="full",
+                 history_length=100,
+                 max_neighbors=None,
+                 min_mutual_information=None,
+                 min_edge_support=None,
                  verbose=False):
+        """ history_mode and history_length configure the beliefs history of each parameter (see BeliefHistory):
+        "full", "last" (the last history_length steps) or "off".
+        max_neighbors, min_mutual_information and min_edge_support prune the fully connected graph (see prune_graph),
+        the graph is kept fully connected when they are all None."""
         self.verbose = verbose
         if self.verbose:
             print("General Agent {} initialization, verbose is {}.".format(name, verbose))
@@ -464,31 +548,66 @@ class GeneralAgent:
         self.parameter_names = parameter_names
         self.language_parameters = {}
         self.graph = {}
+        # array-backed belief propagation, built from the graph on first use (see get_bp_engine)
+        self.bp_engine = None
+
+        # create language_pks_used_for_statistics
+        self.wals_languages_used_for_statistics = self.initialize_wals_list_of_language_pks_used_for_statistics()
+        self.grambank_languages_used_for_statistics = self.initialize_grambank_list_of_language_pks_used_for_statistics()
+
+        # WALS CPT: the one given, or with filter_wals_cpt the CPT computed over the languages used for statistics
+        # when they support it (see MIN_FILTERED_CPT_COVERAGE), otherwise the default one shared with wals_utils
         self.active_wals_cpt = active_wals_cpt
+        if self.active_wals_cpt is None and filter_wals_cpt and self.language_stat_filters != {}:
+            filtered = wu.get_wals_cpt_provider().get_supported_cpt([str(lpk) for lpk in self.wals_languages_used_for_statistics],
+                                                                    wu.N_MIN, MIN_FILTERED_CPT_COVERAGE)
+            if filtered is not None:
+                self.active_wals_cpt = filtered[0]
+                if self.verbose:
+                    print("Agent {}: WALS CPT computed over {} languages.".format(self.name, len(self.wals_languages_used_for_statistics)))
+            else:
+                print("Agent {}: too few languages for a filtered WALS CPT, using the CPT over all languages.".format(self.name))
+        if self.active_wals_cpt is None:
+            self.active_wals_cpt = wu.cpt
         # make index and column labels strings.
         self.active_wals_cpt.index = self.active_wals_cpt.index.astype(str)
         self.active_wals_cpt.columns = self.active_wals_cpt.columns.astype(str)
 
-        # create language_pks_used_for_statistics
-        self.wals_languages_used_for_statistics = self.initialize_wals_list_of_language_pks_used_for_statistics()
-        self.grambank_languages_used_for_statistics = self.initialize_grambank_list_of_language_pks_used_for_statistics()
+        # Grambank CPT: with filter_grambank_cpt, the CPT computed over the Grambank languages of the
+        # family and macroarea filters (when they match Grambank languages), otherwise the default one
+        self.active_grambank_cpt = None
+        if filter_grambank_cpt:
+            grambank_filter = {key: self.language_stat_filters[key] for key in ["family", "macroarea"]
+                               if key in self.language_stat_filters}
+            grambank_lids = gu.get_grambank_cpt_language_lids(grambank_filter) if grambank_filter else []
+            if grambank_lids:
+                filtered = gu.get_grambank_cpt_provider().get_supported_cpt(grambank_lids, gu.N_MIN, MIN_FILTERED_CPT_COVERAGE)
+                if filtered is not None:
+                    self.active_grambank_cpt = filtered[0]
+                    if self.verbose:
+                        print("Agent {}: Grambank CPT computed over {} languages.".format(self.name, len(grambank_lids)))
+                else:
+                    print("Agent {}: too few languages for a filtered Grambank CPT, using the CPT over all languages.".format(self.name))
 
         # create and initialize instances of LanguageParameters objects
         for parameter_name in self.parameter_names:
             if parameter_name in wu.parameter_pk_by_name:
                 # This is a WALS parameter
-                new_language_parameter = LanguageParameter(parameter_name, origin="wals", priors_language_pk_list=self.wals_languages_used_for_statistics, verbose=self.verbose)
+                new_language_parameter = LanguageParameter(parameter_name, origin="wals", priors_language_pk_list=self.wals_languages_used_for_statistics, verbose=self.verbose,
+                                                           history_mode=history_mode, history_length=history_length)
                 self.language_parameters[parameter_name] = new_language_parameter
                 new_language_parameter.initialize_beliefs_with_wals()
             elif parameter_name in gu.grambank_pid_by_pname:
                 # This is a Grambank parameter
-                new_language_parameter = LanguageParameter(parameter_name, origin="grambank", priors_language_pk_list=self.grambank_languages_used_for_statistics, verbose=self.verbose)
+                new_language_parameter = LanguageParameter(parameter_name, origin="grambank", priors_language_pk_list=self.grambank_languages_used_for_statistics, verbose=self.verbose,
+                                                           history_mode=history_mode, history_length=history_length)
                 self.language_parameters[parameter_name] = new_language_parameter
                 new_language_parameter.initialize_beliefs_with_grambank()
             else:
                 new_language_parameter = LanguageParameter(parameter_name, origin="dig4el",
                                                            priors_language_pk_list=[],
-                                                           verbose=self.verbose)
+                                                           verbose=self.verbose,
+                                                           history_mode=history_mode, history_length=history_length)
                 self.language_parameters[parameter_name] = new_language_parameter
                 new_language_parameter.initialize_beliefs_with_grambank()
         if self.verbose:
@@ -499,6 +618,10 @@ class GeneralAgent:
         for p in self.language_parameters:
             self.graph_name += p[-3:] + "_"
         self.initialize_graph()
+        self.graph_pruning_report = None
+        if max_neighbors is not None or min_mutual_information is not None or min_edge_support is not None:
+            self.prune_graph(max_neighbors=max_neighbors, min_mutual_information=min_mutual_information,
+                             min_support=min_edge_support)
 
     def get_beliefs(self):
         beliefs = {}
@@ -518,11 +641,11 @@ class GeneralAgent:
 
     def reset_beliefs_history(self):
         for lp_name, lp in self.language_parameters.items():
-            lp.beliefs_history = []
+            lp.beliefs_history.clear()
 
     def reset_language_parameters_beliefs_with_wals(self):
         for lp_name, lp in self.language_parameters.items():
-            lp.beliefs_history = []
+            lp.beliefs_history.clear()
             lp.initialize_beliefs_with_wals()
 
     def initialize_graph(self, alternate_graph={}):
@@ -532,6 +655,9 @@ class GeneralAgent:
         to, each of these nodes with the value (Pj given Pi) matrix."""
         if self.verbose:
             print("General Agent: initializing graph.")
+        if self.active_wals_cpt is None:
+            self.restore_active_cpts()
+        self.bp_engine = None
         if alternate_graph != {}:
             self.graph = alternate_graph
         else:
@@ -549,7 +675,8 @@ class GeneralAgent:
                     elif lpn1 in gu.grambank_pid_by_pname.keys() and lpn2 in gu.grambank_pid_by_pname.keys() and lpn2 != lpn1:
                         cp_matrix = gu.compute_grambank_cp_matrix_from_general_data(
                             self.language_parameters[lpn2].parameter_pk,
-                            self.language_parameters[lpn1].parameter_pk
+                            self.language_parameters[lpn1].parameter_pk,
+                            active_grambank_cpt=self.active_grambank_cpt
                         )
                         self.graph[lpn1][lpn2] = cp_matrix
 
@@ -569,6 +696,49 @@ class GeneralAgent:
         if self.verbose:
             print("Agent {}: Graph initialized.".format(self.name))
 
+    def restore_active_cpts(self):
+        """ finds again the CPTs of an agent loaded by GeneralAgent.load from their saved ids: the default CPTs,
+        or the CPTs filtered over the languages used for statistics. Raises ValueError when a CPT has changed
+        or cannot be found again: the agent must then be created again."""
+        saved_cpt_ids = getattr(self, "saved_cpt_ids", {})
+        wals_id = saved_cpt_ids.get("wals", None)
+        if wals_id is None:
+            raise ValueError("Agent {}: no saved WALS CPT id, create the agent again.".format(self.name))
+        if wals_id.startswith("wals_"):
+            wals_cpt, _ = wu.get_wals_cpt_provider(filtered_params=wals_id.startswith("wals_filtered:")).get_cpt(
+                [str(lpk) for lpk in self.wals_languages_used_for_statistics])
+        else:
+            wals_cpt = wu.cpt
+        if cu.get_cpt_id(wals_cpt) != wals_id:
+            raise ValueError("Agent {}: WALS CPT {} cannot be found again, create the agent again.".format(self.name, wals_id))
+        grambank_id = saved_cpt_ids.get("grambank", None)
+        grambank_cpt = None
+        if grambank_id is not None:
+            grambank_filter = {key: self.language_stat_filters[key] for key in ["family", "macroarea"]
+                               if key in self.language_stat_filters}
+            grambank_cpt, _ = gu.get_grambank_cpt_provider().get_cpt(gu.get_grambank_cpt_language_lids(grambank_filter))
+            if cu.get_cpt_id(grambank_cpt) != grambank_id:
+                raise ValueError("Agent {}: Grambank CPT {} cannot be found again, create the agent again.".format(
+                    self.name, grambank_id))
+        self.active_wals_cpt = wals_cpt
+        self.active_grambank_cpt = grambank_cpt
+
+    def prune_graph(self, max_neighbors=None, min_mutual_information=None, min_support=None):
+        """ keeps only the informative edges of the graph: pairs of parameters whose mutual information (under the
+        current beliefs and the CP matrices) is at least min_mutual_information, among the max_neighbors best
+        pairs of one of the two parameters, and whose CP matrices have at least a min_support share of defined
+        (non-NaN) cells. See belief_propagation.prune_graph. Returns the report (edges, kept_edges, density...)."""
+        self.graph, self.graph_pruning_report = bp.prune_graph(self.graph, self.get_bp_engine(),
+                                                               max_neighbors=max_neighbors,
+                                                               min_mutual_information=min_mutual_information,
+                                                               min_support=min_support)
+        self.bp_engine = None
+        if self.verbose:
+            print("Agent {}: graph pruned to {} edges out of {} (density {:.2f}).".format(
+                self.name, self.graph_pruning_report["kept_edges"], self.graph_pruning_report["edges"],
+                self.graph_pruning_report["density"]))
+        return self.graph_pruning_report
+
     def initialize_grambank_list_of_language_pks_used_for_statistics(self):
         language_pks_used_for_statistics = []
         # TODO: Handle language family filter
@@ -613,24 +783,98 @@ class GeneralAgent:
         for p_name in path:
             self.language_parameters[p_name].update_beliefs_from_observations()
 
+    def get_bp_engine(self):
+        """ the array-backed belief propagation engine of the agent, (re)built when the graph or the values of a
+        parameter changed, and loaded with the current beliefs, weights and locks of the language parameters."""
+        engine = self.bp_engine
+        if engine is None or engine.graph is not self.graph or engine.nodes != list(self.language_parameters.keys()) \
+                or not all(engine.has_same_values(lpn, lp.beliefs) for lpn, lp in self.language_parameters.items()):
+            engine = bp.BeliefPropagationEngine(self.graph,
+                                                {lpn: list(lp.beliefs.keys()) for lpn, lp in self.language_parameters.items()})
+            self.bp_engine = engine
+        for k, lp in enumerate(self.language_parameters.values()):
+            engine.set_beliefs(lp.name, lp.beliefs)
+            engine.weights[0, k] = lp.weight
+            engine.locked[0, k] = lp.locked
+        return engine
+
+    def put_engine_beliefs(self, engine, updated):
+        """ copies the beliefs updated by the engine (mask returned by update_beliefs) back to the language parameters.
+        Returns the names of the updated parameters. """
+        updated_names = [engine.nodes[k] for k in np.flatnonzero(updated[0])]
+        for p_name in updated_names:
+            P = self.language_parameters[p_name]
+            P.beliefs = engine.get_beliefs(p_name)
+            P.beliefs_history.append(P.beliefs)
+            P.entropy = float(engine.entropy[0, engine.node_index[p_name]])
+        return updated_names
+
     def run_belief_update_cycle(self, path_type="random"):
         path = self.create_path(path_type=path_type)
+        engine = self.get_bp_engine()
         # run messaging round
-        self.run_message_round()
-        # update each parameter's beliefs from observations and neighbors messages
-        for p_name in path:
-            self.update_beliefs_from_messages_received(p_name)
+        engine.run_message_round(self.create_path(path_type="random"))
+        # update each parameter's beliefs from neighbors messages
+        self.put_engine_beliefs(engine, engine.update_beliefs(path))
+
+    def run_belief_propagation_until_convergence(self, tolerance=1e-3, max_iterations=50, damping_factor=0.5):
+        """ residual belief propagation (see BeliefPropagationEngine.run_residual_schedule): deterministic,
+        only the messages whose inputs changed are computed, stops on convergence.
+        Returns the report: iterations, converged, residual_history, message_computations, cycle_times."""
+        engine = self.get_bp_engine()
+        beliefs_before = engine.beliefs.copy()
+        report = engine.run_residual_schedule(tolerance=tolerance, max_iterations=max_iterations,
+                                              damping_factor=damping_factor)
+        changed = bp.segment_sums(np.abs(engine.beliefs - beliefs_before), engine.slot_node, len(engine.nodes)) > 0
+        self.put_engine_beliefs(engine, changed)
+        if self.verbose:
+            print("Agent {}: belief propagation {} after {} iterations, {} messages computed.".format(
+                self.name, "converged" if report["converged"] else "stopped", report["iterations"],
+                report["message_computations"]))
+        return report
+
+    def run_consensus(self, n_runs=3, n_cycles=3, damping_factor=0.5):
+        """ n_runs independent randomized belief propagations of n_cycles cycles each, all starting from the current
+        beliefs and messages, run together: one row of a replicated engine per run, each with its own random order.
+        Returns {"runs": [{parameter: beliefs} at the end of each run], "mean" and "variance":
+        {parameter: {value: statistic over the runs}}, "history": [{parameter: beliefs} after each cycle of the last run]}.
+        The agent ends with the beliefs of the last run."""
+        engine = self.get_bp_engine()
+        runs = engine.replicate(n_runs)
+        history = []
+        for _ in range(n_cycles):
+            runs.run_message_round([self.create_path(path_type="random") for _ in range(n_runs)])
+            runs.update_beliefs(self.parameter_names, damping_factor=damping_factor)
+            history.append({lpn: runs.get_beliefs(lpn, row=n_runs - 1) for lpn in engine.nodes})
+        mean = runs.beliefs.mean(axis=0)
+        variance = runs.beliefs.var(axis=0)
+        consensus = {"runs": [{lpn: runs.get_beliefs(lpn, row=r) for lpn in engine.nodes} for r in range(n_runs)],
+                     "mean": {}, "variance": {}, "history": history}
+        for k, lpn in enumerate(engine.nodes):
+            consensus["mean"][lpn] = dict(zip(engine.values[k], mean[engine.node_slice(k)].tolist()))
+            consensus["variance"][lpn] = dict(zip(engine.values[k], variance[engine.node_slice(k)].tolist()))
+
+        # the agent continues from the last run
+        for name in ["beliefs", "entropy", "messages", "sent"]:
+            getattr(engine, name)[0] = getattr(runs, name)[n_runs - 1]
+        for k, lpn in enumerate(engine.nodes):
+            P = self.language_parameters[lpn]
+            if history and not P.locked:
+                for beliefs in history:
+                    P.beliefs_history.append(beliefs[lpn])
+                P.beliefs = history[-1][lpn]
+                P.entropy = float(engine.entropy[0, k])
+        return consensus
 
     def run_message_round(self, path_type="random"):
-        messages = {}
         path = self.create_path(path_type=path_type)
-        for sender_name in path:
-            for recipient_name in self.graph[sender_name].keys():
-                message = self.generate_message(sender_name, recipient_name)
-                self.language_parameters[recipient_name].message_inbox[sender_name] = message
-                messages[sender_name + "->" + recipient_name] = message
-                # if self.verbose:
-                #     print("Message {}->{}: {}".format(sender_name, recipient_name, message))
+        self.get_bp_engine().run_message_round(path)
+
+    def get_message_inbox(self, parameter_name):
+        """ {sender name: message} of the messages received by a parameter. """
+        if self.bp_engine is None:
+            return {}
+        return self.bp_engine.get_message_inbox(parameter_name)
 
     def create_random_propagation_path(self):
         """ List of parameters indicating the order in which the belief propagation is executed."""
@@ -681,78 +925,14 @@ class GeneralAgent:
         if verbose:
             print("Agent {}: update_beliefs_from_messages_received({})".format(self.name, parameter_name))
             print("Initial belief: {}".format(self.language_parameters[parameter_name].beliefs))
-        # Retrieve the parameter object
-        P = self.language_parameters[parameter_name]
-
-        # Update beliefs only if the parameter is not locked
-        if not P.locked:
-
-            # Get the messages from neighbors
-            message_inbox = P.message_inbox  # {neighbor_name: message_dict}
-
-            # Initialize variables
-            x_i_values = P.beliefs.keys()
-            computed_beliefs = {}
-
-            for x_i in x_i_values:
-                # Start with current belief as the prior
-                prior_belief = P.beliefs.get(x_i, 1.0 / len(x_i_values))  # Default to uniform if missing
-                belief = prior_belief  # Use the current belief as the starting point
-
-                # Multiply by messages from all neighbors
-                for neighbor_name, message in message_inbox.items():
-                    m_neighbor_to_P = message  # {x_i: probability}
-                    m_value = m_neighbor_to_P.get(x_i, 1.0)  # Default to 1.0 if message value is missing
-                    belief *= m_value
-
-                computed_beliefs[x_i] = belief
-
-            # Normalize the computed beliefs
-            total_belief = sum(computed_beliefs.values())
-            if total_belief > 0:
-                for x_i in x_i_values:
-                    computed_beliefs[x_i] /= total_belief
-            else:
-                # Handle zero total by assigning uniform probabilities
-                num_values = len(x_i_values)
-                if num_values > 0:
-                    uniform_prob = 1.0 / num_values
-                    for x_i in x_i_values:
-                        computed_beliefs[x_i] = uniform_prob
-
-            # Apply the damping factor
-            damped_beliefs = {}
-            for x_i in x_i_values:
-                old_belief = P.beliefs.get(x_i, 1.0 / len(x_i_values))  # Default to uniform if missing
-                new_belief = computed_beliefs[x_i]
-                damped_belief = damping_factor * old_belief + (1 - damping_factor) * new_belief
-                damped_beliefs[x_i] = damped_belief
-
-            # Normalize the damped beliefs
-            total_damped_belief = sum(damped_beliefs.values())
-            if total_damped_belief > 0:
-                for x_i in x_i_values:
-                    damped_beliefs[x_i] /= total_damped_belief
-            else:
-                # Handle zero total by assigning uniform probabilities
-                num_values = len(x_i_values)
-                if num_values > 0:
-                    uniform_prob = 1.0 / num_values
-                    for x_i in x_i_values:
-                        damped_beliefs[x_i] = uniform_prob
-
-            # Update the beliefs in the parameter object
-            P.beliefs = damped_beliefs
-            P.beliefs_history.append(copy.deepcopy(P.beliefs))
-            P.update_entropy()
-            if verbose:
-                print(
-                    "Agent {}: belief of parameter {} updated with damping factor {}".format(self.name, parameter_name,
-                                                                                             damping_factor))
+        engine = self.get_bp_engine()
+        updated_names = self.put_engine_beliefs(engine, engine.update_beliefs([parameter_name], damping_factor=damping_factor))
+        if verbose:
+            if updated_names:
+                print("Agent {}: belief of parameter {} updated with damping factor {}".format(self.name, parameter_name,
+                                                                                               damping_factor))
                 print("New belief: {}".format(self.language_parameters[parameter_name].beliefs))
-
-        else:
-            if verbose:
+            else:
                 print("Agent {}: parameter {} is locked and will not be updated by messages.".format(self.name,
                                                                                                      parameter_name))
 
@@ -770,76 +950,334 @@ class GeneralAgent:
         """
         if verbose:
             print("Agent {}: Generate message {} ---> {}".format(self.name, Pi_name, Pj_name))
-
-        # Retrieve the parameter objects
-        Pi = self.language_parameters[Pi_name]
-        Pj = self.language_parameters[Pj_name]
-
-        # Get the potential function between Pi and Pj
-        cp_matrix_Pj_given_Pi = self.graph[Pi_name][Pj_name]  # DataFrame with rows x_j, columns x_i
-
-        # Get the local beliefs at node Pi
-        phi_i = Pi.beliefs  # {x_i: probability}
-
-        # Get neighbors of Pi excluding Pj
-        neighbors_i = self.graph[Pi_name].keys()
-        neighbors_except_j = [k for k in neighbors_i if k != Pj_name]
-
-        # Initialize the product of incoming messages for each x_i
-        x_i_values = phi_i.keys()  # Possible values of Pi
-        product_messages = {x_i: 1.0 for x_i in x_i_values}
-
-        # Multiply messages from all neighbors except Pj
-        for neighbor_name in neighbors_except_j:
-            # Get the message from neighbor to Pi
-            m_neighbor_to_Pi = Pi.message_inbox.get(neighbor_name, {})
-            for x_i in x_i_values:
-                # Get the message value, defaulting to 1.0 if not present
-                m_value = m_neighbor_to_Pi.get(x_i, 1.0)
-                product_messages[x_i] *= m_value
-
-        # Compute the message from Pi to Pj
-        x_j_values = Pj.beliefs.keys()  # Possible values of Pj
-        message_Pi_to_Pj = {x_j: 0.0 for x_j in x_j_values}
-
-        for x_j in x_j_values:
-            total = 0.0
-            for x_i in x_i_values:
-                # Retrieve values
-                phi_i_xi = phi_i.get(x_i, 0.0)
-                psi_ij = cp_matrix_Pj_given_Pi.at[x_j, x_i]  # Potential value between x_i and x_j
-                prod_msg_xi = product_messages.get(x_i, 1.0)
-                # Compute the term
-                term = phi_i_xi * psi_ij * prod_msg_xi
-                total += term
-            message_Pi_to_Pj[x_j] = total
-
-        # **Incorporate the weighting parameter**
-        # Retrieve the weight of node Pi
-        weight_Pi = Pi.weight  # Assuming that Pi has an attribute 'weight'
-
-        # Multiply the entire message by the weight
-        for x_j in x_j_values:
-            message_Pi_to_Pj[x_j] *= weight_Pi
-
-        # Normalize the message
-        total_message = sum(message_Pi_to_Pj.values())
-        if total_message > 0:
-            for x_j in x_j_values:
-                message_Pi_to_Pj[x_j] /= total_message
-        else:
-            # Handle zero total by assigning uniform probabilities or keeping zeros
-            num_values = len(x_j_values)
-            if num_values > 0:
-                uniform_prob = 1.0 / num_values
-                for x_j in x_j_values:
-                    message_Pi_to_Pj[x_j] = uniform_prob
-
+        engine = self.get_bp_engine()
+        i = engine.node_index[Pi_name]
+        e = engine.edge_index[(i, engine.node_index[Pj_name])]
+        messages = engine.compute_messages(i, rows=slice(0, 1))[0]
+        start = engine.message_offsets[e] - engine.message_offsets[engine.out_edges[i][0]]
+        message_Pi_to_Pj = dict(zip(engine.values[engine.node_index[Pj_name]],
+                                    messages[start:start + engine.belief_sizes[engine.node_index[Pj_name]]].tolist()))
         if verbose:
             print("Agent {}: Generated message {} ---> {}: {}".format(self.name, Pi_name, Pj_name, message_Pi_to_Pj))
-        # Return the computed message
         return message_Pi_to_Pj
 
+    def save(self, path):
+        """ saves the agent in one binary file (numpy .npz, no pickle): parameters with their values, beliefs, weights
+        and locks, languages used for statistics, CPT ids and the CP matrices of the graph.
+        Observations and message inboxes are not saved, beliefs histories restart empty. See GeneralAgent.load."""
+        labels = []
+        label_ids = {}
+
+        def label_id(label_list):
+            key = json.dumps(label_list)
+            if key not in label_ids:
+                label_ids[key] = len(labels)
+                labels.append(label_list)
+            return label_ids[key]
+
+        parameters = []
+        for lpn, lp in self.language_parameters.items():
+            parameters.append({"name": lpn, "origin": lp.origin, "parameter_pk": getattr(lp, "parameter_pk", None),
+                               "values": json_labels(lp.values), "beliefs": label_id(json_labels(lp.beliefs.keys())),
+                               "weight": float(lp.weight), "locked": bool(lp.locked), "entropy": float(lp.entropy),
+                               "history_mode": lp.beliefs_history.mode,
+                               "history_length": lp.beliefs_history.max_length})
+        edges = []
+        potentials = []
+        for lpn1 in self.graph:
+            for lpn2, cp_matrix in self.graph[lpn1].items():
+                edges.append([lpn1, lpn2, label_id(json_labels(cp_matrix.index)), label_id(json_labels(cp_matrix.columns))])
+                potentials.append(cp_matrix.to_numpy(dtype=float, na_value=np.nan).ravel())
+        metadata = {"format": AGENT_FILE_FORMAT,
+                    "name": self.name,
+                    "parameter_names": list(self.parameter_names),
+                    "language_stat_filters": self.language_stat_filters,
+                    "graph_name": self.graph_name,
+                    "graph_nodes": list(self.graph.keys()),
+                    "graph_pruning_report": self.graph_pruning_report,
+                    "active_wals_cpt_id": None if self.active_wals_cpt is None else cu.get_cpt_id(self.active_wals_cpt),
+                    "active_grambank_cpt_id": None if self.active_grambank_cpt is None else cu.get_cpt_id(self.active_grambank_cpt),
+                    "wals_languages_used_for_statistics": json_labels(self.wals_languages_used_for_statistics),
+                    "grambank_languages_used_for_statistics": json_labels(self.grambank_languages_used_for_statistics),
+                    "labels": labels,
+                    "parameters": parameters,
+                    "edges": edges}
+        beliefs = [np.array(list(lp.beliefs.values()), dtype=float) for lp in self.language_parameters.values()]
+        with open(path, "wb") as f:
+            np.savez(f, metadata=np.array(json.dumps(metadata)),
+                     beliefs=np.concatenate(beliefs) if beliefs else np.zeros(0),
+                     potentials=np.concatenate(potentials) if potentials else np.zeros(0))
+
+    @classmethod
+    def load(cls, path, verbose=False):
+        """ agent saved with GeneralAgent.save, ready to receive observations and run belief propagation.
+        The graph is loaded as saved: the CPTs the agent was created with are not loaded again,
+        active_wals_cpt and active_grambank_cpt are None until initialize_graph finds them again (see restore_active_cpts)."""
+        with np.load(path, allow_pickle=False) as data:
+            metadata = json.loads(str(data["metadata"]))
+            beliefs = data["beliefs"]
+            potentials = data["potentials"]
+        if metadata["format"] != AGENT_FILE_FORMAT:
+            raise ValueError("{}: agent file format {} is not supported".format(path, metadata["format"]))
+        agent = cls.__new__(cls)
+        agent.verbose = verbose
+        agent.name = metadata["name"]
+        agent.language_stat_filters = metadata["language_stat_filters"]
+        agent.parameter_names = metadata["parameter_names"]
+        agent.wals_languages_used_for_statistics = metadata["wals_languages_used_for_statistics"]
+        agent.grambank_languages_used_for_statistics = metadata["grambank_languages_used_for_statistics"]
+        agent.active_wals_cpt = None
+        agent.active_grambank_cpt = None
+        agent.saved_cpt_ids = {"wals": metadata["active_wals_cpt_id"], "grambank": metadata["active_grambank_cpt_id"]}
+        agent.graph_name = metadata["graph_name"]
+        agent.graph_pruning_report = metadata["graph_pruning_report"]
+        agent.bp_engine = None
+        labels = metadata["labels"]
+
+        agent.language_parameters = {}
+        offset = 0
+        for p in metadata["parameters"]:
+            lp = LanguageParameter.__new__(LanguageParameter)
+            lp.verbose = verbose
+            lp.name = p["name"]
+            lp.origin = p["origin"]
+            if p["parameter_pk"] is not None:
+                lp.parameter_pk = p["parameter_pk"]
+            if lp.origin == "wals":
+                lp.priors_language_pk_list = agent.wals_languages_used_for_statistics
+            elif lp.origin == "grambank":
+                lp.priors_language_pk_list = agent.grambank_languages_used_for_statistics
+            else:
+                lp.priors_language_pk_list = []
+            lp.values = p["values"]
+            value_labels = metadata["labels"][p["beliefs"]]
+            lp.beliefs = dict(zip(value_labels, beliefs[offset:offset + len(value_labels)].tolist()))
+            offset += len(value_labels)
+            lp.weight = p["weight"]
+            lp.locked = p["locked"]
+            lp.entropy = p["entropy"]
+            lp.beliefs_history = BeliefHistory(p["history_mode"], p["history_length"])
+            lp.observations_inbox = []
+            lp.message_inbox = {}
+            agent.language_parameters[lp.name] = lp
+
+        # CP matrices become DataFrames when accessed, the belief propagation engine reads the arrays
+        agent.graph = {lpn: bp.PotentialMap() for lpn in metadata["graph_nodes"]}
+        offset = 0
+        for lpn1, lpn2, index_id, columns_id in metadata["edges"]:
+            index, columns = labels[index_id], labels[columns_id]
+            size = len(index) * len(columns)
+            agent.graph[lpn1].add_block(lpn2, potentials[offset:offset + size].reshape(len(index), len(columns)),
+                                        index, columns)
+            offset += size
+        if verbose:
+            print("Agent {}: loaded from {} with {} parameters.".format(agent.name, path, len(agent.language_parameters)))
+        return agent
+# ************************************************************************
 
+class BatchedGeneralAgent:
+    """ N general agents over the same parameters and graph, one row of beliefs per target language.
+    Priors and graph are computed once (by a template GeneralAgent), beliefs are held by the engine as a
+    (N x values) array, observations and truth injections are given per row, and message passing runs
+    for all rows at once.
+    language_ids only label the rows: the same language can be given several times (e.g. one row per epoch)."""
+    def __init__(self, name, parameter_names=[], language_ids=[],
+                 language_stat_filter={},
+                 active_wals_cpt=None,
+                 filter_wals_cpt=False,
+                 filter_grambank_cpt=False,
+                 verbose=False):
+        self.verbose = verbose
+        self.name = name
+        self.language_ids = list(language_ids)
+        self.template = GeneralAgent(name, parameter_names=parameter_names,
+                                     language_stat_filter=language_stat_filter,
+                                     active_wals_cpt=active_wals_cpt,
+                                     filter_wals_cpt=filter_wals_cpt,
+                                     filter_grambank_cpt=filter_grambank_cpt,
+                                     history_mode="off",
+                                     verbose=verbose)
+        self.language_parameters = self.template.language_parameters
+        self.parameter_names = list(self.language_parameters.keys())
+        self.graph = self.template.graph
+        self.engine = bp.BeliefPropagationEngine(self.graph,
+                                                 {lpn: list(lp.beliefs.keys()) for lpn, lp in self.language_parameters.items()},
+                                                 n_rows=len(self.language_ids))
+        self.prior_beliefs = {lpn: dict(lp.beliefs) for lpn, lp in self.language_parameters.items()}
+        self.observations_inbox = [{} for _ in self.language_ids]
+        self.reset_beliefs()
+        if self.verbose:
+            print("Batched General Agent {}: {} parameters, {} languages.".format(self.name, len(self.parameter_names),
+                                                                                  len(self.language_ids)))
+
+    def reset_beliefs(self):
+        """ all rows back to the priors, unlocked, without messages."""
+        for k, lpn in enumerate(self.parameter_names):
+            for row in range(len(self.language_ids)):
+                self.engine.set_beliefs(lpn, self.prior_beliefs[lpn], row)
+            self.engine.weights[:, k] = self.language_parameters[lpn].weight
+        self.engine.locked[:] = False
+        self.engine.reset_messages()
+        self.engine.update_entropy()
+
+    def inject_peak_belief(self, row, parameter_name, depk, probability, locked=False):
+        """ same as LanguageParameter.inject_peak_belief, for one row."""
+        k = self.engine.node_index[parameter_name]
+        values = self.engine.values[k]
+        p_not = (1 - probability) / (len(values) - 1)
+        self.engine.set_beliefs(parameter_name, {value: probability if str(value) == str(depk) else p_not
+                                                 for value in values}, row)
+        if locked:
+            self.engine.locked[row, k] = True
 
+    def add_observations(self, row, parameter_name, observations):
+        """ observations are {'depk': number of occurrences}, see GeneralAgent.add_observations."""
+        if parameter_name in self.language_parameters.keys():
+            self.observations_inbox[row].setdefault(parameter_name, []).append(observations)
 
+    def run_belief_update_from_observations(self):
+        """ updates each row with its observations, with LanguageParameter.update_beliefs_from_observations."""
+        for row, observations_by_parameter in enumerate(self.observations_inbox):
+            for parameter_name, observations_list in observations_by_parameter.items():
+                k = self.engine.node_index[parameter_name]
+                P = copy.copy(self.language_parameters[parameter_name])
+                P.beliefs = self.engine.get_beliefs(parameter_name, row)
+                P.locked = bool(self.engine.locked[row, k])
+                P.beliefs_history = BeliefHistory("off")
+                P.observations_inbox = list(observations_list)
+                P.update_beliefs_from_observations()
+                self.engine.set_beliefs(parameter_name, P.beliefs, row)
+                self.engine.locked[row, k] = P.locked
+        self.observations_inbox = [{} for _ in self.language_ids]
+        self.engine.update_entropy()
+
+    def run_belief_update_cycle(self, independent_paths=True):
+        """ a messaging round followed by the update of all unlocked beliefs, for all rows.
+        With independent_paths, each row sends its messages in its own random order, as N separate
+        GeneralAgent would; otherwise all rows share the same random order."""
+        if independent_paths:
+            node_order = [self.template.create_path(path_type="random") for _ in self.language_ids]
+        else:
+            node_order = self.template.create_path(path_type="random")
+        self.engine.run_message_round(node_order)
+        self.engine.update_beliefs(self.parameter_names)
+
+    def run_belief_propagation_until_convergence(self, tolerance=1e-3, max_iterations=50, damping_factor=0.5):
+        """ residual belief propagation for all rows, see GeneralAgent.run_belief_propagation_until_convergence."""
+        return self.engine.run_residual_schedule(tolerance=tolerance, max_iterations=max_iterations,
+                                                 damping_factor=damping_factor)
+
+    def get_beliefs(self, row):
+        return {lpn: self.engine.get_beliefs(lpn, row) for lpn in self.parameter_names}
+
+    def get_winning_belief_codes(self, row):
+        """ {parameter name: value code of highest belief} """
+        return self.engine.get_winning_values(row)
+
+
+# ************************************************************************
+# AGENT CACHE
+# Agents saved with GeneralAgent.save, by content: the key is a hash of the parameters, the language filter, the
+# agent options and the ids of the CPTs (with their modification time). A CPT rebuilt gives new keys.
+
+def json_labels(labels):
+    """ labels as a JSON serializable list, numpy scalars converted to Python ones. """
+    return [label.item() if isinstance(label, np.generic) else label for label in labels]
+
+
+def get_agent_cpt_ids(active_wals_cpt=None):
+    """ ids of the CPTs an agent is built from. None if active_wals_cpt has no stable id (see cpt_utils.get_cpt_id). """
+    cpt_ids = {
+        "wals": cu.get_cpt_file_id(wu.wals_data.path("de_conditional_probability_df.json")),
+        "grambank": cu.get_cpt_file_id(gu.grambank_data.path("grambank_vid_conditional_probability.json")),
+    }
+    for name in ["wals_given_grambank_cpt", "grambank_given_wals_cpt"]:
+        folder = gwu.cross_data.path(name)
+        cpt_ids[name] = cu.get_sparse_cpt_id(folder) if os.path.isfile(os.path.join(folder, "values.npz")) else None
+    if active_wals_cpt is not None:
+        cpt_ids["active_wals"] = cu.get_cpt_id(active_wals_cpt)
+        if cpt_ids["active_wals"].startswith("cpt:"):
+            return None
+    return cpt_ids
+
+
+def get_agent_data_ids():
+    """ ids of the WALS and Grambank tables priors, language filters and filtered CPTs are computed from,
+    and of the estimation settings of filtered CPTs. """
+    return {"wals": wu.wals_data.get_file_ids(),
+            "grambank": gu.grambank_data.get_file_ids(),
+            "estimation": {"wals_n_min": wu.N_MIN, "grambank_n_min": gu.N_MIN,
+                           "min_filtered_cpt_coverage": MIN_FILTERED_CPT_COVERAGE}}
+
+
+def get_agent_cache_key(parameter_names, language_stat_filter={}, active_wals_cpt=None, **agent_options):
+    """ hash of what a GeneralAgent depends on, None when it cannot be cached. """
+    cpt_ids = get_agent_cpt_ids(active_wals_cpt)
+    if cpt_ids is None:
+        return None
+    key = {"format": AGENT_FILE_FORMAT,
+           "parameter_names": list(parameter_names),
+           "language_stat_filter": {k: sorted(str(v) for v in values) if isinstance(values, (list, set, tuple))
+                                    else str(values) for k, values in language_stat_filter.items()},
+           "agent_options": agent_options,
+           "cpt_ids": cpt_ids,
+           "data_ids": get_agent_data_ids()}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def evict_agent_cache(cache_folder, max_size=MAX_AGENT_CACHE_SIZE):
+    """ removes the least recently used agent files of cache_folder until their total size is at most max_size. """
+    entries = []
+    for filename in os.listdir(cache_folder):
+        if filename.endswith(".npz"):
+            try:
+                stat = os.stat(os.path.join(cache_folder, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, filename in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_folder, filename))
+            total_size -= size
+        except OSError:
+            # already removed by another session
+            pass
+
+
+def get_cached_general_agent(name, parameter_names=[], language_stat_filter={}, active_wals_cpt=None,
+                             cache_folder=None, verbose=False, **agent_options):
+    """ GeneralAgent(name, parameter_names, language_stat_filter, active_wals_cpt, **agent_options) loaded from the
+    agent cache, or created and saved in the cache when not found. agent_options are the other GeneralAgent arguments
+    (filter_wals_cpt, filter_grambank_cpt, history_mode, max_neighbors...).
+    Agents created with an active_wals_cpt without stable id are not cached. Agents are cached by their CPTs and data
+    tables ids: a rebuilt table creates the agent again. The cache is limited to MAX_AGENT_CACHE_SIZE bytes."""
+    key = get_agent_cache_key(parameter_names, language_stat_filter, active_wals_cpt, **agent_options)
+    if key is None:
+        return GeneralAgent(name, parameter_names=parameter_names, language_stat_filter=language_stat_filter,
+                            active_wals_cpt=active_wals_cpt, verbose=verbose, **agent_options)
+    if cache_folder is None:
+        cache_folder = os.path.join(resolve_data_root("external_data"), AGENT_CACHE_FOLDER)
+    path = os.path.join(cache_folder, key + ".npz")
+    if os.path.isfile(path):
+        try:
+            agent = GeneralAgent.load(path, verbose=verbose)
+            agent.name = name
+            # the modification time of an agent file is its last use (see evict_agent_cache)
+            os.utime(path)
+            return agent
+        except (OSError, ValueError, KeyError) as e:
+            print("Agent cache: {} could not be loaded ({}), creating the agent again.".format(path, e))
+    agent = GeneralAgent(name, parameter_names=parameter_names, language_stat_filter=language_stat_filter,
+                         active_wals_cpt=active_wals_cpt, verbose=verbose, **agent_options)
+    os.makedirs(cache_folder, exist_ok=True)
+    # written under a temporary name first, sessions loading the same agent never read a partial file
+    temporary_path = "{}.{}.tmp".format(path, os.getpid())
+    agent.save(temporary_path)
+    os.replace(temporary_path, path)
+    evict_agent_cache(cache_folder)
+    if verbose:
+        print("Agent cache: agent {} saved in {}".format(name, path))
+    return agent
@@ -19,51 +19,40 @@ import csv
 import pandas as pd
 import numpy as np
 from libs import utils as u
+from libs import cpt_utils as cu
+from libs.data_registry import LazyDataRegistry
+from libs.language_index import language_indexes
 from pathlib import Path
 
 # GLOBAL VARIABLES
-try:
-    with open("../external_data/grambank_derived/grambank_pname_by_pid.json", "r", encoding='utf-8') as f:
-        grambank_pname_by_pid = json.load(f)
-    with open("../external_data/grambank_derived/grambank_pid_by_pname.json", "r", encoding='utf-8') as f:
-        grambank_pid_by_pname = json.load(f)
-    with open("../external_data/grambank_derived/grambank_param_value_dict.json", "r", encoding='utf-8') as f:
-        grambank_param_value_dict = json.load(f)
-    with open("../external_data/grambank_derived/grambank_language_by_lid.json", "r", encoding='utf-8') as f:
-        grambank_language_by_lid = json.load(f)
-    with open("../external_data/grambank_derived/grambank_pvalues_by_language.json", "r", encoding='utf-8') as f:
-        grambank_pvalues_by_language = json.load(f)
-    with open("../external_data/grambank_derived/parameter_id_by_value_id.json", "r", encoding='utf-8') as f:
-        parameter_id_by_value_id = json.load(f)
-    with open("../external_data/grambank_derived/grambank_vname_by_vid.json", "r", encoding='utf-8') as f:
-        grambank_vname_by_vid = json.load(f)
-    with open("../external_data/grambank_derived/grambank_language_id_by_vid.json", "r", encoding='utf-8') as f:
-        grambank_language_id_by_vid = json.load(f)
-
-    cpt = pd.read_json("../external_data/grambank_derived/grambank_vid_conditional_probability.json")
-except FileNotFoundError:
-    with open("./external_data/grambank_derived/grambank_pname_by_pid.json", "r", encoding='utf-8') as f:
-        grambank_pname_by_pid = json.load(f)
-    with open("./external_data/grambank_derived/grambank_pid_by_pname.json", "r", encoding='utf-8') as f:
-        grambank_pid_by_pname = json.load(f)
-    with open("./external_data/grambank_derived/grambank_param_value_dict.json", "r", encoding='utf-8') as f:
-        grambank_param_value_dict = json.load(f)
-    with open("./external_data/grambank_derived/grambank_language_by_lid.json", "r", encoding='utf-8') as f:
-        grambank_language_by_lid = json.load(f)
-    with open("./external_data/grambank_derived/grambank_pvalues_by_language.json", "r", encoding='utf-8') as f:
-        grambank_pvalues_by_language = json.load(f)
-    with open("./external_data/grambank_derived/parameter_id_by_value_id.json", "r", encoding='utf-8') as f:
-        parameter_id_by_value_id = json.load(f)
-    with open("./external_data/grambank_derived/grambank_vname_by_vid.json", "r", encoding='utf-8') as f:
-        grambank_vname_by_vid = json.load(f)
-    with open("./external_data/grambank_derived/grambank_language_id_by_vid.json", "r", encoding='utf-8') as f:
-        grambank_language_id_by_vid = json.load(f)
-    cpt = pd.read_json("./external_data/grambank_derived/grambank_vid_conditional_probability.json")
+# Grambank lookup tables are loaded on first access through the grambank_data registry.
+# They are also available as module attributes (gu.grambank_language_by_lid, gu.cpt...), see __getattr__ below.
+grambank_data = LazyDataRegistry("external_data/grambank_derived", {
+    "grambank_pname_by_pid": "grambank_pname_by_pid.json",
+    "grambank_pid_by_pname": "grambank_pid_by_pname.json",
+    "grambank_param_value_dict": "grambank_param_value_dict.json",
+    "grambank_language_by_lid": "grambank_language_by_lid.json",
+    "grambank_pvalues_by_language": "grambank_pvalues_by_language.json",
+    "parameter_id_by_value_id": "parameter_id_by_value_id.json",
+    "grambank_vname_by_vid": "grambank_vname_by_vid.json",
+    "grambank_language_id_by_vid": "grambank_language_id_by_vid.json",
+    "grambank_lid_by_family": "grambank_lid_by_family.json",
+    "cpt": lambda data: cu.load_cpt(data.path("grambank_vid_conditional_probability.json")),
+})
+
+
+def __getattr__(name):
+    # module-level access to the lazy tables; once loaded, a table becomes a regular module attribute
+    if grambank_data.has_table(name):
+        value = getattr(grambank_data, name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
 
 def build_vname_by_vid():
     grambank_vname_by_vid = {}
-    for pid in grambank_param_value_dict.keys():
-        for vid, valueinfo in grambank_param_value_dict[pid]["pvalues"].items():
+    for pid in grambank_data.grambank_param_value_dict.keys():
+        for vid, valueinfo in grambank_data.grambank_param_value_dict[pid]["pvalues"].items():
             grambank_vname_by_vid[vid] = valueinfo["vname"]
 
     with open("../external_data/grambank_derived/grambank_vname_by_vid.json", "w", encoding='utf-8') as f:
@@ -76,16 +65,17 @@ def get_grambank_language_data_by_id_or_name(language_id, language_name=None):
     language_id_found = False
     if language_id is None and language_name is not None:
         # check if lname is in grambank
-        selected_language_id, language_id_found = next(((lid, True) for lid in grambank_language_by_lid if grambank_language_by_lid[lid]["name"] == language_name), (None, False))
+        selected_language_id = language_indexes.grambank.get_id(language_name)
+        language_id_found = selected_language_id is not None
     elif language_id is not None and language_name is None:
-        language_id_found = language_id in grambank_language_by_lid
+        language_id_found = language_id in grambank_data.grambank_language_by_lid
         selected_language_id = language_id
     if language_id_found:
         result_dict = {}
-        pvalues = grambank_pvalues_by_language[selected_language_id]
+        pvalues = grambank_data.grambank_pvalues_by_language[selected_language_id]
         for pvalue in pvalues:
             result_dict[pvalue[:5]] = {
-                "parameter": grambank_pname_by_pid[pvalue[:5]],
+                "parameter": grambank_data.grambank_pname_by_pid[pvalue[:5]],
                 "value": pvalue,
                 "vid": pvalue,
             }
@@ -95,23 +85,20 @@ def get_grambank_language_data_by_id_or_name(language_id, language_name=None):
         return {}
 
 
-def compute_grambank_cp_matrix_from_general_data(pid1, pid2):
-    """ creates the conditional probability matrix P(pid1 | pid2) and returns it as  df"""
+def compute_grambank_cp_matrix_from_general_data(pid1, pid2, active_grambank_cpt=None):
+    """ creates the conditional probability matrix P(pid1 | pid2) and returns it as  df
+    active_grambank_cpt defaults to the Grambank CPT computed over all languages."""
+    if active_grambank_cpt is None:
+        active_grambank_cpt = grambank_data.cpt
 
-    if pid1 in grambank_param_value_dict and pid2 in grambank_param_value_dict:
+    if pid1 in grambank_data.grambank_param_value_dict and pid2 in grambank_data.grambank_param_value_dict:
 
-        pid1_list = list(grambank_param_value_dict[pid1]["pvalues"].keys())
-        pid2_list = list(grambank_param_value_dict[pid2]["pvalues"].keys())
+        pid1_list = list(grambank_data.grambank_param_value_dict[pid1]["pvalues"].keys())
+        pid2_list = list(grambank_data.grambank_param_value_dict[pid2]["pvalues"].keys())
 
-        # P1 GIVEN P2 DF
-        # keep only p1 on rows
-        filtered_cpt_p1 = cpt.loc[pid1_list]
-        # keep only p2 on columns
-        filtered_cpt_p1_given_p2 = filtered_cpt_p1[pid2_list]
-        # normalization: all the columns of each row (primary event) should sum up to 1
-        filtered_cpt_p2_given_p1_normalized = filtered_cpt_p1_given_p2.apply(u.normalize_column, axis=0)
-
-        return filtered_cpt_p2_given_p1_normalized
+        # P1 GIVEN P2: p1 on rows, given p2 on columns, columns normalized to sum up to 1 (cached per CPT)
+        block = cu.get_normalized_block(active_grambank_cpt, pid1_list, pid2_list, pid2, pid1)
+        return cu.normalized_block_to_df(block)
     else:
         # not grambank pids
         return None
@@ -119,12 +106,12 @@ def compute_grambank_cp_matrix_from_general_data(pid1, pid2):
 
 def compute_grambank_param_distribution(pid, lids_list=["ALL"]):
     if lids_list == ["ALL"]:
-        available_lids = list(grambank_language_by_lid.keys())
+        available_lids = list(grambank_data.grambank_language_by_lid.keys())
     else:
         available_lids = lids_list
-    vids = list(grambank_param_value_dict[pid]["pvalues"].keys())
+    vids = list(grambank_data.grambank_param_value_dict[pid]["pvalues"].keys())
     param_distribution = {key: 0 for key in vids}
-    for lid, pvalues in grambank_pvalues_by_language.items():
+    for lid, pvalues in grambank_data.grambank_pvalues_by_language.items():
         if lid in available_lids:
             for pvalue in pvalues:
                 if pvalue in param_distribution.keys():
@@ -151,7 +138,7 @@ def compute_grambank_conditional_de_proba(vid_a, vid_b, language_lids, return_co
     a_and_b = 0          # how many have *both* values ?
 
     for lid in language_lids:
-        values = grambank_pvalues_by_language[lid]
+        values = grambank_data.grambank_pvalues_by_language[lid]
         has_b = vid_b in values
         if has_b:
             b_count += 1
@@ -174,58 +161,99 @@ def compute_grambank_conditional_de_proba(vid_a, vid_b, language_lids, return_co
     else:
         return p_hat
 
-def build_grambank_conditional_probability_table(language_filter=None):
+def get_grambank_cpt_language_lids(language_filter=None, exclude_lids=None):
+    """ list of language ids used to compute a Grambank CPT.
+    language_filter restricts languages by family and macroarea ({"family": [...], "macroarea": [...]}),
+    exclude_lids removes languages from the selection."""
+    language_filter = language_filter or {}
+    if language_filter:
+        language_lids = set()
+        for family in language_filter.get("family", []):
+            language_lids |= set(grambank_data.grambank_lid_by_family.get(family, []))
+        macroareas = set(language_filter.get("macroarea", []))
+        if macroareas:
+            language_lids |= set(lid for lid, ldata in grambank_data.grambank_language_by_lid.items()
+                                 if ldata.get("macroarea", None) in macroareas)
+    else:
+        language_lids = set(grambank_data.grambank_language_by_lid.keys())
+    if exclude_lids:
+        language_lids -= set(exclude_lids)
+    return sorted(language_lids)
+
+
+def compute_grambank_conditional_probability_table_from_counts(cooccurrence, vid_list):
     """
-    CPT of P(vid_a | vid_b) for every pair of Grambank values.
-    Cells with insufficient evidence are np.nan.
+    Applies the Grambank estimation rules to a co-occurrence count matrix (see cpt_utils),
+    same estimates as compute_grambank_conditional_de_proba:
+    M[a,b] = (k_A_and_B + ALPHA) / (n_B + ALPHA + BETA), NaN if n_B == 0, n_B < N_MIN or k_A_and_B < K_MIN.
+    The trust matrix stores k_A_and_B.
+    Returns (cpt, cpt_trust) DataFrames.
     """
-    language_filter = language_filter or {}
+    cpt_array, _ = cu.compute_conditional_probability_arrays(cooccurrence,
+                                                              n_min=N_MIN,
+                                                              k_min=K_MIN,
+                                                              alpha=ALPHA,
+                                                              beta=BETA)
+    cpt, cpt_trust = cu.cpt_arrays_to_df(cpt_array, np.asarray(cooccurrence, dtype=int), vid_list)
+    return cpt, cpt_trust
+
 
-    # ---------------------------------------------------------------------
-    # 1. which languages to keep?  (simple: no family filter for now)
-    # ---------------------------------------------------------------------
-    language_lids = list(grambank_language_by_lid.keys())
-    # if you need the same family/subfamily/genus filter logic, paste it here
+# global co-occurrence counts over all Grambank languages, computed once per process
+grambank_cooccurrence_counts = {}
 
-    # ---------------------------------------------------------------------
-    # 2. value IDs to iterate over
-    # ---------------------------------------------------------------------
-    vid_list = list(parameter_id_by_value_id.keys())
+def get_grambank_cooccurrence_counts():
+    if "all" not in grambank_cooccurrence_counts:
+        grambank_cooccurrence_counts["all"] = cu.CooccurrenceCounts(grambank_data.grambank_pvalues_by_language,
+                                                                    sorted(grambank_data.grambank_language_by_lid.keys()),
+                                                                    list(grambank_data.parameter_id_by_value_id.keys()))
+    return grambank_cooccurrence_counts["all"]
 
-    # ---------------------------------------------------------------------
-    # 3. populate DataFrame
-    # ---------------------------------------------------------------------
-    cpt = pd.DataFrame(index=vid_list, columns=vid_list, dtype=float)
-    cpt_trust = pd.DataFrame(index=vid_list, columns=vid_list, dtype=int)
 
-    total = len(vid_list)
+def get_grambank_cpt_provider(max_cached=8, cache_folder=None):
+    """ CPTProvider computing Grambank CPTs over any language set, see wals_utils.get_wals_cpt_provider."""
+    if "provider" not in grambank_cooccurrence_counts:
+        grambank_cooccurrence_counts["provider"] = cu.CPTProvider("grambank",
+                                                                  get_grambank_cooccurrence_counts(),
+                                                                  compute_grambank_conditional_probability_table_from_counts,
+                                                                  max_cached=max_cached,
+                                                                  cache_folder=cache_folder)
+    return grambank_cooccurrence_counts["provider"]
 
-    for i, vid_a in enumerate(vid_list, 1):
-        print(f"row {i}/{total}  value={vid_a}")
-        for vid_b in vid_list:
-            # ---- old computation, now returns both p_hat and counts ----
-            p_hat, b_count, a_and_b = compute_grambank_conditional_de_proba(vid_a, vid_b, language_lids, return_counts=True)  # p_hat may be None
 
-            # --- probability table --------------------------------------
-            cpt.at[vid_a, vid_b] = np.nan if p_hat is None else p_hat
+def compute_grambank_conditional_probability_table(language_filter=None, exclude_lids=None):
+    """ Grambank CPT over the languages selected by language_filter and exclude_lids,
+    computed from the global co-occurrence counts. Returns (cpt, cpt_trust) DataFrames."""
+    language_lids = get_grambank_cpt_language_lids(language_filter, exclude_lids)
+    return get_grambank_cpt_provider().get_cpt(language_lids)
 
-            # --- trust table  (choose your notion of support) -----------
-            cpt_trust.at[vid_a, vid_b] = a_and_b  # or a_and_b, or both
 
-    # ---------------------------------------------------------------------
-    # 4. save
-    # ---------------------------------------------------------------------
+def build_grambank_conditional_probability_table(language_filter=None, exclude_lids=None):
+    """
+    CPT of P(vid_a | vid_b) for every pair of Grambank values.
+    Cells with insufficient evidence are np.nan.
+    language_filter ({"family": [...], "macroarea": [...]}) and exclude_lids restrict the languages used.
+    """
+    language_filter = language_filter or {}
+
+    cpt, cpt_trust = compute_grambank_conditional_probability_table(language_filter, exclude_lids)
+
     out_dir = Path("../external_data/grambank_derived")
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    base = "grambank_vid_conditional_probability_new"  # or "grambank_vid_conditional_probability"
+    suffix = []
+    for key in ["family", "macroarea"]:
+        if language_filter.get(key, []):
+            suffix.append(key + "_" + "-".join(language_filter[key]))
+    if exclude_lids:
+        suffix.append("languages_excluded_hash_{}".format(u.generate_hash_from_list(exclude_lids)))
+    base = "grambank_vid_conditional_probability_new" + ("_" + "_".join(suffix) if suffix else "")
 
     cpt.to_json(out_dir / f"{base}.json")
     cpt_trust.to_json(out_dir / f"{base}_trust.json")
     print("Wrote", out_dir / f"{base}.json")
     print("Wrote", out_dir / f"{base}_trust.json")
     return cpt, cpt_trust
-        
+
 # def compute_grambank_conditional_de_proba(vid_a, vid_b, filtered_language_lid=[]):
 #     """
 #     compute the conditional probability p(vid_a | vid_b)
@@ -383,7 +411,7 @@ def build_grambank_param_value_dict():
         else:
             grambank_param_value_dict[item["Parameter_ID"]] = {
                 "pid": item["Parameter_ID"],
-                "pname": grambank_pname_by_pid[item["Parameter_ID"]],
+                "pname": grambank_data.grambank_pname_by_pid[item["Parameter_ID"]],
                 "pvalues":{
                     item["ID"]: {
                         "vid": item["ID"],
@@ -429,7 +457,7 @@ def build_vids_by_lid():
 
 def build_lid_by_family():
     lid_by_family = {}
-    for lid, ldata in grambank_language_by_lid.items():
+    for lid, ldata in grambank_data.grambank_language_by_lid.items():
         if ldata["family"] not in lid_by_family.keys():
             lid_by_family[ldata["family"]] = [lid]
         else:
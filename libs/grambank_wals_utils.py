@@ -13,26 +13,38 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from libs import utils as u, wals_utils as wu, grambank_utils as gu
+from libs import utils as u, wals_utils as wu, grambank_utils as gu, cpt_utils as cu
+from libs.data_registry import LazyDataRegistry, resolve_data_root
+from libs.language_index import language_indexes
+import os
+import numpy as np
+from scipy import sparse
 import pandas as pd, json
 
 # GLOBAL VARIBALES
-try:
-    prefix = "./"
-    grambank_given_wals_cpt = pd.read_json(prefix + "external_data/grambank_given_wals_cpt.json")
-    grambank_given_wals_cpt.index = grambank_given_wals_cpt.index.astype(str)
-    grambank_given_wals_cpt.columns = grambank_given_wals_cpt.columns.astype(str)
-    wals_given_grambank_cpt = pd.read_json(prefix + "external_data/wals_given_grambank_cpt.json")
-    wals_given_grambank_cpt.index = wals_given_grambank_cpt.index.astype(str)
-    wals_given_grambank_cpt.columns = wals_given_grambank_cpt.columns.astype(str)
-except FileNotFoundError:
-    prefix = "../"
-    grambank_given_wals_cpt = pd.read_json(prefix + "external_data/grambank_given_wals_cpt.json")
-    grambank_given_wals_cpt.index = grambank_given_wals_cpt.index.astype(str)
-    grambank_given_wals_cpt.columns = grambank_given_wals_cpt.columns.astype(str)
-    wals_given_grambank_cpt = pd.read_json(prefix + "external_data/wals_given_grambank_cpt.json")
-    wals_given_grambank_cpt.index = wals_given_grambank_cpt.index.astype(str)
-    wals_given_grambank_cpt.columns = wals_given_grambank_cpt.columns.astype(str)
+# WALS given Grambank and Grambank given WALS CPTs, in sparse format (see cpt_utils.SparseCPT),
+# loaded on first access. They are built from the languages present in both datasets (joined by glottocode),
+# see build_wals_grambank_cross_cpts.
+cross_data = LazyDataRegistry("external_data", {
+    "wals_given_grambank_cpt": lambda data: load_cross_cpt(data, "wals_given_grambank_cpt"),
+    "grambank_given_wals_cpt": lambda data: load_cross_cpt(data, "grambank_given_wals_cpt"),
+})
+
+# Robust-estimation hyper-parameters of the cross-dataset CPTs (same as Grambank, the joined sample is small)
+N_MIN  = 5      # keep edge only if the given value is attested in ≥ N_MIN joined languages
+K_MIN  = 2      # …and both values in ≥ K_MIN joined languages
+ALPHA  = 1.0    # Beta(α,β) prior  — Laplace smoothing (α=β=1)
+BETA   = 1.0
+
+
+def __getattr__(name):
+    # module-level access to the lazy cross-dataset CPTs
+    if cross_data.has_table(name):
+        value = getattr(cross_data, name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
 
 # FUNCTIONS
 
@@ -45,16 +57,12 @@ def compute_grambank_given_wals_cp(pid, ppk):
         ppk_list = wu.domain_elements_pk_by_parameter_pk[ppk]
         pid_list = list(gu.grambank_param_value_dict[pid]["pvalues"].keys())
 
-        # Grambank GIVEN WALS DF
-        # keep only ppk_list on lines (primary)
-        filtered_cpt_p2_given_p1 = grambank_given_wals_cpt.loc[pid_list]
-        # keep only pid_list on columns (secondary)
-        filtered_cpt_p2_given_p1 = filtered_cpt_p2_given_p1[ppk_list]
-        # normalization: all the columns of each row (primary event) should sum up to 1
-        filtered_cpt_p2_given_p1_normalized = filtered_cpt_p2_given_p1.apply(u.normalize_column, axis=0)
-
-        if filtered_cpt_p2_given_p1.max().max() != 0:
-            return filtered_cpt_p2_given_p1_normalized
+        # Grambank GIVEN WALS: pid values on rows, given ppk values on columns,
+        # columns normalized to sum up to 1 (cached per CPT)
+        block = cu.get_normalized_block(cross_data.grambank_given_wals_cpt, pid_list, ppk_list, ppk, pid)
+        # no edge when no cell of the block is supported
+        if block[1] > 0:
+            return cu.normalized_block_to_df(block)
         else:
             return None
     else:
@@ -69,15 +77,12 @@ def compute_wals_given_grambank_cp(ppk, pid):
         ppk_list = list(wu.domain_elements_pk_by_parameter_pk[ppk])
         pid_list = list(gu.grambank_param_value_dict[pid]["pvalues"].keys())
 
-        # WALS GIVEN Grambank DF
-        # keep only p1 on lines (primary)
-        filtered_cpt_p2_given_p1 = wals_given_grambank_cpt.loc[ppk_list]
-        # keep only p2 on columns (secondary)
-        filtered_cpt_p2_given_p1 = filtered_cpt_p2_given_p1[pid_list]
-        # normalization: all the columns of each row (primary event) should sum up to 1
-        filtered_cpt_p2_given_p1_normalized = filtered_cpt_p2_given_p1.apply(u.normalize_column, axis=0)
-        if filtered_cpt_p2_given_p1.max().max() != 0:
-            return filtered_cpt_p2_given_p1_normalized
+        # WALS GIVEN Grambank: ppk values on rows, given pid values on columns,
+        # columns normalized to sum up to 1 (cached per CPT)
+        block = cu.get_normalized_block(cross_data.wals_given_grambank_cpt, ppk_list, pid_list, pid, ppk)
+        # no edge when no cell of the block is supported
+        if block[1] > 0:
+            return cu.normalized_block_to_df(block)
         else:
             return None
     else:
@@ -120,34 +125,101 @@ def get_pvalue_name_from_value_code(code):
         return wu.get_careful_name_of_de_pk(code)
 
 def get_language_family_by_language_name(lname):
-    if lname in wu.language_pk_id_by_name.keys():
-        lid = wu.language_pk_id_by_name[lname]["id"]
-        return wu.language_info_by_id[lid].get("family", None)
+    """ family of a WALS language, or of a Grambank language if not in WALS. None if not found."""
+    if language_indexes.wals.get_id(lname) is not None:
+        return language_indexes.wals.get_family_by_name(lname)
     else:
-        try:
-            lid = next(lid
-                       for lid in gu.grambank_language_by_lid.keys()
-                       if gu.grambank_language_by_lid[lid]["name"] == lname)
-            try:
-                family = gu.grambank_language_by_lid[lid]["family"]
-            except KeyError:
-                print("Error in get_language_family_by_language_name")
-                print("lid {} not in grambank_language_by_lid or no family mentioned in that entry".format(lid))
-                return None
-            return gu.grambank_language_by_lid[lid]["family"]
-        except StopIteration:
-            return None
-
-
-def build_wals_given_grambank_cpt_df():
-    wals_cpt = wu.cpt
-    grambank_cpt = gu.cpt
-    wals_given_grambank_cpt = pd.DataFrame(float(0), index=wals_cpt.index, columns=grambank_cpt.columns)
-    wals_given_grambank_cpt.to_json("../external_data/wals_given_grambank_cpt.json")
-
-
-def build_grambank_given_wals_cpt_df():
-    wals_cpt = wu.cpt
-    grambank_cpt = gu.cpt
-    grambank_given_wals_cpt = pd.DataFrame(float(0), index=grambank_cpt.index, columns=wals_cpt.columns)
-    grambank_given_wals_cpt.to_json("../external_data/grambank_given_wals_cpt.json")
\ No newline at end of file
+        return language_indexes.grambank.get_family_by_name(lname)
+
+
+def get_wals_grambank_joined_languages():
+    """ (WALS language pk, Grambank language id) pairs of the languages present in both datasets,
+    joined by glottocode. A glottocode shared by several WALS languages gives one pair for each."""
+    languages = pd.read_csv(os.path.join(resolve_data_root("external_data/wals-master/cldf"), "languages.csv"),
+                            usecols=["ID", "Glottocode"], keep_default_na=False)
+    grambank_lid_by_glottocode = {ldata.get("glottocode", lid): lid for lid, ldata in gu.grambank_language_by_lid.items()}
+    joined_languages = []
+    for wals_id, glottocode in zip(languages["ID"], languages["Glottocode"]):
+        if glottocode in grambank_lid_by_glottocode and wals_id in wu.language_pk_by_id:
+            joined_languages.append((str(wu.language_pk_by_id[wals_id]), grambank_lid_by_glottocode[glottocode]))
+    return joined_languages
+
+
+def load_curated_cross_cp(json_path, parameter_by_row_value):
+    """ hand-edited cells of a dense cross-dataset CPT (see pages/wgb_cp.py), as {(row value, column value): p}.
+    For each column, every value of an edited row parameter gets a cell (0 if not edited).
+    Columns edited for all rows (uniform defaults) are ignored."""
+    if not os.path.isfile(json_path):
+        return {}
+    dense = pd.read_json(json_path)
+    dense.index = dense.index.astype(str)
+    dense.columns = dense.columns.astype(str)
+    values_by_parameter = {}
+    for value in dense.index:
+        values_by_parameter.setdefault(parameter_by_row_value.get(value, None), []).append(value)
+    curated = {}
+    for column in dense.columns:
+        edited = dense.index[dense[column].fillna(0) != 0]
+        if len(edited) == 0 or len(edited) == len(dense.index):
+            continue
+        for parameter in set(parameter_by_row_value.get(value, None) for value in edited):
+            for value in values_by_parameter[parameter]:
+                curated[(value, column)] = float(dense.at[value, column]) if value in edited else 0.0
+    return curated
+
+
+def compute_cross_cpt(row_incidence, column_incidence, row_values, column_values, curated=None):
+    """ sparse CPT of P(row value | column value) over the joined languages (rows of both incidence matrices),
+    curated cells override computed ones."""
+    cooccurrence = row_incidence.T @ column_incidence
+    n_b = np.asarray(column_incidence.sum(axis=0)).ravel()
+    matrix = cu.compute_sparse_conditional_probabilities(cooccurrence, n_b, N_MIN, K_MIN, ALPHA, BETA)
+    if curated:
+        cells = dict(zip(zip(*matrix.nonzero()), matrix.data))
+        row_index = {str(v): i for i, v in enumerate(row_values)}
+        column_index = {str(v): j for j, v in enumerate(column_values)}
+        for (row_value, column_value), p in curated.items():
+            if row_value in row_index and column_value in column_index:
+                cells[(row_index[row_value], column_index[column_value])] = p
+        rows, cols = zip(*cells.keys()) if cells else ((), ())
+        matrix = sparse.csr_matrix((np.array(list(cells.values()), dtype=float), (rows, cols)), shape=matrix.shape)
+    return cu.SparseCPT(matrix, row_values, column_values)
+
+
+def build_wals_grambank_cross_cpts():
+    """ builds the WALS given Grambank and Grambank given WALS sparse CPTs from the languages of both datasets,
+    with the hand-edited cells of the former dense CPT files (if present), and stores them in external_data."""
+    joined_languages = get_wals_grambank_joined_languages()
+    print("build_wals_grambank_cross_cpts: {} joined languages".format(len(joined_languages)))
+    wals_values = [str(de_pk) for de_pk in wu.domain_element_by_pk.keys()]
+    grambank_values = [str(vid) for vid in gu.parameter_id_by_value_id.keys()]
+    wals_incidence = cu.build_incidence_matrix(wu.domain_elements_by_language,
+                                               [wals_pk for wals_pk, _ in joined_languages], wals_values)
+    grambank_incidence = cu.build_incidence_matrix(gu.grambank_pvalues_by_language,
+                                                   [lid for _, lid in joined_languages], grambank_values)
+
+    external_data = cross_data.root
+    cross_cpts = {
+        "wals_given_grambank_cpt": compute_cross_cpt(
+            wals_incidence, grambank_incidence, wals_values, grambank_values,
+            load_curated_cross_cp(os.path.join(external_data, "wals_given_grambank_cpt.json"),
+                                  {str(k): str(v) for k, v in wu.param_pk_by_de_pk.items()})),
+        "grambank_given_wals_cpt": compute_cross_cpt(
+            grambank_incidence, wals_incidence, grambank_values, wals_values,
+            load_curated_cross_cp(os.path.join(external_data, "grambank_given_wals_cpt.json"),
+                                  gu.parameter_id_by_value_id)),
+    }
+    for name, cross_cpt in cross_cpts.items():
+        folder = os.path.join(external_data, name)
+        cu.save_sparse_cpt(cross_cpt, folder)
+        cu.register_cpt(cross_cpt, cu.get_sparse_cpt_id(folder))
+        cross_data.unload(name)
+        print("{}: {} supported cells stored in {}".format(name, cross_cpt.matrix.nnz, folder))
+    return cross_cpts
+
+
+def load_cross_cpt(data, name):
+    if not os.path.isdir(data.path(name)):
+        print("{} not found in the file system, building it.".format(name))
+        return build_wals_grambank_cross_cpts()[name]
+    return cu.load_sparse_cpt(data.path(name))
@@ -1,10 +1,10 @@
 import copy
 import json
 import stat
-from os import listdir, mkdir
-from os.path import isfile, join
+from os import mkdir
 import time
 from libs import utils, stats, graphs_utils as gu
+from libs import questionnaire_registry as qr
 from collections import OrderedDict
 import pandas as pd
 
@@ -14,27 +14,15 @@ RPKS = ["AGENT", "PATIENT", "OBLIQUE", "POSSESSOR", "POSSESSEE"]
 # delimiters = json.load(open("./data/delimiters.json", encoding='utf-8'))
 
 def consolidate_cq_transcriptions(transcriptions_list, language, delimiters):
-    try:
-        cq_folder = "./questionnaires"
-        cq_json_list = [f for f in listdir(cq_folder) if isfile(join(cq_folder, f)) and f.endswith(".json")]
-    except FileNotFoundError:
-        cq_folder = "../questionnaires"
-        cq_json_list = [f for f in listdir(cq_folder) if isfile(join(cq_folder, f)) and f.endswith(".json")]
-    cq_id_dict = {}
-    # preparing the list of available cqs
-    for cq in cq_json_list:
-        # load the cq json file
-        cq_json = json.load(open(join(cq_folder, cq), encoding='utf-8'))
-        uid = cq_json["uid"]
-        cq_content = json.load(open(join(cq_folder, cq), encoding='utf-8'))
-        cq_id_dict[uid] = {"filename": cq, "content": cq_content}
+    # available cqs, parsed once per process by the questionnaire registry
+    available_cq_uids = set(qr.questionnaires.uids())
     # filtering out transcriptions that don't have a known cq_uid
     filtered_recordings = {}
 
     for r in transcriptions_list:
         cq_uid = r["cq_uid"]
         #print("cq_uid: ", cq_uid)
-        if cq_uid in cq_id_dict.keys():
+        if cq_uid in available_cq_uids:
             filtered_recordings[cq_uid] = copy.deepcopy(r)
             #print("transcription {} has a corresponding questionnaire".format(cq_uid))
         else:
@@ -48,7 +36,7 @@ def consolidate_cq_transcriptions(transcriptions_list, language, delimiters):
     index_counter = 0
     for recording_cq_uid, recording in filtered_recordings.items():
         # open corresponding cq
-        cq = cq_id_dict[recording_cq_uid]["content"]
+        cq = qr.questionnaires.get_by_uid(recording_cq_uid)
         for item in cq["dialog"]:
             if cq["dialog"][item]["speaker"] == "A":
                 speaker = "A"
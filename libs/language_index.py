@@ -0,0 +1,111 @@
+# Copyright (C) 2024 Sebastien CHRISTIAN, University of French Polynesia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import re
+import csv
+import unicodedata
+import marisa_trie
+from libs.data_registry import LazyDataRegistry
+
+# Language indexes of WALS, Grambank and Glottolog: name -> id, normalized name -> id, id -> family,
+# and prefix search over normalized names (marisa-trie). Each index is built once, on first access:
+#   language_indexes.wals, language_indexes.grambank, language_indexes.glottolog
+
+
+def normalize_language_name(name):
+    """ lower case, without diacritics and punctuation, single spaces: "Kati (in Afghanistan)" -> "kati in afghanistan" """
+    name = unicodedata.normalize("NFKD", str(name))
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    name = re.sub(r"[\W_]+", " ", name.casefold())
+    return name.strip()
+
+
+class LanguageIndex:
+    """ entries are (id, name, family) tuples. When several languages share a name, the first one is kept."""
+    def __init__(self, entries):
+        self.id_by_name = {}
+        self.id_by_normalized_name = {}
+        self.names_by_normalized_name = {}
+        self.family_by_id = {}
+        for language_id, name, family in entries:
+            self.id_by_name.setdefault(name, language_id)
+            normalized = normalize_language_name(name)
+            self.id_by_normalized_name.setdefault(normalized, language_id)
+            names = self.names_by_normalized_name.setdefault(normalized, [])
+            if name not in names:
+                names.append(name)
+            if family is not None:
+                self.family_by_id.setdefault(language_id, family)
+        self.trie = marisa_trie.Trie(list(self.names_by_normalized_name.keys()))
+
+    def get_id(self, name):
+        """ id of the language with that name, or with the same normalized name. None if not found."""
+        if name in self.id_by_name:
+            return self.id_by_name[name]
+        return self.id_by_normalized_name.get(normalize_language_name(name), None)
+
+    def get_family(self, language_id):
+        return self.family_by_id.get(language_id, None)
+
+    def get_family_by_name(self, name):
+        language_id = self.get_id(name)
+        return None if language_id is None else self.get_family(language_id)
+
+    def search(self, prefix, limit=None):
+        """ names whose normalized form starts with the normalized prefix, sorted. """
+        names = []
+        for normalized in self.trie.keys(normalize_language_name(prefix)):
+            names += self.names_by_normalized_name[normalized]
+        names = sorted(names)
+        return names if limit is None else names[:limit]
+
+
+def build_wals_language_index(data):
+    from libs import wals_utils as wu
+    entries = []
+    for name, language in wu.language_pk_id_by_name.items():
+        entries.append((language["id"], name, wu.language_info_by_id.get(language["id"], {}).get("family", None)))
+    return LanguageIndex(entries)
+
+
+def build_grambank_language_index(data):
+    from libs import grambank_utils as gu
+    return LanguageIndex([(lid, language["name"], language.get("family", None))
+                          for lid, language in gu.grambank_language_by_lid.items()])
+
+
+def build_glottolog_language_index(data):
+    """ names of the Glottolog language list used by the pages (glottolog_utils),
+    families from external_data/glottolog/languages.csv when available."""
+    from libs import glottolog_utils as glu
+    family_by_glottocode = {}
+    languages_csv = data.path(os.path.join("glottolog", "languages.csv"))
+    if os.path.isfile(languages_csv):
+        with open(languages_csv, "r", encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+        name_by_glottocode = {row["Glottocode"]: row["Name"] for row in rows}
+        for row in rows:
+            if row["Family_ID"]:
+                family_by_glottocode[row["Glottocode"]] = name_by_glottocode.get(row["Family_ID"], row["Family_ID"])
+    return LanguageIndex([(glottocode, name, family_by_glottocode.get(glottocode, None))
+                          for name, glottocode in glu.GLOTTO_LANGUAGE_LIST.items()])
+
+
+language_indexes = LazyDataRegistry("external_data", {
+    "wals": build_wals_language_index,
+    "grambank": build_grambank_language_index,
+    "glottolog": build_glottolog_language_index,
+})
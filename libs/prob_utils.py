@@ -14,8 +14,10 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import pickle
+import weakref
 from libs import wals_utils as wu
-from collections import deque, defaultdict
+from libs import cpt_utils as cu
+from collections import deque, defaultdict, OrderedDict
 import pandas as pd
 import numpy as np
 import json
@@ -26,59 +28,93 @@ import numpy as np
 import os
 
 
+# Mutual information matrices (parameter x parameter) computed from a potential store, by potential store id
+# (last MAX_CACHED_MUTUAL_INFORMATION_DFS stores)
+MAX_CACHED_MUTUAL_INFORMATION_DFS = 4
+mutual_information_dfs = OrderedDict()
+
+
+def compute_block_mutual_information(potentials, block_sizes):
+    """
+    Mutual information (in bits) between all pairs of parameters, from the block-structured potential matrix
+    (values grouped by parameter, block_sizes values per parameter).
+    The potential block of two parameters is normalized into their joint distribution P_ij, then
+    MI = sum P_ij log2(P_ij / (P_i P_j)). With Z the sum of the block, R its row sums and C its column sums:
+    MI = (sum Phi log2 Phi - sum R log2 R - sum C log2 C) / Z + log2 Z, computed for all blocks at once.
+    NaN potentials count as 0. Blocks with negative potentials get NaN, blocks summing to 0 get 0.
+
+    Returns a (parameters x parameters) numpy array.
+    """
+    Phi = np.nan_to_num(np.asarray(potentials, dtype=float), nan=0.0)
+    starts = np.concatenate([[0], np.cumsum(block_sizes)[:-1]]).astype(int)
+
+    def x_log2_x(x):
+        return np.where(x > 0, x * np.log2(np.where(x > 0, x, 1.0)), 0.0)
+
+    def block_sums(values):
+        return np.add.reduceat(np.add.reduceat(values, starts, axis=0), starts, axis=1)
+
+    R = np.add.reduceat(Phi, starts, axis=1)  # values x parameters: row sums within each column block
+    C = np.add.reduceat(Phi, starts, axis=0)  # parameters x values: column sums within each row block
+    Z = np.add.reduceat(R, starts, axis=0)
+    entropy_terms = block_sums(x_log2_x(Phi)) - np.add.reduceat(x_log2_x(R), starts, axis=0) \
+        - np.add.reduceat(x_log2_x(C), starts, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mutual_info = np.where(Z > 0, entropy_terms / np.where(Z > 0, Z, 1.0) + np.log2(np.where(Z > 0, Z, 1.0)), 0.0)
+    mutual_info = np.maximum(mutual_info, 0.0)
+    mutual_info[block_sums((Phi < 0).astype(float)) > 0] = np.nan
+    return mutual_info
+
+
+def get_mutual_information_df(potential_store=None):
+    """
+    Mutual information between all pairs of parameters of a potential store (default: WALS MRF potentials,
+    wu.wals_data.mrf_potentials), as a DataFrame indexed by parameter pk on both axes.
+    Computed once per potential store (cached by its id), queries are then lookups.
+    """
+    if potential_store is None:
+        potential_store = wu.wals_data.mrf_potentials
+    key = potential_store.potential_id
+    if key in mutual_information_dfs:
+        mutual_information_dfs.move_to_end(key)
+        return mutual_information_dfs[key]
+    parameters = sorted(potential_store.offsets.keys(), key=potential_store.offsets.get)
+    mutual_info = compute_block_mutual_information(potential_store.potentials,
+                                                   [len(potential_store.labels[p]) for p in parameters])
+    mutual_information_dfs[key] = pd.DataFrame(mutual_info, index=parameters, columns=parameters)
+    while len(mutual_information_dfs) > MAX_CACHED_MUTUAL_INFORMATION_DFS:
+        mutual_information_dfs.popitem(last=False)
+    return mutual_information_dfs[key]
+
+
+def get_mutual_information(param_i, param_j, potential_store=None):
+    """ mutual information between two parameters, NaN if one of them has no potential. """
+    mutual_info_df = get_mutual_information_df(potential_store)
+    if str(param_i) not in mutual_info_df.index or str(param_j) not in mutual_info_df.index:
+        return np.nan
+    return float(mutual_info_df.at[str(param_i), str(param_j)])
+
+
 def create_mutual_information__between_parameters_df(parameters):
     parameters = sorted(parameters)
-    potentials_folder = "../data/potentials/"
     """
     Creates a mutual information DataFrame for the given list of parameters.
 
     Parameters:
-    - parameters: list of parameter names.
-    - potentials_folder: string, path to the folder containing pickled potentials.
-    - compute_potential_function_from_general_data: function, computes potential between two parameters.
+    - parameters: list of parameter pks.
+    Potentials are read from the WALS MRF potential store (wu.wals_data.mrf_potentials),
+    mutual information is taken from the cached matrix of all pairs (see get_mutual_information_df).
 
     Returns:
     - mutual_info_df: pandas DataFrame containing mutual information between parameter pairs.
     """
-    # Initialize the mutual information DataFrame
-    mutual_info_df = pd.DataFrame(index=parameters, columns=parameters, dtype=float)
-
-    # Precompute the list of existing potential files for quick lookup
-    potential_files = set(f for f in os.listdir(potentials_folder) if f.endswith('.pkl'))
-
-    # Iterate over all unique pairs of parameters
-    for i, param_i in enumerate(parameters):
-        for j, param_j in enumerate(parameters):
-            if i <= j:
-                # Construct the potential filename
-                filename = f"{param_i}_{param_j}.pkl"
-                filepath = os.path.join(potentials_folder, filename)
-                reverse_filename = f"{param_j}_{param_i}.pkl"
-                reverse_filepath = os.path.join(potentials_folder, reverse_filename)
-
-                # Check if the potential file exists
-                if filename in potential_files:
-                    # Load the potential from the pickle file
-                    potential_df = pd.read_pickle(filepath)
-                elif reverse_filename in potential_files:
-                    # Load the potential from the reverse pickle file
-                    potential_df = pd.read_pickle(reverse_filepath)
-                else:
-                    # Potential file not found, compute it
-                    print(f"Computing missing potential for {param_i} and {param_j}")
-                    potential_df = wu.compute_potential_function_from_general_data(param_i, param_j)
-
-                # Compute the mutual information
-                try:
-                    mi = compute_mutual_information_between_parameters_df(potential_df)
-                    #mi = potential_df.max().max()
-                except ValueError as e:
-                    print(f"Error computing MI for {param_i} and {param_j}: {e}")
-                    mi = np.nan
-                # Store the mutual information in the DataFrame
-                mutual_info_df.loc[param_i, param_j] = mi
-                mutual_info_df.loc[param_j, param_i] = mi  # Symmetric entry
-                print("mutual information {}-{}: {}".format(param_i, param_j, mi))
+    all_mutual_info_df = get_mutual_information_df()
+    missing = [p for p in parameters if str(p) not in all_mutual_info_df.index]
+    for param in missing:
+        print(f"No potential for {param}")
+    mutual_info_df = all_mutual_info_df.reindex(index=[str(p) for p in parameters], columns=[str(p) for p in parameters])
+    mutual_info_df.index = parameters
+    mutual_info_df.columns = parameters
 
     with open("../data/mutual_information_between_parameters_df.pkl", "wb") as f:
         pickle.dump(mutual_info_df, f)
@@ -103,43 +139,69 @@ def compute_mutual_information_between_parameters_df(potential_df):
     if np.any(Phi_ij < 0):
         raise ValueError("Potentials must be non-negative.")
 
-    # Sum of all potential values
-    Z = np.sum(Phi_ij)
-    if Z == 0:
-        return 0.0
-
-    # Normalize to get the joint probability distribution
-    P_ij = Phi_ij / Z
-
-    # Compute marginal distributions
-    P_i = np.sum(P_ij, axis=1)  # Sum over columns for each row
-    P_j = np.sum(P_ij, axis=0)  # Sum over rows for each column
-
-    # Compute mutual information
-    mutual_info = 0.0
-    n_i, n_j = P_ij.shape
-    for k in range(n_i):
-        for l in range(n_j):
-            P_ij_kl = P_ij[k, l]
-            if P_ij_kl > 0:
-                P_i_k = P_i[k]
-                P_j_l = P_j[l]
-                mutual_info += P_ij_kl * np.log2(P_ij_kl / (P_i_k * P_j_l))
+    # the potential as one block, off-diagonal block of a two-parameter matrix
+    n_i, n_j = Phi_ij.shape
+    potentials = np.zeros((n_i + n_j, n_i + n_j))
+    potentials[:n_i, n_i:] = Phi_ij
+    return float(compute_block_mutual_information(potentials, [n_i, n_j])[0, 1])
 
-    return mutual_info
+
+# Sorted edge indexes of the last MAX_CACHED_EDGE_INDEXES CPTs, by CPT id (see get_sorted_edge_index)
+MAX_CACHED_EDGE_INDEXES = 4
+sorted_edge_indexes = OrderedDict()
+
+
+class SortedEdgeIndex:
+    """
+    Edges of a CPT DataFrame, from each row label to the column labels of its non-NaN cells,
+    sorted by decreasing probability (stored as flat arrays with row offsets, like a CSR matrix).
+    The edges of a row above any threshold are a prefix of its slice.
+    """
+    def __init__(self, df):
+        values = df.to_numpy(dtype=float)
+        self.row_index = {label: i for i, label in enumerate(df.index)}
+        self.column_labels = list(df.columns)
+        defined = ~np.isnan(values)
+        order = np.argsort(np.where(defined, -values, np.inf), axis=1, kind="stable")
+        counts = defined.sum(axis=1)
+        self.indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        keep = np.arange(values.shape[1])[np.newaxis, :] < counts[:, np.newaxis]
+        self.columns = order[keep].astype(np.int32)
+        self.probabilities = np.take_along_axis(values, order, axis=1)[keep]
+
+    def edges_above(self, label, threshold):
+        """ [(column label, probability)] of the cells of row label with probability >= threshold, in column order. """
+        i = self.row_index.get(label, None)
+        if i is None:
+            return []
+        start, end = self.indptr[i], self.indptr[i + 1]
+        # probabilities are decreasing: the edges above threshold are the first n_above of the row
+        n_above = int(np.searchsorted(-self.probabilities[start:end], -threshold, side="right"))
+        columns = self.columns[start:start + n_above]
+        in_column_order = np.argsort(columns, kind="stable")
+        return [(self.column_labels[j], p) for j, p in zip(columns[in_column_order].tolist(),
+                                                           self.probabilities[start:start + n_above][in_column_order].tolist())]
+
+
+def get_sorted_edge_index(df):
+    """ SortedEdgeIndex of a CPT, built once per CPT object (see cpt_utils.get_cpt_id: copied or derived
+    CPTs get their own index). The index is dropped with its CPT, or when more recent CPTs fill the cache."""
+    key = cu.get_cpt_id(df)
+    if key in sorted_edge_indexes:
+        sorted_edge_indexes.move_to_end(key)
+        return sorted_edge_indexes[key]
+    sorted_edge_indexes[key] = SortedEdgeIndex(df)
+    weakref.finalize(df, sorted_edge_indexes.pop, key, None)
+    while len(sorted_edge_indexes) > MAX_CACHED_EDGE_INDEXES:
+        sorted_edge_indexes.popitem(last=False)
+    return sorted_edge_indexes[key]
 
 
 def inference_graph_from_cpt_with_belief_propagation(df, starting_vars, threshold):
-    # Step 1: Build the graph from the DataFrame
-    graph = defaultdict(dict)
+    # Step 1: the graph of the CPT is its sorted edge index, built once per CPT, whatever the threshold
+    edge_index = get_sorted_edge_index(df)
     variables = set(df.index).union(set(df.columns))
 
-    for from_var in df.index:
-        for to_var in df.columns:
-            prob = df.at[from_var, to_var]
-            if pd.notna(prob):
-                graph[from_var][to_var] = prob
-
     # Step 2: Initialize beliefs
     belief = {var: 0 for var in variables}
     for var in starting_vars:
@@ -152,17 +214,16 @@ def inference_graph_from_cpt_with_belief_propagation(df, starting_vars, threshol
     # Step 4: Perform belief propagation
     while queue:
         vi = queue.popleft()
-        for vj, prob in graph.get(vi, {}).items():
-            if prob >= threshold:
-                # Calculate the new belief
-                mi_j = belief[vi] * prob
+        for vj, prob in edge_index.edges_above(vi, threshold):
+            # Calculate the new belief
+            mi_j = belief[vi] * prob
+            #print("belief[vi] {} * prob {} = mi_j {}".format(belief[vi], prob, mi_j))
+            if mi_j >= threshold and mi_j > belief.get(vj, 0):
+                #print("vi={}, vj={}".format(vi, vj))
                 #print("belief[vi] {} * prob {} = mi_j {}".format(belief[vi], prob, mi_j))
-                if mi_j >= threshold and mi_j > belief.get(vj, 0):
-                    #print("vi={}, vj={}".format(vi, vj))
-                    #print("belief[vi] {} * prob {} = mi_j {}".format(belief[vi], prob, mi_j))
-                    belief[vj] = mi_j
-                    inference_graph[vi][vj] = mi_j
-                    queue.append(vj)
+                belief[vj] = mi_j
+                inference_graph[vi][vj] = mi_j
+                queue.append(vj)
 
     # Convert inference_graph to a regular dict for readability
     inference_graph = {k: dict(v) for k, v in inference_graph.items()}
@@ -0,0 +1,97 @@
+# Copyright (C) 2024 Sebastien CHRISTIAN, University of French Polynesia
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import json
+import pickle
+from libs.data_registry import resolve_data_root
+
+# Conversational questionnaires (questionnaires/*.json), parsed once per process and indexed by uid:
+#   questionnaires.get_cq_id_dict() -> {uid: {"filename": filename, "content": cq}}
+# The folder is listed on each access; a file is parsed again only when its mtime or size changed.
+# Each questionnaire is kept pickled and every call returns a new copy (unpickling is faster than parsing
+# the JSON again or deep-copying): callers can modify it without changing the registry or other sessions.
+
+
+class QuestionnaireRegistry:
+    def __init__(self, relative_folder="questionnaires"):
+        self._relative_folder = relative_folder
+        self._root = None
+        # filename -> {"stamp": (mtime_ns, size), "uid", "title", "pickled": pickled cq}, in listing order
+        self._entries = {}
+        # uid -> filename
+        self._filename_by_uid = {}
+
+    @property
+    def root(self):
+        if self._root is None:
+            self._root = resolve_data_root(self._relative_folder)
+        return self._root
+
+    def refresh(self):
+        """ parses new and modified questionnaire files, drops removed ones. """
+        entries = {}
+        for filename in os.listdir(self.root):
+            path = os.path.join(self.root, filename)
+            if not (filename.endswith(".json") and os.path.isfile(path)):
+                continue
+            stat = os.stat(path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            entry = self._entries.get(filename, None)
+            if entry is None or entry["stamp"] != stamp:
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        cq = json.load(f)
+                except (OSError, ValueError):
+                    print("QUESTIONNAIRES: cannot read {}".format(path))
+                    continue
+                entry = {"stamp": stamp, "uid": cq.get("uid", None), "title": cq.get("title", None),
+                         "pickled": pickle.dumps(cq, protocol=pickle.HIGHEST_PROTOCOL)}
+            entries[filename] = entry
+        self._entries = entries
+        self._filename_by_uid = {entry["uid"]: filename for filename, entry in entries.items() if entry["uid"] is not None}
+
+    def filenames(self):
+        self.refresh()
+        return list(self._entries.keys())
+
+    def uids(self):
+        self.refresh()
+        return list(self._filename_by_uid.keys())
+
+    def get_cq_id_dict(self):
+        """ {uid: {"filename": filename, "content": cq}} for all questionnaires. """
+        self.refresh()
+        return {uid: {"filename": filename, "content": pickle.loads(self._entries[filename]["pickled"])}
+                for uid, filename in self._filename_by_uid.items()}
+
+    def get_by_uid(self, uid):
+        self.refresh()
+        filename = self._filename_by_uid.get(uid, None)
+        return None if filename is None else pickle.loads(self._entries[filename]["pickled"])
+
+    def get_title(self, uid, default=None):
+        self.refresh()
+        filename = self._filename_by_uid.get(uid, None)
+        title = None if filename is None else self._entries[filename]["title"]
+        return default if title is None else title
+
+    def get_by_filename(self, filename):
+        self.refresh()
+        entry = self._entries.get(filename, None)
+        return None if entry is None else pickle.loads(entry["pickled"])
+
+
+questionnaires = QuestionnaireRegistry()
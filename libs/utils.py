@@ -28,6 +28,7 @@ import streamlit as st
 import unicodedata
 from libs import glottolog_utils as gu
 from libs import file_manager_utils as fmu
+from libs import questionnaire_registry as qr
 
 from collections.abc import Mapping, Sequence
 
@@ -858,7 +859,8 @@ def catalog_all_available_cqs(language=None):
                         cqc["location"] = "unknown"
                     cq_catalog.append({
                         "index": index,
-                        "title": uid_dict.get(cqc["cq_uid"], "unknown"),
+                        "title": uid_dict[cqc["cq_uid"]] if cqc["cq_uid"] in uid_dict
+                                 else qr.questionnaires.get_title(cqc["cq_uid"], "unknown"),
                         "language": language,
                         "pivot": cqc["pivot language"],
                         "info": cqc["interviewee"][:3]+" by "+cqc["interviewer"][:3],
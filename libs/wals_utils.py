@@ -15,15 +15,17 @@
 
 import os
 import json
+from collections import OrderedDict
 from libs import utils as u
 import pandas as pd
 import math
 import numpy as np
-import pickle
-from collections import defaultdict, Counter
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 from pathlib import Path
 import libs.utils as u
-from multiprocessing import Pool, cpu_count
+from libs import cpt_utils as cu
+from libs.data_registry import LazyDataRegistry
 
 # parameter.csv list parameters by pk and their names
 #
@@ -35,144 +37,105 @@ from multiprocessing import Pool, cpu_count
 # language.csv contains all the languages with their pk, id, name and location
 
 # GLOBAL VARIABLES
-try:
-    with open("./external_data/wals_derived/parameter_pk_by_name_lookup_table.json", encoding='utf-8') as f:
-        parameter_pk_by_name = json.load(f)
-    with open("./external_data/wals_derived/parameter_pk_by_name_filtered.json", encoding='utf-8') as f:
-        parameter_pk_by_name_filtered = json.load(f)
-    with open("./external_data/wals_derived/language_by_pk_lookup_table.json", encoding='utf-8') as f:
-        language_by_pk = json.load(f)
-    with open("./external_data/wals_derived/domain_elements_by_language.json", encoding='utf-8') as f:
-        domain_elements_by_language = json.load(f)
-    with open("./external_data/wals_derived/domain_elements_pk_by_parameter_pk_lookup_table.json", encoding='utf-8') as f:
-        domain_elements_pk_by_parameter_pk = json.load(f)
-    with open("./external_data/wals_derived/domain_element_by_pk_lookup_table.json", encoding='utf-8') as f:
-        domain_element_by_pk = json.load(f)
-    with open("./external_data/wals_derived/language_pk_by_family.json", encoding='utf-8') as f:
-        language_pk_by_family = json.load(f)
-    with open("./external_data/wals_derived/language_pk_by_subfamily.json", encoding='utf-8') as f:
-        language_pk_by_subfamily = json.load(f)
-    with open("./external_data/wals_derived/language_pk_by_genus.json", encoding='utf-8') as f:
-        language_pk_by_genus = json.load(f)
-    with open("./external_data/wals_derived/language_pk_by_macroarea.json", encoding='utf-8') as f:
-        language_pk_by_macroarea = json.load(f)
-    with open("./external_data/wals_derived/language_pk_id_by_name.json", encoding='utf-8') as f:
-        language_pk_id_by_name = json.load(f)
-    with open("./external_data/wals_derived/value_by_domain_element_pk_lookup_table.json", encoding='utf-8') as f:
-        value_by_domain_element_pk = json.load(f)
-    with open("./external_data/wals_derived/valueset_by_pk_lookup_table.json", encoding='utf-8') as f:
-        valueset_by_pk = json.load(f)
-    with open("./external_data/wals_derived/n_param_by_language_id.json", encoding='utf-8') as f:
-        n_param_by_language_id = json.load(f)
-    with open("./external_data/wals_derived/language_info_by_id_lookup_table.json", encoding='utf-8') as f:
-        language_info_by_id = json.load(f)
-    with open("./external_data/wals_derived/param_pk_by_de_pk.json", encoding='utf-8') as f:
-        param_pk_by_de_pk = json.load(f)
-    with open("./external_data/wals_derived/params_pk_by_language_pk.json", encoding='utf-8') as f:
-        params_pk_by_language_pk = json.load(f)
-    with open("./external_data/wals_derived/language_pk_by_id.json", encoding='utf-8') as f:
-        language_pk_by_id = json.load(f)
-    cpt = pd.read_json("./external_data/wals_derived/de_conditional_probability_df.json")
-    cpt.index = cpt.index.astype(str)
-    cpt.columns = cpt.columns.astype(str)
-except FileNotFoundError:
-    with open("../external_data/wals_derived/parameter_pk_by_name_lookup_table.json", encoding='utf-8') as f:
-        parameter_pk_by_name = json.load(f)
-    with open("../external_data/wals_derived/parameter_pk_by_name_filtered.json", encoding='utf-8') as f:
-        parameter_pk_by_name_filtered = json.load(f)
-    with open("../external_data/wals_derived/language_by_pk_lookup_table.json", encoding='utf-8') as f:
-        language_by_pk = json.load(f)
-    with open("../external_data/wals_derived/domain_elements_by_language.json", encoding='utf-8') as f:
-        domain_elements_by_language = json.load(f)
-    with open("../external_data/wals_derived/domain_elements_pk_by_parameter_pk_lookup_table.json", encoding='utf-8') as f:
-        domain_elements_pk_by_parameter_pk = json.load(f)
-    with open("../external_data/wals_derived/domain_element_by_pk_lookup_table.json", encoding='utf-8') as f:
-        domain_element_by_pk = json.load(f)
-    with open("../external_data/wals_derived/language_pk_by_family.json", encoding='utf-8') as f:
-        language_pk_by_family = json.load(f)
-    with open("../external_data/wals_derived/language_pk_by_subfamily.json", encoding='utf-8') as f:
-        language_pk_by_subfamily = json.load(f)
-    with open("../external_data/wals_derived/language_pk_by_genus.json", encoding='utf-8') as f:
-        language_pk_by_genus = json.load(f)
-    with open("../external_data/wals_derived/language_pk_by_macroarea.json", encoding='utf-8') as f:
-        language_pk_by_macroarea = json.load(f)
-    with open("../external_data/wals_derived/language_pk_id_by_name.json", encoding='utf-8') as f:
-        language_pk_id_by_name = json.load(f)
-    with open("../external_data/wals_derived/value_by_domain_element_pk_lookup_table.json", encoding='utf-8') as f:
-        value_by_domain_element_pk = json.load(f)
-    with open("../external_data/wals_derived/valueset_by_pk_lookup_table.json", encoding='utf-8') as f:
-        valueset_by_pk = json.load(f)
-    with open("../external_data/wals_derived/language_info_by_id_lookup_table.json", encoding='utf-8') as f:
-        language_info_by_id = json.load(f)
-    with open("../external_data/wals_derived/param_pk_by_de_pk.json", encoding='utf-8') as f:
-        param_pk_by_de_pk = json.load(f)
-    with open("../external_data/wals_derived/params_pk_by_language_pk.json", encoding='utf-8') as f:
-        params_pk_by_language_pk = json.load(f)
-    with open("../external_data/wals_derived/language_pk_by_id.json", encoding='utf-8') as f:
-        language_pk_by_id = json.load(f)
-    cpt = pd.read_json("../external_data/wals_derived/de_conditional_probability_df.json")
-    cpt.index = cpt.index.astype(str)
-    cpt.columns = cpt.columns.astype(str)
-
-parameter_name_by_pk = {}
-for name, pk in parameter_pk_by_name.items():
-    parameter_name_by_pk[str(pk)] = name
+# WALS lookup tables are loaded on first access through the wals_data registry.
+# They are also available as module attributes (wu.language_by_pk, wu.cpt...), see __getattr__ below.
+wals_data = LazyDataRegistry("external_data/wals_derived", {
+    "parameter_pk_by_name": "parameter_pk_by_name_lookup_table.json",
+    "parameter_pk_by_name_filtered": "parameter_pk_by_name_filtered.json",
+    "language_by_pk": "language_by_pk_lookup_table.json",
+    "domain_elements_by_language": "domain_elements_by_language.json",
+    "domain_elements_pk_by_parameter_pk": "domain_elements_pk_by_parameter_pk_lookup_table.json",
+    "domain_element_by_pk": "domain_element_by_pk_lookup_table.json",
+    "language_pk_by_family": "language_pk_by_family.json",
+    "language_pk_by_subfamily": "language_pk_by_subfamily.json",
+    "language_pk_by_genus": "language_pk_by_genus.json",
+    "language_pk_by_macroarea": "language_pk_by_macroarea.json",
+    "language_pk_id_by_name": "language_pk_id_by_name.json",
+    "value_by_domain_element_pk": "value_by_domain_element_pk_lookup_table.json",
+    "valueset_by_pk": "valueset_by_pk_lookup_table.json",
+    "n_param_by_language_id": "n_param_by_language_id.json",
+    "language_info_by_id": "language_info_by_id_lookup_table.json",
+    "param_pk_by_de_pk": "param_pk_by_de_pk.json",
+    "params_pk_by_language_pk": "params_pk_by_language_pk.json",
+    "language_pk_by_id": "language_pk_by_id.json",
+    "language_profiles_by_id": lambda data: load_language_profiles_by_id(data),
+    "language_id_by_name": lambda data: build_language_id_by_name(data),
+    "value_incidence": lambda data: build_wals_value_incidence(data),
+    "mrf_potentials": lambda data: load_mrf_potential_store(data),
+    "parameter_name_by_pk": lambda data: {str(pk): name for name, pk in data.parameter_pk_by_name.items()},
+    "cpt": lambda data: cu.load_cpt(data.path("de_conditional_probability_df.json")),
+})
+
+
+def get_wals_raw_folder():
+    """ raw WALS tables (wals-master/raw), next to the wals_derived folder of wals_data."""
+    return os.path.join(os.path.dirname(os.path.normpath(wals_data.root)), "wals-master", "raw")
+
+
+def __getattr__(name):
+    # module-level access to the lazy tables; once loaded, a table becomes a regular module attribute
+    if wals_data.has_table(name):
+        value = getattr(wals_data, name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {} has no attribute {}".format(__name__, name))
+
 
 def build_language_pk_by_id():
     language_pk_by_id = {}
-    for lpk in language_by_pk:
+    for lpk in wals_data.language_by_pk:
         try:
-            language_pk_by_id[language_by_pk[lpk]["id"]] = lpk
+            language_pk_by_id[wals_data.language_by_pk[lpk]["id"]] = lpk
         except KeyError:
             print("no id field in language pk {}".format(lpk))
 
-    with open("../external_data/wals_derived/language_pk_by_id.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("language_pk_by_id.json"), "w", encoding='utf-8') as f:
         json.dump(language_pk_by_id, f, ensure_ascii=False, indent=4)
 
 
 
 def build_param_pk_by_de_pk():
     param_pk_by_de_pk = {}
-    for ppk in domain_elements_pk_by_parameter_pk:
-        depks =  domain_elements_pk_by_parameter_pk[ppk]
+    for ppk in wals_data.domain_elements_pk_by_parameter_pk:
+        depks =  wals_data.domain_elements_pk_by_parameter_pk[ppk]
         for depk in depks:
             if depk not in param_pk_by_de_pk.keys():
                 param_pk_by_de_pk[depk] = ppk
 
-    with open("../external_data/wals_derived/param_pk_by_de_pk.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("param_pk_by_de_pk.json"), "w", encoding='utf-8') as f:
         json.dump(param_pk_by_de_pk, f, ensure_ascii=False, indent=4)
 
 
 def build_param_name_by_de_name():
     param_name_by_de_name = {}
-    for de_pk, info in domain_element_by_pk.items():
+    for de_pk, info in wals_data.domain_element_by_pk.items():
         ppk = info["parameter_pk"]
-        p_name = parameter_name_by_pk[str(ppk)]
+        p_name = wals_data.parameter_name_by_pk[str(ppk)]
         param_name_by_de_name[info["name"]] = p_name
 
-    with open("../external_data/wals_derived/param_name_by_de_name.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("param_name_by_de_name.json"), "w", encoding='utf-8') as f:
         json.dump(param_name_by_de_name, f, ensure_ascii=False, indent=4)
 
 
 def build_params_pk_by_language_pk():
     params_pk_by_language_pk = {}
-    for language_pk in domain_elements_by_language:
+    for language_pk in wals_data.domain_elements_by_language:
         params_pk_by_language_pk[language_pk] = []
-        for depk in domain_elements_by_language[language_pk]:
-            if str(depk) in param_pk_by_de_pk.keys():
-                ppk = param_pk_by_de_pk[str(depk)]
+        for depk in wals_data.domain_elements_by_language[language_pk]:
+            if str(depk) in wals_data.param_pk_by_de_pk.keys():
+                ppk = wals_data.param_pk_by_de_pk[str(depk)]
                 if ppk not in params_pk_by_language_pk[language_pk]:
                     params_pk_by_language_pk[language_pk].append(ppk)
             else:
                 print("build_params_pk_by_language_pk: {} not in param_pk_by_de_pk".format(depk))
 
-    with open("../external_data/wals_derived/params_pk_by_language_pk.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("params_pk_by_language_pk.json"), "w", encoding='utf-8') as f:
         json.dump(params_pk_by_language_pk, f, ensure_ascii=False, indent=4)
 
 
 
 def get_careful_name_of_de_pk(depk):
-    info = domain_element_by_pk[str(depk)]
+    info = wals_data.domain_element_by_pk[str(depk)]
     if "name" in info.keys():
         if info["name"] != "" and str(info["name"]).lower() != "nan":
             return info["name"]
@@ -187,92 +150,118 @@ def extract_wals_cp_matrix_from_general_data(ppk1, ppk2, active_wals_cpt):
     # if rows of extracted cpt samples have only zeros, making impossible a normalization,
     # the values of such rows are changed to uniform distributions, expressing the absence of information.
 
-    if str(ppk1) in domain_elements_pk_by_parameter_pk and str(ppk2) in domain_elements_pk_by_parameter_pk:
-
-        p1_de_pk_list = domain_elements_pk_by_parameter_pk[ppk1]
-        p2_de_pk_list = domain_elements_pk_by_parameter_pk[ppk2]
-        # P1 GIVEN P2 DF
-        # keep only p1 on rows
-        filtered_cpt_p1 = active_wals_cpt.loc[p1_de_pk_list]
-        # keep only given p2 on columns
-        filtered_cpt_p1_given_p2 = filtered_cpt_p1[p2_de_pk_list]
-        # normalization: all the columns of each row (primary event) should sum up to 1
-        filtered_cpt_p1_given_p2_normalized = filtered_cpt_p1_given_p2.apply(u.normalize_column, axis=0)
+    if str(ppk1) in wals_data.domain_elements_pk_by_parameter_pk and str(ppk2) in wals_data.domain_elements_pk_by_parameter_pk:
 
-        return filtered_cpt_p1_given_p2_normalized
+        p1_de_pk_list = wals_data.domain_elements_pk_by_parameter_pk[ppk1]
+        p2_de_pk_list = wals_data.domain_elements_pk_by_parameter_pk[ppk2]
+        # P1 GIVEN P2: p1 on rows, given p2 on columns, columns normalized to sum up to 1 (cached per CPT)
+        block = cu.get_normalized_block(active_wals_cpt, p1_de_pk_list, p2_de_pk_list, ppk2, ppk1)
+        return cu.normalized_block_to_df(block)
     else:
         # either wrong or not wals ppk
         return None
 
+def get_wals_cpt_file_id():
+    """ id of the stored default WALS CPT, changes when it is rebuilt (see cpt_utils.get_cpt_file_id)."""
+    return cu.get_cpt_file_id(wals_data.path("de_conditional_probability_df.json"))
+
+
+def build_mrf_potential_store(cpt=None):
+    """ computes the MRF potentials of all pairs of WALS parameters from cpt (default WALS CPT)
+    and stores them in wals_derived/mrf_potentials, with the file id of the default CPT they come from."""
+    cpt_id = None
+    if cpt is None:
+        cpt = wals_data.cpt
+        cpt_id = get_wals_cpt_file_id()
+    print("build_mrf_potential_store")
+    return cu.build_potential_store(cpt, wals_data.domain_elements_pk_by_parameter_pk, wals_data.path("mrf_potentials"),
+                                    cpt_id=cpt_id)
+
+
+def load_mrf_potential_store(data):
+    """ stored MRF potentials, built again when missing or built from another version of the default WALS CPT."""
+    if os.path.isdir(data.path("mrf_potentials")):
+        store = cu.PotentialStore(data.path("mrf_potentials"))
+        cpt_id = get_wals_cpt_file_id()
+        if cpt_id is None or store.cpt_id == cpt_id:
+            return store
+        print("mrf_potentials built from another version of the WALS CPT, building it again.")
+    else:
+        print("mrf_potentials not found in the file system, building it.")
+    return build_mrf_potential_store()
+
+
 def compute_MRF_potential_function_from_general_data(ppk1, ppk2):
     """ use geometric mean to compute potential function from conditional probabilities.
-    potentials are considered uniform across all languages."""
+    potentials are considered uniform across all languages.
+    Potentials of all pairs are precomputed in the potential store (see build_mrf_potential_store)."""
 
     # if rows of extracted cpt samples have only zeros, making impossible a normalization,
     # the values of such rows are changed to uniform distributions, expressing the absence of information.
+    potential_function = wals_data.mrf_potentials.get_potential(ppk1, ppk2)
+    if potential_function is None:
+        print("compute_MRF_potential_function_from_general_data: no potential for {} and {}".format(ppk1, ppk2))
+    return potential_function
+
+# Priors: value counts come from a language x domain element count matrix built from the WALS values
+# (value_by_domain_element_pk and valueset_by_pk, as a direct recount). A language whitelist is turned into
+# a boolean mask over its rows, the counts of every value for that whitelist are a single masked sum,
+# memoized by the whitelist itself (last MAX_CACHED_VALUE_COUNTS whitelists).
+MAX_CACHED_VALUE_COUNTS = 256
+wals_value_counts_by_whitelist = OrderedDict()
+
+
+def build_wals_value_incidence(data):
+    de_pks = sorted(data.domain_element_by_pk.keys(), key=int)
+    de_index = {de_pk: i for i, de_pk in enumerate(de_pks)}
+    language_index = {}
+    rows = []
+    cols = []
+    for de_pk, values in data.value_by_domain_element_pk.items():
+        col = de_index.get(str(de_pk), None)
+        if col is None:
+            continue
+        for value in values:
+            valueset = data.valueset_by_pk.get(str(value["valueset_pk"]), {})
+            if "language_pk" in valueset:
+                rows.append(language_index.setdefault(str(valueset["language_pk"]), len(language_index)))
+                cols.append(col)
+    # each value of a language is counted, as in a direct recount (duplicates are summed)
+    incidence = sparse.csc_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                  shape=(len(language_index), len(de_pks)), dtype=np.int32)
+    return {"language_index": language_index, "de_index": de_index, "incidence": incidence}
+
+
+def get_wals_value_counts(language_whitelist):
+    """ returns the number of values of each domain element in the languages of language_whitelist,
+    as a vector following wals_data.value_incidence["de_index"]. Memoized by whitelist."""
+    language_pks = frozenset(str(lpk) for lpk in language_whitelist)
+    if language_pks in wals_value_counts_by_whitelist:
+        wals_value_counts_by_whitelist.move_to_end(language_pks)
+        return wals_value_counts_by_whitelist[language_pks]
+    language_index = wals_data.value_incidence["language_index"]
+    mask = np.zeros(len(language_index), dtype=bool)
+    mask[[language_index[lpk] for lpk in language_pks if lpk in language_index]] = True
+    counts = wals_data.value_incidence["incidence"].T @ mask.astype(np.int32)
+    wals_value_counts_by_whitelist[language_pks] = np.asarray(counts).ravel()
+    while len(wals_value_counts_by_whitelist) > MAX_CACHED_VALUE_COUNTS:
+        wals_value_counts_by_whitelist.popitem(last=False)
+    return wals_value_counts_by_whitelist[language_pks]
 
-    # storing potentials as pickles as new ones are created, as it takes time
-    potential_filename = str(ppk1) + "_" + str(ppk2) + ".pkl"
-    if potential_filename in os.listdir("../data/potentials/"):
-        with open("../data/potentials/"+potential_filename, "rb") as f:
-            return pickle.load(f)
-    else:
-        def normalize_row(row):
-            row_sum = row.sum()
-            if row_sum == 0:
-                # All values are 0, assign uniform distribution using Pandas
-                return pd.Series([1 / len(row)] * len(row), index=row.index)
-            else:
-                # Normalize the row
-                return row / row_sum
-
-        cpt = pd.read_json("../external_data/wals_derived/de_conditional_probability_df.json")
-        p1_de_pk_list = domain_elements_pk_by_parameter_pk[str(ppk1)]
-        p2_de_pk_list = domain_elements_pk_by_parameter_pk[str(ppk2)]
-
-        # P2 GIVEN P1 DF
-
-        # keep only p1 on lines (primary)
-        filtered_cpt_p2_given_p1 = cpt.loc[p1_de_pk_list]
-        # keep only p2 on columns (secondary)
-        filtered_cpt_p2_given_p1 = filtered_cpt_p2_given_p1[p2_de_pk_list]
-        # normalization: all the columns of each row (primary event) should sum up to 1
-        filtered_cpt_p2_given_p1_normalized = filtered_cpt_p2_given_p1.apply(normalize_row, axis=1)
-        # P1 GIVEN P2 DF
-        # keep only p2 on lines (primary)
-        filtered_cpt_p1_given_p2 = cpt.loc[p2_de_pk_list]
-        # keep only p1 on columns (secondary)
-        filtered_cpt_p1_given_p2 = filtered_cpt_p1_given_p2[p1_de_pk_list]
-        # normalization: all the columns of each row (primary event) should sum up to 1
-        filtered_cpt_p1_given_p2_normalized = filtered_cpt_p1_given_p2.apply(normalize_row, axis=1)
-
-        potential_function = np.sqrt(filtered_cpt_p2_given_p1_normalized * filtered_cpt_p1_given_p2_normalized.T)
-
-        with open("../data/potentials/"+potential_filename, "wb") as f:
-            pickle.dump(potential_function, f)
-
-        return potential_function
 
 def compute_wals_param_distribution(parameter_pk, language_whitelist):
     param_distribution = {}
-    total_count = 0
-    if str(parameter_pk) in domain_elements_pk_by_parameter_pk:
-        de_pks = domain_elements_pk_by_parameter_pk[str(parameter_pk)]
+    if str(parameter_pk) in wals_data.domain_elements_pk_by_parameter_pk:
+        de_pks = wals_data.domain_elements_pk_by_parameter_pk[str(parameter_pk)]
+        counts = get_wals_value_counts(language_whitelist)
+        de_index = wals_data.value_incidence["de_index"]
         for de_pk in de_pks:
-            c = 0
-            if str(de_pk) in value_by_domain_element_pk:
-                for valueset in value_by_domain_element_pk[str(de_pk)]:
-                    valueset_pk = valueset["valueset_pk"]
-                    # increment counter only if language in whitelist
-                    if "language_pk" in valueset_by_pk[str(valueset_pk)]:
-                        if str(valueset_by_pk[str(valueset_pk)]["language_pk"]) in language_whitelist:
-                            c += 1
-                            total_count += 1
-                    else:
-                        print(" 'language pk' not in valueset_by_pk")
+            if str(de_pk) in de_index:
+                param_distribution[str(de_pk)] = int(counts[de_index[str(de_pk)]])
             else:
-                print("de_pk {} not in value_by_domain_element_pk".format(de_pk))
-            param_distribution[str(de_pk)] = c
+                print("de_pk {} not in domain_element_by_pk".format(de_pk))
+                param_distribution[str(de_pk)] = 0
+        total_count = sum(param_distribution.values())
         for de_pk in param_distribution.keys():
             if total_count != 0:
                 param_distribution[de_pk] = param_distribution[de_pk]/total_count
@@ -282,73 +271,59 @@ def compute_wals_param_distribution(parameter_pk, language_whitelist):
     return param_distribution
 
 def get_language_pks_by_family(family):
-    if family in language_pk_by_family:
-        return language_pk_by_family[family]
+    if family in wals_data.language_pk_by_family:
+        return wals_data.language_pk_by_family[family]
     else:
         print("Language family {} not in list of known families".format(family))
         return None
 
 def get_language_pks_by_subfamily(subfamily):
-    if subfamily in language_pk_by_subfamily:
-        return language_pk_by_subfamily[subfamily]
+    if subfamily in wals_data.language_pk_by_subfamily:
+        return wals_data.language_pk_by_subfamily[subfamily]
     else:
         print("Language subfamily {} not in list of known subfamilies".format(subfamily))
 
 def get_language_pks_by_genus(genus):
-    if genus in language_pk_by_genus:
-        return language_pk_by_genus[genus]
+    if genus in wals_data.language_pk_by_genus:
+        return wals_data.language_pk_by_genus[genus]
     else:
         print("Language genus {} not in list of known genuses".format(genus))
 
 def get_language_pks_by_macroarea(macroarea):
-    if macroarea in language_pk_by_macroarea:
-        return language_pk_by_macroarea[macroarea]
+    if macroarea in wals_data.language_pk_by_macroarea:
+        return wals_data.language_pk_by_macroarea[macroarea]
     else:
         print("Language macroarea {} not in list of known macroareas".format(macroarea))
 
 def build_number_of_params_by_language_id():
     out_dict = {}
-    available_languages_filtered = []
-    c = 0
-    n = len(language_pk_id_by_name)
-    for language in language_pk_id_by_name:
-        c += 1
-        id = language_pk_id_by_name[language]["id"]
-        n_param = len(get_language_data_by_id(id))
-        out_dict[id] = n_param
-        print("{} / {}".format(c, n))
-
-    with open("./external_data/wals_derived/n_param_by_language_id.json", "w", encoding='utf-8') as f:
+    for language in wals_data.language_pk_id_by_name:
+        id = wals_data.language_pk_id_by_name[language]["id"]
+        out_dict[id] = len(wals_data.language_profiles_by_id.get(id, {}))
+
+    with open(wals_data.path("n_param_by_language_id.json"), "w", encoding='utf-8') as f:
         json.dump(out_dict, f, ensure_ascii=False)
 
 
 def build_domain_elements_by_language_and_languages_by_domain_element():
-    with open("./external_data/wals_derived/language_by_pk_lookup_table.json", encoding='utf-8') as f:
+    with open(wals_data.path("language_by_pk_lookup_table.json"), encoding='utf-8') as f:
         language_by_pk = json.load(f)
     domain_elements_by_language = {}
     languages_by_domain_element = {}
-    c = 0
     for language_pk in language_by_pk.keys():
-        c += 1
-        language_domain_elements = []
         language_id = language_by_pk[language_pk]["id"]
-        print("language {}, {}% completion".format(language_by_pk[language_pk]["name"], c/len(language_by_pk)))
-        result_dict = get_language_data_by_id(language_id)
-        try:
-            for parameter in result_dict.keys():
-                language_domain_elements.append(result_dict[parameter]["domainelement_pk"])
-            domain_elements_by_language[language_pk] = language_domain_elements
-            for domain_element in language_domain_elements:
-                if domain_element in languages_by_domain_element:
-                    languages_by_domain_element[domain_element].append(language_pk)
-                else:
-                    languages_by_domain_element[domain_element] = [language_pk]
-        except:
-            print("issue with a result dict on language {}".format(language_id))
+        profile = wals_data.language_profiles_by_id.get(language_id, {})
+        language_domain_elements = [record["domainelement_pk"] for record in profile.values()]
+        domain_elements_by_language[language_pk] = language_domain_elements
+        for domain_element in language_domain_elements:
+            if domain_element in languages_by_domain_element:
+                languages_by_domain_element[domain_element].append(language_pk)
+            else:
+                languages_by_domain_element[domain_element] = [language_pk]
 
-    with open("./external_data/wals_derived/domain_elements_by_language.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("domain_elements_by_language.json"), "w", encoding='utf-8') as f:
         json.dump(domain_elements_by_language, f, ensure_ascii=False)
-    with open("./external_data/wals_derived/languages_by_domain_element.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("languages_by_domain_element.json"), "w", encoding='utf-8') as f:
         json.dump(languages_by_domain_element, f, ensure_ascii=False)
 
 
@@ -379,7 +354,7 @@ def compute_conditional_de_proba(a_pk, b_pk, language_pks, return_counts = False
     a_and_b = 0
 
     for lang_pk in language_pks:
-        values = domain_elements_by_language[str(lang_pk)]
+        values = wals_data.domain_elements_by_language[str(lang_pk)]
         has_a = int(a_pk) in values
         has_b = int(b_pk) in values
         if has_b:
@@ -391,7 +366,7 @@ def compute_conditional_de_proba(a_pk, b_pk, language_pks, return_counts = False
         print("no b_count for a_pk {} and b_pk {} for language {}".format(
             get_careful_name_of_de_pk(a_pk),
             get_careful_name_of_de_pk(b_pk),
-            language_by_pk.get(str(lang_pk), "no language with that pk")
+            wals_data.language_by_pk.get(str(lang_pk), "no language with that pk")
         ))
         return None  # undefined
     else:
@@ -404,196 +379,157 @@ def compute_conditional_de_proba(a_pk, b_pk, language_pks, return_counts = False
         return p_hat
 
 
-def build_conditional_probability_table(filtered_params=True,
-                                        language_filter=None,
-                                        exclude_lids=None):
-    """
-    Build a |V| x |V| matrix M where M[a,b] estimates P(A|B) over a selected language set.
-
-  Cells are set to NaN when support is too small:
-  n_B < N_MIN or k_A_and_B < K_MIN.
-
-A separate “trust” matrix stores k_A_and_B (co-occurrence counts).
-    """
+def get_cpt_language_pks(language_filter=None, exclude_lids=None):
+    """ list of language pks used to compute a CPT.
+    language_filter restricts languages by family, subfamily, genus and macroarea,
+    exclude_lids removes languages (by id) from the selection."""
     language_filter = language_filter or {}
-
-    # ---- 1. which languages ------------------------------------------------
     if language_filter:
         language_pks = set()
         for key, table in [
-            ("family",     language_pk_by_family),
-            ("subfamily",  language_pk_by_subfamily),
-            ("genus",      language_pk_by_genus),
-            ("macroarea",  language_pk_by_macroarea),
+            ("family",     wals_data.language_pk_by_family),
+            ("subfamily",  wals_data.language_pk_by_subfamily),
+            ("genus",      wals_data.language_pk_by_genus),
+            ("macroarea",  wals_data.language_pk_by_macroarea),
         ]:
             for label in language_filter.get(key, []):
                 language_pks |= set(table.get(label, []))
+    else:
+        language_pks = set(wals_data.language_by_pk.keys())
     if exclude_lids:
-        exclude_pks = [language_pk_by_id.get(lid, None) for lid in exclude_lids]
-        print("exclude pks: {}".format(exclude_pks))
+        exclude_pks = [wals_data.language_pk_by_id.get(lid, None) for lid in exclude_lids]
         exclude_pks = set([item for item in exclude_pks if item is not None])
-        print("WALS CPT computation: {} language pks from exclusion list not found".format(len(exclude_lids) - len(exclude_pks)))
-        language_pks = set(language_by_pk.keys())
+        if len(exclude_pks) != len(exclude_lids):
+            print("WALS CPT computation: {} language pks from exclusion list not found".format(len(exclude_lids) - len(exclude_pks)))
         language_pks -= exclude_pks
-        print("WALS CPT computation: Excluded {} languages".format(len(exclude_lids)))
-        print("Full hash of excluded languages: ")
-        print(u.generate_hash_from_list(exclude_lids))
-    else:
-        language_pks = set(language_by_pk.keys())
+        print("WALS CPT computation: Excluded {} languages, hash {}".format(len(exclude_pks), u.generate_hash_from_list(exclude_lids)))
+    return sorted(language_pks, key=int)
 
-    language_pks = list(language_pks)
-    # to test
-    # language_pks = ['2534', '2343', '1821']
 
-    # ---- 2. which domain-element values -----------------------------------
-    lookup_file = (
-        "../external_data/wals_derived/"
+def get_cpt_domain_element_pk_list(filtered_params=True):
+    lookup_file = wals_data.path(
         "domain_element_by_pk_lookup_table_filtered.json"
         if filtered_params else
-        "../external_data/wals_derived/"
         "domain_element_by_pk_lookup_table.json"
     )
-    domain_element_pk_list = list(json.load(open(lookup_file, encoding='utf-8')).keys())
-
-    # ---- 3. compute CPT ----------------------------------------------------
-    cpt = pd.DataFrame(index=domain_element_pk_list,
-                       columns=domain_element_pk_list, dtype=float)
-    cpt_trust = pd.DataFrame(index=domain_element_pk_list,
-                       columns=domain_element_pk_list, dtype=int)
-
-
-    for i, a_pk in enumerate(domain_element_pk_list, 1):
-        print(f"Row {i}/{len(domain_element_pk_list)}  value={a_pk}")
-        for b_pk in domain_element_pk_list:
-            if compute_conditional_de_proba(a_pk, b_pk, language_pks, return_counts=True) is None:
-                cpt.at[a_pk, b_pk] = np.nan
-                cpt_trust.at[a_pk, b_pk] = np.nan
-            else:
-                p_hat, b_count, a_and_b = compute_conditional_de_proba(a_pk, b_pk, language_pks, return_counts=True)
+    with open(lookup_file, encoding='utf-8') as f:
+        return list(json.load(f).keys())
 
-                if p_hat is None:
-                    cpt.at[a_pk, b_pk] = np.nan
-                    continue
-
-                # too little support? → mark as None
-                if b_count < N_MIN or a_and_b < K_MIN:
-                    cpt.at[a_pk, b_pk] = np.nan
-                else:
-                    cpt.at[a_pk, b_pk] = p_hat
-
-                # trust table
-                cpt_trust.at[a_pk, b_pk] = a_and_b
-
-    # ---- 4. save -----------------------------------------------------------
-    out = Path("../external_data/wals_derived/partial_cpt")
-    out.mkdir(exist_ok=True, parents=True)
 
-    suffix = []
-    for key in ["family", "subfamily", "genus", "macroarea"]:
-        if key in language_filter and language_filter[key]:
-            suffix.append(key + "_" + "-".join(language_filter[key]))
-    if exclude_lids:
-        suffix.append("languages_excluded_hash_{}".format(u.generate_hash_from_list(exclude_lids)))
+def compute_conditional_probability_table_from_counts(cooccurrence, domain_element_pk_list):
+    """
+    Applies the CPT estimation rules to a co-occurrence count matrix (see cpt_utils).
+    M[a,b] estimates P(A|B) with the same estimates as compute_conditional_de_proba.
 
-    fname = "de_conditional_probability" + ("_" + "_".join(suffix) if suffix else "") + ".json"
-    f_trust_name = "de_conditional_probability_trust_" + ("_" + "_".join(suffix) if suffix else "") + ".json"
+    Cells are set to NaN when support is too small:
+    n_B < N_MIN or k_A_and_B < K_MIN.
+    The trust matrix stores k_A_and_B (co-occurrence counts), NaN when B is never observed.
+    Returns (cpt, cpt_trust) DataFrames.
+    """
+    cpt_array, n_b = cu.compute_conditional_probability_arrays(cooccurrence,
+                                                               n_min=N_MIN,
+                                                               k_min=K_MIN,
+                                                               alpha=EPSILON,
+                                                               beta=EPSILON)
+    trust_array = np.asarray(cooccurrence, dtype=float)
+    trust_array[:, n_b == 0] = np.nan
+    return cu.cpt_arrays_to_df(cpt_array, trust_array, domain_element_pk_list)
 
-    cpt.to_json(out / fname)
-    cpt_trust.to_json(out / f_trust_name)
 
-    return os.path.join(out, fname)
+def compute_conditional_probability_table(language_pks, domain_element_pk_list):
+    """
+    Vectorized computation of the |V| x |V| matrix M where M[a,b] estimates P(A|B) over language_pks.
+    All co-occurrence counts come from a single product of the language x domain element incidence matrix.
+    Returns (cpt, cpt_trust) DataFrames.
+    """
+    incidence = cu.build_incidence_matrix(wals_data.domain_elements_by_language, language_pks, domain_element_pk_list)
+    cooccurrence = cu.compute_cooccurrence_counts(incidence)
+    return compute_conditional_probability_table_from_counts(cooccurrence, domain_element_pk_list)
 
 
+# global co-occurrence counts, computed once per process and per domain element list
+wals_cooccurrence_counts = {}
 
-def compute_row(args):
-    """Compute one row of the conditional probability table, used by multiprocessing."""
-    a_pk, domain_element_pk_list, language_pks = args
-    row = {}
-    trust_row = {}
+def get_wals_cooccurrence_counts(filtered_params=True):
+    """ co-occurrence counts over all WALS languages, kept in memory once computed."""
+    key = "filtered" if filtered_params else "full"
+    if key not in wals_cooccurrence_counts:
+        wals_cooccurrence_counts[key] = cu.CooccurrenceCounts(wals_data.domain_elements_by_language,
+                                                              sorted(wals_data.language_by_pk.keys(), key=int),
+                                                              get_cpt_domain_element_pk_list(filtered_params))
+    return wals_cooccurrence_counts[key]
 
-    print(f"Computing row: {get_careful_name_of_de_pk(a_pk)}")
 
-    for b_pk in domain_element_pk_list:
-        result = compute_conditional_de_proba(a_pk, b_pk, language_pks, return_counts=True)
+def compute_conditional_probability_table_excluding_languages(exclude_lids=None, exclude_pks=None, filtered_params=True):
+    """
+    CPT over all WALS languages minus a set S of languages (given by ids and/or pks).
+    The counts of S are subtracted from the global co-occurrence counts: nothing is read from or written to disk,
+    which makes leave-one-out and leave-family-out evaluations cheap.
+    Returns (cpt, cpt_trust) DataFrames.
+    """
+    excluded = set(str(pk) for pk in (exclude_pks or []))
+    for lid in exclude_lids or []:
+        if lid in wals_data.language_pk_by_id:
+            excluded.add(str(wals_data.language_pk_by_id[lid]))
+        else:
+            print("compute_conditional_probability_table_excluding_languages: language id {} not found".format(lid))
+    counts = get_wals_cooccurrence_counts(filtered_params)
+    return compute_conditional_probability_table_from_counts(counts.counts_excluding(excluded), counts.value_ids)
 
-        if result is None:
-            row[b_pk] = np.nan
-            trust_row[b_pk] = np.nan
-            continue
 
-        p_hat, b_count, a_and_b = result
+# on-demand CPTs over filtered language sets, by domain element list
+wals_cpt_providers = {}
 
-        if p_hat is None or b_count < N_MIN or a_and_b < K_MIN:
-            row[b_pk] = np.nan
-        else:
-            row[b_pk] = p_hat
+def get_wals_cpt_provider(filtered_params=True, max_cached=8, cache_folder=None):
+    """ CPTProvider computing WALS CPTs over any language set from the global co-occurrence counts.
+    cache_folder (optional) stores the computed CPTs on disk, by language set hash.
+    max_cached and cache_folder are used when the provider is first created."""
+    key = "filtered" if filtered_params else "full"
+    if key not in wals_cpt_providers:
+        wals_cpt_providers[key] = cu.CPTProvider("wals_" + key,
+                                                 get_wals_cooccurrence_counts(filtered_params),
+                                                 compute_conditional_probability_table_from_counts,
+                                                 max_cached=max_cached,
+                                                 cache_folder=cache_folder)
+    return wals_cpt_providers[key]
 
-        trust_row[b_pk] = a_and_b
 
-    return a_pk, row, trust_row
+def get_filtered_wals_cpt(language_pks, filtered_params=True):
+    """ WALS CPT over language_pks (e.g. the languages of a family filter), with its trust matrix."""
+    return get_wals_cpt_provider(filtered_params).get_cpt([str(lpk) for lpk in language_pks])
 
 
-def build_conditional_probability_table_multiprocessing(filtered_params=True,
-                                                        language_filter=None,
-                                                        exclude_lids=None):
-    """Main function to build the conditional probability table."""
+def build_conditional_probability_table(filtered_params=True,
+                                        language_filter=None,
+                                        exclude_lids=None,
+                                        output_folder=None):
+    """
+    Build a |V| x |V| matrix M where M[a,b] estimates P(A|B) over a selected language set,
+    and store it with its trust matrix in output_folder (default wals_derived/partial_cpt).
+    See compute_conditional_probability_table.
+    """
     language_filter = language_filter or {}
 
     # ---- 1. which languages ------------------------------------------------
-    if language_filter:
-        language_pks = set()
-        for key, table in [
-            ("family",     language_pk_by_family),
-            ("subfamily",  language_pk_by_subfamily),
-            ("genus",      language_pk_by_genus),
-            ("macroarea",  language_pk_by_macroarea),
-        ]:
-            for label in language_filter.get(key, []):
-                language_pks |= set(table.get(label, []))
-    elif exclude_lids:
-        exclude_pks = [language_pk_by_id.get(lid) for lid in exclude_lids]
-        exclude_pks = set(filter(None, exclude_pks))
-        language_pks = set(language_by_pk.keys()) - exclude_pks
-    else:
-        language_pks = set(language_by_pk.keys())
-
-    language_pks = list(language_pks)
+    language_pks = get_cpt_language_pks(language_filter, exclude_lids)
 
     # ---- 2. which domain-element values -----------------------------------
-    lookup_file = (
-        "../external_data/wals_derived/"
-        "domain_element_by_pk_lookup_table_filtered.json"
-        if filtered_params else
-        "../external_data/wals_derived/"
-        "domain_element_by_pk_lookup_table.json"
-    )
-    domain_element_pk_list = list(json.load(open(lookup_file, encoding='utf-8')))
+    domain_element_pk_list = get_cpt_domain_element_pk_list(filtered_params)
 
     # ---- 3. compute CPT ----------------------------------------------------
-    num_processes = min(cpu_count() - 1, len(domain_element_pk_list))
-    args_list = [(a_pk, domain_element_pk_list, language_pks) for a_pk in domain_element_pk_list]
-
-    with Pool(num_processes) as pool:
-        results = pool.map(compute_row, args_list)
-
-    cpt = pd.DataFrame(index=domain_element_pk_list, columns=domain_element_pk_list, dtype=float)
-    cpt_trust = pd.DataFrame(index=domain_element_pk_list, columns=domain_element_pk_list, dtype=int)
-
-    for a_pk, row, trust_row in results:
-        for b_pk in domain_element_pk_list:
-            cpt.at[a_pk, b_pk] = row.get(b_pk, np.nan)
-            cpt_trust.at[a_pk, b_pk] = trust_row.get(b_pk, np.nan)
+    print("WALS CPT computation: {} values over {} languages".format(len(domain_element_pk_list), len(language_pks)))
+    cpt, cpt_trust = compute_conditional_probability_table(language_pks, domain_element_pk_list)
 
-    # ---- 4. Save -----------------------------------------------------------
-    out = Path("../external_data/wals_derived/experimental_cpt")
+    # ---- 4. save -----------------------------------------------------------
+    out = Path(output_folder if output_folder is not None else wals_data.path("partial_cpt"))
     out.mkdir(exist_ok=True, parents=True)
 
     suffix = []
     for key in ["family", "subfamily", "genus", "macroarea"]:
         if key in language_filter and language_filter[key]:
-            suffix.append(f"{key}_{'-'.join(language_filter[key])}")
+            suffix.append(key + "_" + "-".join(language_filter[key]))
     if exclude_lids:
-        suffix.append(f"languages_excluded_hash_{u.generate_hash_from_list(exclude_lids)}")
+        suffix.append("languages_excluded_hash_{}".format(u.generate_hash_from_list(exclude_lids)))
 
     fname = "de_conditional_probability" + ("_" + "_".join(suffix) if suffix else "") + ".json"
     f_trust_name = "de_conditional_probability_trust_" + ("_" + "_".join(suffix) if suffix else "") + ".json"
@@ -601,10 +537,10 @@ def build_conditional_probability_table_multiprocessing(filtered_params=True,
     cpt.to_json(out / fname)
     cpt_trust.to_json(out / f_trust_name)
 
-    print("Saved to:", os.path.join(out, fname))
     return os.path.join(out, fname)
 
 
+
 #   ========================
 
 
@@ -729,7 +665,7 @@ def build_conditional_probability_table_multiprocessing(filtered_params=True,
 
 def get_available_wals_languages_dict():
     language_dict = {}
-    with open("./external_data/wals_derived/language_by_pk_lookup_table.json", encoding='utf-8') as f:
+    with open(wals_data.path("language_by_pk_lookup_table.json"), encoding='utf-8') as f:
         language_by_pk_lookup_table = json.load(f)
     for lpk in language_by_pk_lookup_table.keys():
         language_dict[language_by_pk_lookup_table[lpk]["name"]] = {
@@ -737,97 +673,92 @@ def get_available_wals_languages_dict():
             "id": language_by_pk_lookup_table[lpk]["id"]
         }
 
-    with open("./external_data/wals_derived/language_pk_id_by_name.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("language_pk_id_by_name.json"), "w", encoding='utf-8') as f:
         json.dump(language_dict, f, ensure_ascii=False)
 
     return language_dict
 
-def get_wals_language_data_by_id_or_name(language_id, language_name=None):
-    try:
-        with open("./external_data/wals_derived/language_by_pk_lookup_table.json", encoding='utf-8') as f:
-            language_by_pk_lookup_table = json.load(f)
-        with open("./external_data/wals_derived/valueset_by_pk_lookup_table.json", encoding='utf-8') as f:
-            valueset_by_pk_lookup_table = json.load(f)
-        with open("./external_data/wals_derived/domain_element_by_pk_lookup_table.json", encoding='utf-8') as f:
-            domainelement_by_pk_lookup_table = json.load(f)
-        with open("./external_data/wals_derived/parameter_pk_by_name_lookup_table.json", encoding='utf-8') as f:
-            parameter_pk_by_name = json.load(f)
-        values = u.csv_to_dict("./external_data/wals-master/raw/value.csv")
-    except FileNotFoundError:
-        with open("../external_data/wals_derived/language_by_pk_lookup_table.json", encoding='utf-8') as f:
-            language_by_pk_lookup_table = json.load(f)
-        with open("../external_data/wals_derived/valueset_by_pk_lookup_table.json", encoding='utf-8') as f:
-            valueset_by_pk_lookup_table = json.load(f)
-        with open("../external_data/wals_derived/domain_element_by_pk_lookup_table.json", encoding='utf-8') as f:
-            domainelement_by_pk_lookup_table = json.load(f)
-        with open("../external_data/wals_derived/parameter_pk_by_name_lookup_table.json", encoding='utf-8') as f:
-            parameter_pk_by_name = json.load(f)
-        values = u.csv_to_dict("../external_data/wals-master/raw/value.csv")
+def build_language_profiles_by_id():
+    """ builds in one pass over the raw WALS tables the profile of each language:
+    {language id: {parameter pk: {"parameter", "value", "domainelement_pk", "valueset_pk"}}}
+    and stores it in language_profiles_by_id.json."""
+    print("build_language_profiles_by_id")
+    raw_folder = get_wals_raw_folder()
+    values = pd.read_csv(os.path.join(raw_folder, "value.csv"), usecols=["valueset_pk", "domainelement_pk"])
+    valuesets = pd.read_csv(os.path.join(raw_folder, "valueset.csv"), usecols=["pk", "language_pk"])
+    # keep_default_na=False: some WALS language ids ("nan") would otherwise be read as NaN
+    languages = pd.read_csv(os.path.join(raw_folder, "language.csv"), usecols=["pk", "id"], keep_default_na=False)
+    domain_elements = pd.read_csv(os.path.join(raw_folder, "domainelement.csv"), usecols=["pk", "name", "parameter_pk"])
+    parameters = pd.read_csv(os.path.join(raw_folder, "parameter.csv"), usecols=["pk", "name"])
+
+    rows = values.merge(valuesets.rename(columns={"pk": "valueset_pk"}), on="valueset_pk")
+    rows = rows.merge(languages.rename(columns={"pk": "language_pk", "id": "language_id"}), on="language_pk")
+    rows = rows.merge(domain_elements.rename(columns={"pk": "domainelement_pk", "name": "value"}), on="domainelement_pk")
+    rows = rows.merge(parameters.rename(columns={"pk": "parameter_pk", "name": "parameter"}), on="parameter_pk", how="left")
+
+    language_profiles_by_id = {}
+    for row in rows.itertuples(index=False):
+        language_profiles_by_id.setdefault(row.language_id, {})[str(row.parameter_pk)] = {
+            "parameter": row.parameter if isinstance(row.parameter, str) else None,
+            "value": row.value,
+            "domainelement_pk": int(row.domainelement_pk),
+            "valueset_pk": int(row.valueset_pk)
+        }
 
-    if language_id == None and language_name != None:
-        language_pk_found = False
-        for pk in language_by_pk_lookup_table.keys():
-            if language_by_pk_lookup_table[pk]["name"] == language_name:
-                selected_language_pk = pk
-                language_pk_found = True
-                break
+    with open(wals_data.path("language_profiles_by_id.json"), "w", encoding='utf-8') as f:
+        json.dump(language_profiles_by_id, f, ensure_ascii=False)
+
+    return language_profiles_by_id
+
+
+def load_language_profiles_by_id(data):
+    """ language profiles with int parameter pk keys, built from the raw tables if not stored yet."""
+    if os.path.isfile(data.path("language_profiles_by_id.json")):
+        with open(data.path("language_profiles_by_id.json"), "r", encoding='utf-8') as f:
+            language_profiles_by_id = json.load(f)
     else:
-        language_pk_found = False
-        for pk in language_by_pk_lookup_table.keys():
-            if language_by_pk_lookup_table[pk]["id"] == language_id:
-                selected_language_pk = pk
-                language_pk_found = True
-                break
-    if language_pk_found:
-        valueset_list = []
-        vpks = []
-        # retrieving all value_pk associated with this language_pk
-        for pk in valueset_by_pk_lookup_table:
-            if str(valueset_by_pk_lookup_table[pk]["language_pk"]) == selected_language_pk:
-                vpks.append(pk)
-        #print("vpks: ",vpks)
-        for item in values:
-            if str(item["valueset_pk"]) in vpks:
-                valueset_list.append({"valueset_pk":item["valueset_pk"], "domainelement_pk":item["domainelement_pk"]})
-        # now getting an organized dict with parameter and parameter_value for that language
-        result_dict = {}
-        for item in valueset_list:
-            parameter_pk = domainelement_by_pk_lookup_table[str(item["domainelement_pk"])]["parameter_pk"]
-            for name in parameter_pk_by_name:
-                if str(parameter_pk_by_name[name]) == str(parameter_pk):
-                    parameter_name = name
-                    break
-                else:
-                    #print("no match for parameter pk {}".format(parameter_pk))
-                    parameter_name = None
-            domainelement_name = domainelement_by_pk_lookup_table[str(item["domainelement_pk"])]["name"]
-            result_dict[parameter_pk] = {
-                "parameter": parameter_name,
-                "value": domainelement_name,
-                "domainelement_pk": item["domainelement_pk"],
-                "valueset_pk": item["valueset_pk"]
-            }
-        return result_dict
+        print("language_profiles_by_id not found in the file system, building it.")
+        language_profiles_by_id = build_language_profiles_by_id()
+    return {language_id: {int(ppk): record for ppk, record in profile.items()}
+            for language_id, profile in language_profiles_by_id.items()}
+
+
+def build_language_id_by_name(data):
+    # first language listed with a given name, as the former scan of language_by_pk did
+    language_id_by_name = {}
+    for language in data.language_by_pk.values():
+        language_id_by_name.setdefault(language["name"], language["id"])
+    return language_id_by_name
+
+
+def get_wals_language_data_by_id_or_name(language_id, language_name=None):
+    """ returns {parameter pk (int): {"parameter", "value", "domainelement_pk", "valueset_pk"}} for a WALS language,
+    from the language profile index. Returns {} for unknown languages."""
+    if language_id == None and language_name != None:
+        language_id = wals_data.language_id_by_name.get(language_name, None)
+    if language_id in wals_data.language_profiles_by_id:
+        # shallow copy: callers get their own dict, records are shared
+        return dict(wals_data.language_profiles_by_id[language_id])
     else:
         print("language pk with id {} not found".format(language_id))
         return {}
 
 def build_parameter_pk_by_name_lookup_table():
     print("build_parameter_pk_by_name_lookup_table")
-    parameter = u.csv_to_dict("../external_data/wals-master/raw/parameter.csv")
+    parameter = u.csv_to_dict(os.path.join(get_wals_raw_folder(), "parameter.csv"))
     parameter_pk_by_name_lookup_table = {}
     for entry in parameter:
         parameter_pk_by_name_lookup_table[entry["name"]] = str(entry["pk"])
     # store the lookup table in a file
 
-    with open("../external_data/wals_derived/parameter_pk_by_name_lookup_table.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("parameter_pk_by_name_lookup_table.json"), "w", encoding='utf-8') as f:
         json.dump(parameter_pk_by_name_lookup_table, f, ensure_ascii=False)
 
     return parameter_pk_by_name_lookup_table
 
 def load_parameter_pk_by_name_lookup_table():
-    if "parameter_pk_by_name_lookup_table.json" in os.listdir("./external_data/wals_derived/"):
-        with open("./external_data/wals_derived/parameter_pk_by_name_lookup_table.json", encoding='utf-8') as f:
+    if "parameter_pk_by_name_lookup_table.json" in os.listdir(wals_data.root):
+        with open(wals_data.path("parameter_pk_by_name_lookup_table.json"), encoding='utf-8') as f:
             return json.load(f)
     else:
         print("domain_elements_pk_by_parameter_pk_lookup_table not found in the file system, building it.")
@@ -835,7 +766,7 @@ def load_parameter_pk_by_name_lookup_table():
 
 def build_domain_elements_pk_by_parameter_pk_lookup_table():
     print("build_domain_element_pk_by_parameter_pk_lookup_table")
-    domain_element = u.csv_to_dict("../external_data/wals-master/raw/domainelement.csv")
+    domain_element = u.csv_to_dict(os.path.join(get_wals_raw_folder(), "domainelement.csv"))
     domain_elements_pk_by_parameter_pk_lookup_table = {}
     for entry in domain_element:
         if entry["parameter_pk"] not in domain_elements_pk_by_parameter_pk_lookup_table:
@@ -844,14 +775,14 @@ def build_domain_elements_pk_by_parameter_pk_lookup_table():
             domain_elements_pk_by_parameter_pk_lookup_table[entry["parameter_pk"]].append(str(entry["pk"]))
     # store the lookup table in a file
 
-    with open("../external_data/wals_derived/domain_elements_pk_by_parameter_pk_lookup_table.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("domain_elements_pk_by_parameter_pk_lookup_table.json"), "w", encoding='utf-8') as f:
         json.dump(domain_elements_pk_by_parameter_pk_lookup_table, f, ensure_ascii=False)
 
     return domain_elements_pk_by_parameter_pk_lookup_table
 
 def load_domain_elements_pk_by_parameter_pk_lookup_table():
-    if "domain_elements_pk_by_parameter_pk_lookup_table.json" in os.listdir("./external_data/wals_derived/"):
-        with open("./external_data/wals_derived/domain_elements_pk_by_parameter_pk_lookup_table.json", encoding='utf-8') as f:
+    if "domain_elements_pk_by_parameter_pk_lookup_table.json" in os.listdir(wals_data.root):
+        with open(wals_data.path("domain_elements_pk_by_parameter_pk_lookup_table.json"), encoding='utf-8') as f:
             return json.load(f)
     else:
         print("domain_elements_pk_by_parameter_pk_lookup_table not found in the file system, building it.")
@@ -859,7 +790,7 @@ def load_domain_elements_pk_by_parameter_pk_lookup_table():
 
 def build_domain_element_by_pk_lookup_table():
     print("build_domain_element_by_pk_lookup_table")
-    domain_element = u.csv_to_dict("./external_data/wals-master/raw/domainelement.csv")
+    domain_element = u.csv_to_dict(os.path.join(get_wals_raw_folder(), "domainelement.csv"))
     domain_element_by_pk_lookup_table = {}
     for entry in domain_element:
         if entry["pk"] not in domain_element_by_pk_lookup_table:
@@ -868,14 +799,14 @@ def build_domain_element_by_pk_lookup_table():
             domain_element_by_pk_lookup_table[entry["pk"]].append(entry)
     # store the lookup table in a file
 
-    with open("./external_data/wals_derived/domain_element_by_pk_lookup_table.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("domain_element_by_pk_lookup_table.json"), "w", encoding='utf-8') as f:
         json.dump(domain_element_by_pk_lookup_table, f, ensure_ascii=False)
 
     return domain_element_by_pk_lookup_table
 
 def load_domain_element_by_pk_lookup_table():
-    if "domain_element_by_pk_lookup_table.json" in os.listdir("./external_data/wals_derived/"):
-        with open ("./external_data/wals_derived/domain_element_by_pk_lookup_table.json") as f:
+    if "domain_element_by_pk_lookup_table.json" in os.listdir(wals_data.root):
+        with open (wals_data.path("domain_element_by_pk_lookup_table.json")) as f:
             return json.load(f)
     else:
         print("domain_element_by_pk_lookup_table not found in the file system, building it.")
@@ -883,7 +814,7 @@ def load_domain_element_by_pk_lookup_table():
 
 def build_value_by_domain_element_pk_lookup_table():
     print("build_value_by_domain_element_pk_lookup_table")
-    values = u.csv_to_dict("./external_data/wals-master/raw/value.csv")
+    values = u.csv_to_dict(os.path.join(get_wals_raw_folder(), "value.csv"))
     value_by_domain_element_pk_lookup_table = {}
     for value in values:
         if value["domainelement_pk"] not in value_by_domain_element_pk_lookup_table:
@@ -892,14 +823,14 @@ def build_value_by_domain_element_pk_lookup_table():
             value_by_domain_element_pk_lookup_table[value["domainelement_pk"]].append(value)
     # store the lookup table in a file
 
-    with open("./external_data/wals_derived/value_by_domain_element_pk_lookup_table.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("value_by_domain_element_pk_lookup_table.json"), "w", encoding='utf-8') as f:
         json.dump(value_by_domain_element_pk_lookup_table, f, ensure_ascii=False)
 
     return value_by_domain_element_pk_lookup_table
 
 def load_value_by_domain_element_pk_lookup_table():
-    if "value_by_domain_element_pk_lookup_table.json" in os.listdir("./external_data/wals_derived/"):
-        with open("./external_data/wals_derived/value_by_domain_element_pk_lookup_table.json", "r", encoding='utf-8') as f:
+    if "value_by_domain_element_pk_lookup_table.json" in os.listdir(wals_data.root):
+        with open(wals_data.path("value_by_domain_element_pk_lookup_table.json"), "r", encoding='utf-8') as f:
             return json.load(f)
     else:
         print("build_value_by_domain_element_pk_lookup_table not found in the file system, building it.")
@@ -907,20 +838,20 @@ def load_value_by_domain_element_pk_lookup_table():
 
 def build_valueset_by_pk_lookup_table():
     print("build_valueset_by_pk_lookup_table")
-    valueset = u.csv_to_dict("./external_data/wals-master/raw/valueset.csv")
+    valueset = u.csv_to_dict(os.path.join(get_wals_raw_folder(), "valueset.csv"))
     valueset_by_pk_lookup_table = {}
     for v in valueset:
         valueset_by_pk_lookup_table[v["pk"]] = v
     # store the lookup table in a file
 
-    with open("./external_data/wals_derived/valueset_by_pk_lookup_table.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("valueset_by_pk_lookup_table.json"), "w", encoding='utf-8') as f:
         json.dump(valueset_by_pk_lookup_table, f, ensure_ascii=False)
 
     return valueset_by_pk_lookup_table
 
 def load_valueset_by_pk_lookup_table():
-    if "valueset_by_pk_lookup_table.json" in os.listdir("./external_data/wals_derived/"):
-        with open("./external_data/wals_derived/valueset_by_pk_lookup_table.json", "r", encoding='utf-8') as f:
+    if "valueset_by_pk_lookup_table.json" in os.listdir(wals_data.root):
+        with open(wals_data.path("valueset_by_pk_lookup_table.json"), "r", encoding='utf-8') as f:
             return json.load(f)
     else:
         print("valueset_by_pk_lookup_table not found in the file system, building it.")
@@ -928,20 +859,20 @@ def load_valueset_by_pk_lookup_table():
 
 def build_language_by_pk_lookup_table():
     print("build_language_by_pk_lookup_table")
-    language = u.csv_to_dict("./external_data/wals-master/raw/language.csv")
+    language = u.csv_to_dict(os.path.join(get_wals_raw_folder(), "language.csv"))
     language_by_pk_lookup_table = {}
     for l in language:
         language_by_pk_lookup_table[l["pk"]] = l
     # store the lookup table in a file
 
-    with open("./external_data/wals_derived/language_by_pk_lookup_table.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("language_by_pk_lookup_table.json"), "w", encoding='utf-8') as f:
         json.dump(language_by_pk_lookup_table, f, ensure_ascii=False)
 
     return language_by_pk_lookup_table
 
 def load_language_by_pk_lookup_table():
-    if "language_by_pk_lookup_table.json" in os.listdir("./external_data/wals_derived/"):
-        with open("./external_data/wals_derived/language_by_pk_lookup_table.json", "r", encoding='utf-8') as f:
+    if "language_by_pk_lookup_table.json" in os.listdir(wals_data.root):
+        with open(wals_data.path("language_by_pk_lookup_table.json"), "r", encoding='utf-8') as f:
             return json.load(f)
     else:
         print("language_by_pk_lookup_table not found in the file system, building it.")
@@ -950,7 +881,7 @@ def load_language_by_pk_lookup_table():
 def build_language_info_by_id_lookup_table():
     print("build_language_info_by_id_lookup_table")
     language_info_by_id_lookup_table = {}
-    languagesMSD = u.csv_to_dict("./external_data/wals-master/raw/languagesMSD.csv")
+    languagesMSD = u.csv_to_dict(os.path.join(get_wals_raw_folder(), "languagesMSD.csv"))
     for l in languagesMSD:
         language_info_by_id_lookup_table[l["ID"]] = {
             "name": l["NameNEW"],
@@ -961,14 +892,14 @@ def build_language_info_by_id_lookup_table():
         }
     # store the lookup table in a file
 
-    with open("./external_data/wals_derived/language_info_by_id_lookup_table.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("language_info_by_id_lookup_table.json"), "w", encoding='utf-8') as f:
         json.dump(language_info_by_id_lookup_table, f, ensure_ascii=False)
 
     return language_info_by_id_lookup_table
 
 def load_language_info_by_id_lookup_table():
-    if "language_info_by_id_lookup_table.json" in os.listdir("./external_data/wals_derived/"):
-        with open("./external_data/wals_derived/language_info_by_id_lookup_table.json", "r", encoding='utf-8') as f:
+    if "language_info_by_id_lookup_table.json" in os.listdir(wals_data.root):
+        with open(wals_data.path("language_info_by_id_lookup_table.json"), "r", encoding='utf-8') as f:
             return json.load(f)
     else:
         print("language_info_by_id_lookup_table not found in the file system, building it.")
@@ -995,11 +926,11 @@ def update_delimiter_file():
 
 def build_domain_elements_pk_by_parameter_pk_lookup_table_filtered():
     """creates the reduced domain_element_by_pk json based on a limited list of paramaters"""
-    with open("./external_data/wals_derived/parameter_pk_by_name_filtered.json", encoding='utf-8') as f:
+    with open(wals_data.path("parameter_pk_by_name_filtered.json"), encoding='utf-8') as f:
         filtered_params = json.load(f)
-    with open("./external_data/wals_derived/domain_element_by_pk_lookup_table.json", encoding='utf-8') as f:
+    with open(wals_data.path("domain_element_by_pk_lookup_table.json"), encoding='utf-8') as f:
         domain_element_by_pk_lookup_table = json.load(f)
-    with open("./external_data/wals_derived/domain_elements_pk_by_parameter_pk_lookup_table.json", encoding='utf-8') as f:
+    with open(wals_data.path("domain_elements_pk_by_parameter_pk_lookup_table.json"), encoding='utf-8') as f:
         domain_elements_pk_by_parameter_pk = json.load(f)
 
     filtered_de = {}
@@ -1016,14 +947,14 @@ def build_domain_elements_pk_by_parameter_pk_lookup_table_filtered():
             print("{} not in domain_elements_pk_by_parameter_pk".format(param_pk))
 
 
-    with open("./external_data/wals_derived/domain_element_by_pk_lookup_table_filtered.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("domain_element_by_pk_lookup_table_filtered.json"), "w", encoding='utf-8') as f:
         json.dump(filtered_de, f, ensure_ascii=False)
 
 
 def build_language_pk_by_family_subfamily_genus_macroarea():
-    with open("./external_data/wals_derived/language_info_by_id_lookup_table.json", encoding='utf-8') as f:
+    with open(wals_data.path("language_info_by_id_lookup_table.json"), encoding='utf-8') as f:
         language_info_by_id = json.load(f)
-    with open("./external_data/wals_derived/language_by_pk_lookup_table.json", encoding='utf-8') as f:
+    with open(wals_data.path("language_by_pk_lookup_table.json"), encoding='utf-8') as f:
         language_by_pk = json.load(f)
 
     language_pk_by_id = {}
@@ -1069,13 +1000,13 @@ def build_language_pk_by_family_subfamily_genus_macroarea():
             print("{} not in language_pk_by_id")
 
 
-    with open("./external_data/wals_derived/language_pk_by_family.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("language_pk_by_family.json"), "w", encoding='utf-8') as f:
         json.dump(language_pk_by_family, f, ensure_ascii=False)
-    with open("./external_data/wals_derived/language_pk_by_subfamily.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("language_pk_by_subfamily.json"), "w", encoding='utf-8') as f:
         json.dump(language_pk_by_subfamily, f, ensure_ascii=False)
-    with open("./external_data/wals_derived/language_pk_by_genus.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("language_pk_by_genus.json"), "w", encoding='utf-8') as f:
         json.dump(language_pk_by_genus, f, ensure_ascii=False)
-    with open("./external_data/wals_derived/language_pk_by_macroarea.json", "w", encoding='utf-8') as f:
+    with open(wals_data.path("language_pk_by_macroarea.json"), "w", encoding='utf-8') as f:
         json.dump(language_pk_by_macroarea, f, ensure_ascii=False)
 
 # ========================= WALS GRAPH ANALYSIS ===================================================
@@ -1083,109 +1014,84 @@ def build_language_pk_by_family_subfamily_genus_macroarea():
 def analyze_total_wals_parameter_graph(
     min_non_nan=1,                        # edge exists if >= this many non-NaN cells
     drop_self_loops=True,
+    active_wals_cpt=None,                 # default: WALS CPT
 ):
     """
     Build and analyze the *global* directed parameter graph induced by a value–value CPT.
 
     Edge Pi -> Pj exists if the extracted matrix P(Pj | Pi) has at least `min_non_nan`
     non-NaN cells after slicing.
+    CPT values are grouped by parameter, so the non-NaN counts of all parameter pairs
+    come from one block reduction of the CPT array.
 
-    Returns a report dict + a lightweight edge list.
+    Returns a report dict + the edge list as arrays {"parent", "child", "non_nan_cells"}.
     """
-
-    with open("../external_data/wals_derived/de_conditional_probability_df.json", "r") as f:
-        active_wals_cpt = pd.DataFrame(json.load(f))
-
-
-    # Make sure labels are strings to match your extraction assumptions
-    cpt = active_wals_cpt.copy()
-    cpt.index = cpt.index.astype(str)
-    cpt.columns = cpt.columns.astype(str)
+    if active_wals_cpt is None:
+        active_wals_cpt = wals_data.cpt
 
     # parameter list
-    ppk_list = list(domain_elements_pk_by_parameter_pk.keys())
-    ppk_list = [str(x) for x in ppk_list]
-
-    # helper: count non-NaN in extracted block quickly
-    def block_non_nan_count(ppk_child, ppk_parent):
-        child_vals = [str(x) for x in domain_elements_pk_by_parameter_pk.get(str(ppk_child), [])]
-        parent_vals = [str(x) for x in domain_elements_pk_by_parameter_pk.get(str(ppk_parent), [])]
-        if not child_vals or not parent_vals:
-            return 0
-
-        # slice: rows child, cols parent = P(child_value | parent_value)
-        try:
-            block = cpt.loc[child_vals, parent_vals]
-        except KeyError:
-            return 0
-
-        return int(block.notna().sum().sum())
-
-    edges = []  # (parent_ppk, child_ppk, non_nan_cells)
-    out_deg = Counter()
-    in_deg = Counter()
+    ppk_list = [str(x) for x in wals_data.domain_elements_pk_by_parameter_pk.keys()]
+    n = len(ppk_list)
 
-    for parent in ppk_list:
-        for child in ppk_list:
-            if drop_self_loops and child == parent:
-                continue
-            nn = block_non_nan_count(child, parent)
-            if nn >= min_non_nan:
-                edges.append((parent, child, nn))
-                out_deg[parent] += 1
-                in_deg[child] += 1
+    # parameter-block index: parameters with values missing from the CPT have no edges
+    cpt_labels = set(str(x) for x in active_wals_cpt.index) & set(str(x) for x in active_wals_cpt.columns)
+    block_params = []
+    block_values = []
+    for i, ppk in enumerate(ppk_list):
+        values = [str(x) for x in wals_data.domain_elements_pk_by_parameter_pk[ppk]]
+        if values and all(v in cpt_labels for v in values):
+            block_params.append(i)
+            block_values.append(values)
+
+    # non_nan[child, parent] = number of non-NaN cells of P(child values | parent values)
+    non_nan = np.zeros((n, n), dtype=np.int64)
+    if block_params:
+        labels = [v for values in block_values for v in values]
+        starts = np.concatenate([[0], np.cumsum([len(values) for values in block_values])[:-1]]).astype(int)
+        not_nan = active_wals_cpt.reindex(index=labels, columns=labels).notna().to_numpy(dtype=np.int64)
+        block_counts = np.add.reduceat(np.add.reduceat(not_nan, starts, axis=0), starts, axis=1)
+        non_nan[np.ix_(block_params, block_params)] = block_counts
+
+    adjacency = non_nan.T >= min_non_nan          # adjacency[parent, child]
+    if drop_self_loops:
+        np.fill_diagonal(adjacency, False)
+    parent_idx, child_idx = np.nonzero(adjacency)
+    ppk_array = np.array(ppk_list)
+    edges = {
+        "parent": ppk_array[parent_idx],
+        "child": ppk_array[child_idx],
+        "non_nan_cells": non_nan[child_idx, parent_idx],
+    }
 
-    n = len(ppk_list)
-    m = len(edges)
+    m = len(parent_idx)
     max_edges = n * (n - 1) if drop_self_loops else n * n
     density = m / max_edges if max_edges else 0.0
 
     # connected components (undirected view)
-    undirected = defaultdict(set)
-    for u, v, _ in edges:
-        undirected[u].add(v)
-        undirected[v].add(u)
-    for p in ppk_list:
-        undirected[p] |= set()
-
-    visited = set()
-    comps = []
-    for p in ppk_list:
-        if p in visited:
-            continue
-        stack = [p]
-        visited.add(p)
-        comp = set()
-        while stack:
-            x = stack.pop()
-            comp.add(x)
-            for y in undirected[x]:
-                if y not in visited:
-                    visited.add(y)
-                    stack.append(y)
-        comps.append(comp)
-    comps = sorted(comps, key=len, reverse=True)
-
-    def deg_stats(counter):
-        vals = list(counter.values())
-        if not vals:
+    components_count, component_labels = connected_components(sparse.csr_matrix(adjacency), directed=True, connection="weak")
+    component_sizes = sorted(np.bincount(component_labels).tolist(), reverse=True)
+
+    # degrees of the parameters having at least one edge
+    def deg_stats(degrees):
+        vals = degrees[degrees > 0]
+        if len(vals) == 0:
             return {"min": 0, "max": 0, "mean": 0.0}
-        return {"min": min(vals), "max": max(vals), "mean": sum(vals)/len(vals)}
+        return {"min": int(vals.min()), "max": int(vals.max()), "mean": float(vals.mean())}
 
     # optional name mapping for readability
     ppk_to_name = None
-    if parameter_pk_by_name:
-        ppk_to_name = {str(v): k for k, v in parameter_pk_by_name.items()}
+    if wals_data.parameter_pk_by_name:
+        ppk_to_name = {str(v): k for k, v in wals_data.parameter_pk_by_name.items()}
 
     report = {
         "nodes_parameters": n,
         "directed_edges": m,
         "density_directed": density,
         "min_non_nan_threshold": min_non_nan,
-        "out_degree": deg_stats(out_deg),
-        "in_degree": deg_stats(in_deg),
-        "components_count": len(comps),
-        "largest_components_sizes": [len(c) for c in comps[:10]],
+        "out_degree": deg_stats(adjacency.sum(axis=1)),
+        "in_degree": deg_stats(adjacency.sum(axis=0)),
+        "components_count": int(components_count),
+        "largest_components_sizes": component_sizes[:10],
         "ppk_to_name_available": ppk_to_name is not None,
     }
 
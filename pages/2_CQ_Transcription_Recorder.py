@@ -15,11 +15,11 @@
 
 import streamlit as st
 import json
-from os import listdir, mkdir
-from os.path import isfile, join
+from os import mkdir
 import time
 from libs import graphs_utils
 from libs import utils, stats, wals_utils as wu
+from libs import questionnaire_registry as qr
 from random import randint
 from libs import output_generation_utils as ogu
 from io import BytesIO
@@ -71,13 +71,11 @@ delimiters_bank = [
 ]
 key_counter = 0
 
-questionnaires_folder = "./questionnaires"
 # cq_list is the list of json files in the questionnaires folder
-cq_list = [f for f in listdir(questionnaires_folder) if isfile(join(questionnaires_folder, f)) and f.endswith(".json")]
+cq_list = qr.questionnaires.filenames()
 
 concepts_kson = json.load(open("./data/concepts.json", encoding='utf-8'))
 available_pivot_languages = list(wu.language_pk_id_by_name.keys())
-questionnaires_folder = "./questionnaires"
 
 if "concepts" not in st.session_state:
     with open("./data/concepts.json", "r", encoding='utf-8') as f:
@@ -110,11 +108,7 @@ if "loaded_existing_transcription" not in st.session_state:
 if "existing_filename" not in st.session_state:
     st.session_state["existing_filename"] = ""
 if "cq_id_dict" not in st.session_state:
-    cq_id_dict = {}
-    for cq in cq_list:
-        cq_json = json.load(open(join(questionnaires_folder, cq), encoding='utf-8'))
-        cq_id_dict[cq_json["uid"]] = {"filename": cq, "content": cq_json}
-    st.session_state["cq_id_dict"] = cq_id_dict
+    st.session_state["cq_id_dict"] = qr.questionnaires.get_cq_id_dict()
 
 st.title("Record Transcriptions")
 
@@ -261,7 +255,7 @@ with st.expander("Start a new transcription or edit the header of an existing on
 
 if st.session_state["cq_is_chosen"]:
     # load the json file
-    cq = json.load(open(join(questionnaires_folder, st.session_state["current_cq"]), encoding='utf-8'))
+    cq = qr.questionnaires.get_by_filename(st.session_state["current_cq"])
     number_of_sentences = len(cq["dialog"])
     st.session_state["recording"]["cq_uid"] = cq["uid"]
 
@@ -373,7 +367,7 @@ if st.session_state["cq_is_chosen"]:
     concept_words = {}
     colz.write(
         "In this sentence, would you know which word(s) would contribute to the expression the following concepts?")
-    concept_list = cq["dialog"][str(st.session_state["counter"])]["intent"]
+    concept_list = list(cq["dialog"][str(st.session_state["counter"])]["intent"])
 
     # Concepts
     is_negative_polarity = False
@@ -381,7 +375,7 @@ if st.session_state["cq_is_chosen"]:
         if concept[-8:] == "POLARITY":
             if properties["value"] == "NEGATIVE":
                 concept_list.append("Negative Polarity")
-    concept_list += cq["dialog"][str(st.session_state["counter"])]["concept"]
+    concept_list = concept_list + list(cq["dialog"][str(st.session_state["counter"])]["concept"])
     for concept in concept_list:
         concept_default = []
         if str(st.session_state["counter"]) in st.session_state["recording"]["data"].keys():
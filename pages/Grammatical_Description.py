@@ -84,6 +84,8 @@ if "belief_history" not in st.session_state:
     st.session_state["belief_history"] = {}
 if "consensus_store" not in st.session_state:
     st.session_state["consensus_store"] = {}
+if "consensus_stats" not in st.session_state:
+    st.session_state["consensus_stats"] = {}
 if "run_ga" not in st.session_state:
     st.session_state["run_ga"] = False
 if "ga_output_available" not in st.session_state:
@@ -402,6 +404,7 @@ with st.expander("Inputs"):
         st.session_state["observations_processed"] = False
         st.session_state["obs"] = {}
         st.session_state["consensus_store"] = {}
+        st.session_state["consensus_stats"] = {}
         st.session_state["belief_history"] = {}
         st.session_state["ga_output_available"] = False
         st.session_state["generate_description"] = False
@@ -645,11 +648,11 @@ if st.session_state["kg"] and not st.session_state["preprocessing_done"]:
         parameter_selection_belief = psu.BeliefState(priors)
 
         # feed observations: use a General Agent to get beliefs from observations -----------------------------------
-        st.session_state["parameter_selection_ga"] = general_agents.GeneralAgent("parameter_selection_ga",
-                                                                                 parameter_names=[str(name) for name in
-                                                                                                  st.session_state[
-                                                                                                      'obs'].keys()],
-                                                                                 language_stat_filter={})
+        st.session_state["parameter_selection_ga"] = general_agents.get_cached_general_agent("parameter_selection_ga",
+                                                                                             parameter_names=[str(name) for name in
+                                                                                                              st.session_state[
+                                                                                                                  'obs'].keys()],
+                                                                                             language_stat_filter={})
 
         for observed_param_name in st.session_state["tl_knowledge"]["observed"]:
             st.session_state["parameter_selection_ga"].add_observations(observed_param_name,
@@ -848,6 +851,7 @@ if (st.session_state["preprocessing_done"]
     side_info.write("Creating agent")
     st.session_state["belief_history"] = {}
     st.session_state["consensus_store"] = {}
+    st.session_state["consensus_stats"] = {}
     st.session_state["ga_output_available"] = False
     st.session_state["generate_description"] = False
     st.session_state["results_approved"] = False
@@ -868,12 +872,17 @@ if (st.session_state["preprocessing_done"]
 
     if st.session_state["run_ga"]:
         side_info.write("Running inferences")
-        st.session_state["ga"] = general_agents.GeneralAgent("ga",
-                                                             parameter_names=st.session_state["ga_param_names"],
-                                                             language_stat_filter=st.session_state["l_filter"])
-
-        st.session_state["belief_history"] = {param: [st.session_state["ga"].language_parameters[param].beliefs] for
+        st.session_state["ga"] = general_agents.get_cached_general_agent("ga",
+                                                                         parameter_names=st.session_state["ga_param_names"],
+                                                                         language_stat_filter=st.session_state["l_filter"],
+                                                                         filter_wals_cpt=True,
+                                                                         filter_grambank_cpt=True,
+                                                                         history_mode="off")
+
+        st.session_state["belief_history"] = {param: general_agents.BeliefHistory() for
                                               param in st.session_state["ga"].language_parameters.keys()}
+        for param in st.session_state["belief_history"].keys():
+            st.session_state["belief_history"][param].append(st.session_state["ga"].language_parameters[param].beliefs)
 
         # OBSERVATIONS
         for observed_param_name in st.session_state["tl_knowledge"]["observed"]:
@@ -905,21 +914,15 @@ if (st.session_state["preprocessing_done"]
 
         # BELIEF PROPAGATION
         side_info.write("Belief propagation")
-        beliefs_snapshot = st.session_state["ga"].get_beliefs()
-        for k in range(NUMBER_OF_MESSAGING_CYCLES):
-            st.session_state["belief_history"] = {param_name: [] for param_name in
-                                                  st.session_state["ga"].language_parameters.keys()}
-            st.session_state["ga"].reset_beliefs_history()
-            st.session_state["ga"].put_beliefs(beliefs_snapshot)
-            #st.write(st.session_state["ga"].get_displayable_beliefs())
-            for i in range(3):
-                st.session_state["ga"].run_belief_update_cycle()
-                for param in st.session_state["ga"].language_parameters.keys():
-                    st.session_state["belief_history"][param].append(
-                        st.session_state["ga"].language_parameters[param].beliefs)
-                # st.write("----------------**Messaging Iteration {}**---------------------".format(i))
-                # st.write(st.session_state["ga"].get_displayable_beliefs())
-            st.session_state["consensus_store"][k] = st.session_state["ga"].get_beliefs()
+        # NUMBER_OF_MESSAGING_CYCLES randomized runs of 3 cycles from the same beliefs, computed together
+        consensus = st.session_state["ga"].run_consensus(n_runs=NUMBER_OF_MESSAGING_CYCLES, n_cycles=3)
+        st.session_state["belief_history"] = {param_name: general_agents.BeliefHistory() for param_name in
+                                              st.session_state["ga"].language_parameters.keys()}
+        for beliefs in consensus["history"]:
+            for param in st.session_state["ga"].language_parameters.keys():
+                st.session_state["belief_history"][param].append(beliefs[param])
+        st.session_state["consensus_store"] = dict(enumerate(consensus["runs"]))
+        st.session_state["consensus_stats"] = {"mean": consensus["mean"], "variance": consensus["variance"]}
 
         cross_consensus_stat = {param: {gwu.get_pvalue_name_from_value_code(pvalue): [] for pvalue in
                                         st.session_state["consensus_store"][0][param].keys()}
@@ -964,9 +967,9 @@ if show_details and st.session_state["ga_output_available"]:
                                                                                  "ga"].language_parameters[
                                                                                  param].entropy, 2),
                                                                              rounded_weight))
-        pdf = pd.DataFrame(st.session_state["belief_history"][param]).T
+        pdf = st.session_state["belief_history"][param].to_df()
         renaming_dict = {}
-        for v in st.session_state["belief_history"][param][0].keys():
+        for v in pdf.index:
             renaming_dict[v] = gwu.get_pvalue_name_from_value_code(v)
         pdf = pdf.rename(index=renaming_dict)
         st.dataframe(pdf)
@@ -295,16 +295,16 @@ if len(st.session_state["ga_domains"]) > 0:
                 for pn in ga_param_name_list:
                     agent_name += pn[0] + random.sample(vowels, 1)[0]
                 if st.session_state["language_family_filter"] == "ALL":
-                    st.session_state["current_ga"] = general_agents.GeneralAgent(agent_name + str(time.time())[-3:],
-                                                                                 parameter_names=ga_param_name_list,
-                                                                                 language_stat_filter={}
-                                                                                 )
+                    st.session_state["current_ga"] = general_agents.get_cached_general_agent(agent_name + str(time.time())[-3:],
+                                                                                             parameter_names=ga_param_name_list,
+                                                                                             language_stat_filter={}
+                                                                                             )
                 else:
-                    st.session_state["current_ga"] = general_agents.GeneralAgent(agent_name + str(time.time())[-3:],
-                                                                                 parameter_names=ga_param_name_list,
-                                                                                 language_stat_filter={"family": [
-                                                                                     st.session_state[
-                                                                                         "language_family_filter"]]})
+                    st.session_state["current_ga"] = general_agents.get_cached_general_agent(agent_name + str(time.time())[-3:],
+                                                                                             parameter_names=ga_param_name_list,
+                                                                                             language_stat_filter={"family": [
+                                                                                                 st.session_state[
+                                                                                                     "language_family_filter"]]})
                 st.write("General Agent created")
 
             # last process to catch the new users params, resetting
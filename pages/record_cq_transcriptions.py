@@ -16,8 +16,7 @@
 import streamlit as st
 import json
 import os
-from os import listdir, mkdir
-from os.path import isfile, join
+from os import mkdir
 import time
 import streamlit_authenticator as stauth
 import yaml
@@ -27,6 +26,7 @@ from datetime import datetime
 from libs import utils as u
 from libs import graphs_utils
 from libs import utils, stats, wals_utils as wu
+from libs import questionnaire_registry as qr
 from libs import output_generation_utils as ogu
 from libs import glottolog_utils as gu
 from libs import file_manager_utils as fmu
@@ -87,13 +87,11 @@ delimiters_bank = [
 ]
 key_counter = 0
 
-questionnaires_folder = "./questionnaires"
 # cq_list is the list of json files in the questionnaires folder
-cq_list = [f for f in listdir(questionnaires_folder) if isfile(join(questionnaires_folder, f)) and f.endswith(".json")]
+cq_list = qr.questionnaires.filenames()
 
 concepts_kson = json.load(open("./data/concepts.json", encoding='utf-8'))
 available_pivot_languages = list(wu.language_pk_id_by_name.keys())
-questionnaires_folder = "./questionnaires"
 
 if "indi_language" not in st.session_state:
     st.session_state["indi_language"] = "Abkhaz-Adyge"
@@ -128,11 +126,7 @@ if "loaded_existing_transcription" not in st.session_state:
 if "existing_filename" not in st.session_state:
     st.session_state["existing_filename"] = ""
 if "cq_id_dict" not in st.session_state:
-    cq_id_dict = {}
-    for cq in cq_list:
-        cq_json = json.load(open(join(questionnaires_folder, cq), encoding='utf-8'))
-        cq_id_dict[cq_json["uid"]] = {"filename": cq, "content": cq_json}
-    st.session_state["cq_id_dict"] = cq_id_dict
+    st.session_state["cq_id_dict"] = qr.questionnaires.get_cq_id_dict()
 if "is_guest" not in st.session_state:
     st.session_state.is_guest = None
 if "caretaker_of" not in st.session_state:
@@ -696,7 +690,7 @@ else:  # if loaded_existing_transcription
 if st.session_state["cq_is_chosen"]:
     st.markdown("#### 3. Translate & Connect")
     # load the json file
-    cq = json.load(open(join(questionnaires_folder, st.session_state["current_cq"]), encoding='utf-8'))
+    cq = qr.questionnaires.get_by_filename(st.session_state["current_cq"])
     number_of_sentences = len(cq["dialog"])
     st.session_state["recording"]["cq_uid"] = cq["uid"]
 
@@ -818,7 +812,7 @@ if st.session_state["cq_is_chosen"]:
     concept_words = {}
     colz.write(
         "In this sentence, would you know which word(s) would contribute to the expression the following concepts?")
-    concept_list = cq["dialog"][str(st.session_state["counter"])]["intent"]
+    concept_list = list(cq["dialog"][str(st.session_state["counter"])]["intent"])
 
     # Concepts
     is_negative_polarity = False
@@ -826,7 +820,7 @@ if st.session_state["cq_is_chosen"]:
         if concept[-8:] == "POLARITY":
             if properties["value"] == "NEGATIVE":
                 concept_list.append("Negative Polarity")
-    concept_list += cq["dialog"][str(st.session_state["counter"])]["concept"]
+    concept_list = concept_list + list(cq["dialog"][str(st.session_state["counter"])]["concept"])
     for concept in concept_list:
         concept_default = []
         if str(st.session_state["counter"]) in st.session_state["recording"]["data"].keys():
@@ -130,6 +130,8 @@ if st.button("save"):
     normalized_wals_given_gb_df.to_json("./external_data/wals_given_grambank_cpt.json")
     normalized_gb_given_wals_df = normalize_conditional_probabilities(st.session_state["gb_given_wals_df"], gb_given_wals_row_groups)
     normalized_gb_given_wals_df.to_json("./external_data/grambank_given_wals_cpt.json")
+    # the sparse cross-dataset CPTs used by the agents include these edits
+    gwu.build_wals_grambank_cross_cpts()
     st.write("CP files updated")
 
 
@@ -0,0 +1,61 @@
+import random
+import time
+from libs import general_agents
+from libs import wals_utils as wu
+
+# Density and belief propagation speedup of pruned general agent graphs against the fully connected graph.
+# The benchmark set is the first N_PARAMETERS WALS parameters (by pk). For each pruning setting, the agent
+# runs N_CYCLES belief update cycles from the same priors and the winning values are compared with the ones
+# of the fully connected agent. The random message orders are seeded with SEED before the cycles of each agent:
+# all the agents use the same orders, differences in winning values come from the pruning only.
+
+N_PARAMETERS = 100
+N_CYCLES = 3
+SEED = 0
+SETTINGS = [
+    {"max_neighbors": 5},
+    {"max_neighbors": 10},
+    {"max_neighbors": 20},
+    {"min_mutual_information": 0.01},
+    {"min_mutual_information": 0.05},
+    {"max_neighbors": 10, "min_edge_support": 0.5},
+]
+
+
+def run_cycles(agent):
+    random.seed(SEED)
+    t0 = time.perf_counter()
+    for _ in range(N_CYCLES):
+        agent.run_belief_update_cycle()
+    return (time.perf_counter() - t0) / N_CYCLES
+
+
+def winning_values(agent):
+    return {lpn: lp.get_winning_belief_code() for lpn, lp in agent.language_parameters.items()}
+
+
+if __name__ == "__main__":
+    parameter_names = sorted(wu.parameter_pk_by_name.keys(), key=lambda name: int(wu.parameter_pk_by_name[name]))
+    parameter_names = parameter_names[:N_PARAMETERS]
+
+    t0 = time.perf_counter()
+    full_agent = general_agents.GeneralAgent("full", parameter_names=parameter_names, history_mode="off")
+    print("{} parameters, fully connected agent built in {:.2f}s".format(len(parameter_names), time.perf_counter() - t0))
+    full_cycle = run_cycles(full_agent)
+    full_values = winning_values(full_agent)
+    print("fully connected: {:.4f}s per cycle".format(full_cycle))
+
+    for setting in SETTINGS:
+        t0 = time.perf_counter()
+        agent = general_agents.GeneralAgent("pruned", parameter_names=parameter_names, history_mode="off", **setting)
+        build_time = time.perf_counter() - t0
+        report = agent.graph_pruning_report
+        cycle = run_cycles(agent)
+        values = winning_values(agent)
+        agreement = sum(values[lpn] == full_values[lpn] for lpn in values) / len(values)
+        print("{}: {} of {} edges (density {:.3f}), {:.0f}% of the mutual information, built in {:.2f}s, "
+              "{:.4f}s per cycle, speedup x{:.1f}, same winning value for {:.0f}% of the parameters".format(
+                setting, report["kept_edges"], report["edges"], report["density"],
+                100 * report["kept_mutual_information"] / report["total_mutual_information"]
+                if report["total_mutual_information"] else 0,
+                build_time, cycle, full_cycle / cycle if cycle else float("nan"), 100 * agreement))
@@ -0,0 +1,73 @@
+import subprocess
+import sys
+from pathlib import Path
+
+# Cold-start benchmark of the lazy WALS / Grambank lookup tables.
+# Each measure runs in a fresh interpreter from the repository root, as Streamlit pages do:
+#   - lazy:  import the module and access only the tables the page uses
+#   - eager: import the module and load every JSON lookup table, as the import used to do
+#     (tables built on first access, like the MRF potentials, are left out: building them writes derived files)
+# Tables missing from the data folder are reported and skipped.
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+N_RUNS = 5
+
+PAGES = {
+    "WALS_Explore.py": ("wals_utils", "wals_data", [
+        "parameter_pk_by_name",
+        "domain_elements_pk_by_parameter_pk",
+        "domain_element_by_pk",
+    ]),
+    "Grambank_Explore.py": ("grambank_utils", "grambank_data", [
+        "grambank_language_by_lid",
+        "grambank_param_value_dict",
+        "grambank_pid_by_pname",
+        "grambank_vname_by_vid",
+    ]),
+}
+
+MEASURE = """
+import time
+t0 = time.perf_counter()
+from libs import {module} as m
+registry = m.{registry}
+tables = {tables}
+if tables is None:
+    tables = [name for name, source in registry._tables.items() if not callable(source)]
+missing = []
+for name in tables:
+    try:
+        getattr(registry, name)
+    except FileNotFoundError:
+        missing.append(name)
+print("time=" + repr(time.perf_counter() - t0))
+print("missing=" + ",".join(missing))
+"""
+
+
+def measure(module, registry, tables):
+    durations = []
+    missing = ""
+    for _ in range(N_RUNS):
+        code = MEASURE.format(module=module, registry=registry, tables=repr(tables))
+        out = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, capture_output=True, text=True)
+        if out.returncode != 0:
+            raise RuntimeError(out.stderr.strip().split("\n")[-1])
+        # the module may print while loading: only the marked lines are read
+        results = dict(line.split("=", 1) for line in out.stdout.splitlines() if line.startswith(("time=", "missing=")))
+        durations.append(float(results["time"]))
+        missing = results["missing"]
+    return min(durations), missing
+
+
+if __name__ == "__main__":
+    for page, (module, registry, tables) in PAGES.items():
+        try:
+            lazy, _ = measure(module, registry, tables)
+            eager, missing = measure(module, registry, None)
+        except RuntimeError as e:
+            print("{}: import of libs.{} failed: {}".format(page, module, e))
+            continue
+        print("{}: lazy {:.3f}s, eager {:.3f}s, gain x{:.1f}".format(page, lazy, eager, eager / lazy if lazy else float("nan")))
+        if missing:
+            print("    tables not found (skipped in eager measure): {}".format(missing))
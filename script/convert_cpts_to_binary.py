@@ -0,0 +1,7 @@
+from libs import cpt_utils as cu
+
+# Converts the value-level CPTs from pandas JSON to the memory-mapped binary format (see cpt_utils).
+# Once converted, wals_utils, general_agents, grambank_utils and grambank_wals_utils map the binary
+# versions instead of parsing the JSON files (as long as the JSON files are not rebuilt after the conversion).
+# The CPTs are found in the external_data folder of the data registries (run from the repository root).
+cu.convert_default_cpts_to_binary()
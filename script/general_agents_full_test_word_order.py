@@ -9,7 +9,6 @@ import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 from libs import general_agents
 from libs import wals_utils as wu
-from libs.utils import generate_hash_from_list
 from scipy.stats import gaussian_kde, bootstrap
 from matplotlib.patches import Patch
 
@@ -69,94 +68,78 @@ def process_excluded_language(excluded_lid: str):
     nobs_pk_list = [str(v) for v in nobs.values()]
 
 
-    # CREATE OR LOAD CONDITIONAL PROBABILITY TABLE ============================================================
-    # Either load if existing or create and save a conditional probability table without the excluded languages.
-    # if existing, the file is in ../external_data/wals_derived/partial_cpt/
-    # filemame is "de_conditional_probability_df_new_" + u.generate_hash_from_list(excluded_lids) + ".json"
-    # we use the 16 first characters of a hash as a unique short encoder of the excluded languages.
-
-    if not os.path.exists("../external_data/wals_derived/partial_cpt/"):
-        os.makedirs("../external_data/wals_derived/partial_cpt/")
-    hash_value = generate_hash_from_list(excluded_lids)
-    cpt_filename = f"../external_data/wals_derived/partial_cpt/de_conditional_probability_languages_excluded_hash_{hash_value}.json"
-    if os.path.exists(cpt_filename):
-        print(f"Loading existing conditional probability table from {cpt_filename}")
-    else:
-        print(f"Creating new conditional probability table with {excluded_lid} excluded, saving to {cpt_filename}")
-        # Build the conditional probability table excluding the specified languages
-        cpt_filename = wu.build_conditional_probability_table(exclude_lids=excluded_lids)
-
-    CPT = pd.read_json(cpt_filename)
-    CPT.index = CPT.index.astype(str)
-    CPT.columns = CPT.columns.astype(str)
-    print("CPT loaded")
+    # DERIVE CONDITIONAL PROBABILITY TABLE ====================================================================
+    # The conditional probability table without the excluded languages is derived in memory from the global
+    # WALS co-occurrence counts, by subtracting the counts of the excluded languages.
+
+    CPT, _ = wu.compute_conditional_probability_table_excluding_languages(exclude_lids=excluded_lids)
+    print("CPT derived with {} excluded".format(excluded_lid))
 
     ga_param_name_list = list(obs.keys()) + list(nobs.keys())
 
     # Running max_epoch number of test across all languages
-    for epoch in range(1, 30):
-        # GA CREATION =========================================================================================
-        # excluded languages not used to build priors
-        ga = general_agents.GeneralAgent("experimental GA",
-                             parameter_names=ga_param_name_list,
-                             language_stat_filter={
-                                 "exclusion_list": excluded_pks  # experimental languages excluded from priors
-                             },
-                             active_wals_cpt=CPT)  # using a CPT that does not use experimental languages
-
+    # GA CREATION =========================================================================================
+    # one batched agent, one row of beliefs per epoch: priors and graph are computed once, and each epoch
+    # runs its messaging rounds in its own random order, as separate agents would.
+    epochs = list(range(1, 30))
+    test_lids = [lid for lid in excluded_lids for _ in epochs]
+    ga = general_agents.BatchedGeneralAgent("experimental GA",
+                                            parameter_names=ga_param_name_list,
+                                            language_ids=test_lids,
+                                            language_stat_filter={
+                                                "exclusion_list": excluded_pks  # experimental languages excluded from priors
+                                            },
+                                            active_wals_cpt=CPT)  # using a CPT that does not use experimental languages
+
+    # simulated observations
+    for row, lid in enumerate(test_lids):
+        language_data = wu.get_wals_language_data_by_id_or_name(lid)
+        for lp_name in ga.language_parameters.keys():
+            if lp_name in obs.keys():
+                # this parameter is considered as observed with a probability of 1.
+                # finding the true value
+                ppk = int(wu.parameter_pk_by_name[lp_name])
+                true_depk = language_data[ppk]["domainelement_pk"]
+                # injecting it
+                ga.inject_peak_belief(row, lp_name, true_depk, 1, locked=True)
+
+    # belief propagation, all epochs at once
+    for i in range(3):
+        ga.run_belief_update_cycle()
+
+    for row, lid in enumerate(test_lids):
+        epoch = epochs[row % len(epochs)]
         # ITERATING OVER TEST LANGUAGES
         general_result_dict = {}
-        c = 0
-        for lid in excluded_lids:
-            c += 1
-            lname = wu.language_info_by_id[lid]["name"]
-            print("language: {}, {}/{}".format(lname, c, len(experimental_lids)))
-            general_result_dict[lname] = {}
-
-            # priors
-            ga.reset_language_parameters_beliefs_with_wals()
-
-            # simulated observations
-            for lp_name in ga.language_parameters.keys():
-                if lp_name in obs.keys():
-                    # this parameter is considered as observed with a probability of 1.
-                    # finding the true value
-                    language_data = wu.get_wals_language_data_by_id_or_name(lid)
-                    ppk = int(wu.parameter_pk_by_name[lp_name])
-                    true_depk = language_data[ppk]["domainelement_pk"]
-                    # injecting it
-                    ga.language_parameters[lp_name].inject_peak_belief(true_depk,
-                                                                       1,
-                                                                       locked=True)
-            # belief propagation
-            for i in range(3):
-                ga.run_belief_update_cycle()
-
-            # record score
-            evaluation = {"success": 0, "failure": 0}
-            for upn in nobs.keys():
-                general_result_dict[lname][upn] = {}
-                expected_value = wu.get_wals_language_data_by_id_or_name(lid)[int(wu.parameter_pk_by_name[upn])][
-                    "domainelement_pk"]
-                current_consensus = max(ga.language_parameters[upn].beliefs,
-                                        key=ga.language_parameters[upn].beliefs.get)
-
-                general_result_dict[lname][upn]["expected"] = wu.get_careful_name_of_de_pk(str(expected_value))
-                general_result_dict[lname][upn]["consensus"] = wu.get_careful_name_of_de_pk(str(current_consensus))
-
-                if str(expected_value) == str(current_consensus):
-                    evaluation["success"] += 1
-                    general_result_dict[lname][upn]["success"] = True
-                else:
-                    evaluation["failure"] += 1
-                    general_result_dict[lname][upn]["success"] = False
-
-            if (evaluation["success"] + evaluation["failure"]) != 0:
-                score = evaluation["success"] / (evaluation["success"] + evaluation["failure"])
+        lname = wu.language_info_by_id[lid]["name"]
+        print("language: {}, epoch {}/{}".format(lname, epoch, len(epochs)))
+        general_result_dict[lname] = {}
+        consensus = ga.get_winning_belief_codes(row)
+
+        # record score
+        evaluation = {"success": 0, "failure": 0}
+        for upn in nobs.keys():
+            general_result_dict[lname][upn] = {}
+            expected_value = wu.get_wals_language_data_by_id_or_name(lid)[int(wu.parameter_pk_by_name[upn])][
+                "domainelement_pk"]
+            current_consensus = consensus[upn]
+
+            general_result_dict[lname][upn]["expected"] = wu.get_careful_name_of_de_pk(str(expected_value))
+            general_result_dict[lname][upn]["consensus"] = wu.get_careful_name_of_de_pk(str(current_consensus))
+
+            if str(expected_value) == str(current_consensus):
+                evaluation["success"] += 1
+                general_result_dict[lname][upn]["success"] = True
             else:
-                score = 0
+                evaluation["failure"] += 1
+                general_result_dict[lname][upn]["success"] = False
+
+        if (evaluation["success"] + evaluation["failure"]) != 0:
+            score = evaluation["success"] / (evaluation["success"] + evaluation["failure"])
+        else:
+            score = 0
 
-            general_result_dict[lname]["score_percent"] = round(score * 100, 0)
+        general_result_dict[lname]["score_percent"] = round(score * 100, 0)
 
         # format results across languages
 
@@ -0,0 +1,16 @@
+import pytest
+
+from libs.general_agents import BeliefHistory
+
+
+def test_last_mode_rejects_empty_buffer():
+    with pytest.raises(ValueError):
+        BeliefHistory(mode="last", max_length=0)
+
+
+def test_last_mode_keeps_the_last_steps():
+    history = BeliefHistory(mode="last", max_length=1)
+    history.append({"a": 0.2, "b": 0.8})
+    history.append({"a": 0.6, "b": 0.4})
+    assert len(history) == 1
+    assert history[-1] == {"a": 0.6, "b": 0.4}